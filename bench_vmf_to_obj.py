@@ -0,0 +1,297 @@
+import os
+import sys
+import json
+import math
+import shutil
+import struct
+import random
+import argparse
+import tempfile
+import subprocess
+
+#
+# Benchmark of vmf_to_obj_solids_mats.py on synthetic maps.
+#
+# Usage:
+#   python bench_vmf_to_obj.py                                  # 1k, 10k and 100k solids
+#   python bench_vmf_to_obj.py --sizes 1000 10000 --save-baseline bench_baseline.json
+#   python bench_vmf_to_obj.py --sizes 1000 10000 --baseline bench_baseline.json --threshold 0.2
+#
+# Every size is generated deterministically (same seed, same map) into a fake game folder
+# (gameinfo.txt, materials with VMT/VTF stubs, mapsrc/bench_<N>.vmf) and converted in a fresh process,
+# so the peak memory of one size doesn't leak into the next one.
+# With --baseline the run fails (exit code 1) if throughput, peak memory or a stage time regressed past the threshold.
+#
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Stages faster than this in the baseline are too noisy to be checked
+MIN_CHECKED_STAGE_SECONDS = 0.5
+
+GAMEINFO = '''"GameInfo"
+{
+	game "bench"
+	FileSystem
+	{
+		SearchPaths
+		{
+			game |gameinfo_path|.
+		}
+	}
+}
+'''
+
+# Function for the names and texture sizes of the generated materials; the last one is TOOLSNODRAW without a VTF
+def bench_materials(material_count):
+    rnd = random.Random(material_count)
+    materials = [(f'BENCH/BENCH_MAT_{i:03d}', (rnd.choice((256, 512, 1024, 2048)), rnd.choice((256, 512, 1024, 2048))))
+                 for i in range(max(material_count - 1, 1))]
+    materials.append(('TOOLS/TOOLSNODRAW', None))
+    return materials
+
+# Function for writing the VMT/VTF stubs, only the VTF header is written
+def write_materials(game_dir, materials):
+    for material, size in materials:
+        vmt_path = os.path.join(game_dir, 'materials', *material.split('/')) + '.vmt'
+        os.makedirs(os.path.dirname(vmt_path), exist_ok=True)
+        with open(vmt_path, 'w') as f:
+            f.write(f'"LightmappedGeneric"\n{{\n\t"$basetexture" "{material}"\n}}\n')
+        if size is None:
+            continue
+        # VTF 7.2 header: signature, version, header size, width, height, flags, frames, first frame,
+        # padding, reflectivity, padding, bumpmap scale, high res format
+        header = struct.pack('<4s2IIHHIHH4x3f4xfi', b'VTF\0', 7, 2, 80, size[0], size[1], 0, 1, 0, 0.5, 0.5, 0.5, 1.0, 13)
+        with open(vmt_path[:-len('.vmt')] + '.vtf', 'wb') as f:
+            f.write(header.ljust(80, b'\0'))
+
+# Function for the texture axes of a face, aligned to the world axis closest to its normal like in Hammer
+def texture_axes(normal, rnd):
+    scale = rnd.choice((0.25, 0.5))
+    shift = rnd.randint(0, 63)
+    axis = max(range(3), key=lambda i: abs(normal[i]))
+    if axis == 2:
+        return f'[1 0 0 {shift}] {scale}', f'[0 -1 0 0] {scale}'
+    if axis == 0:
+        return f'[0 1 0 {shift}] {scale}', f'[0 0 -1 0] {scale}'
+    return f'[1 0 0 {shift}] {scale}', f'[0 0 -1 0] {scale}'
+
+def cross(a, b):
+    return (a[1] * b[2] - a[2] * b[1], a[2] * b[0] - a[0] * b[2], a[0] * b[1] - a[1] * b[0])
+
+def sub(a, b):
+    return (a[0] - b[0], a[1] - b[1], a[2] - b[2])
+
+# Function for the faces of a prism with a regular polygon base, wound like Hammer (clockwise seen from outside)
+def prism_faces(x, y, z, radius, height, base_sides, rotation):
+    base = [(round(x + radius * math.cos(rotation + 2 * math.pi * i / base_sides), 3),
+             round(y + radius * math.sin(rotation + 2 * math.pi * i / base_sides), 3)) for i in range(base_sides)]
+    faces = [[(px, py, z + height) for px, py in reversed(base)],     # top
+             [(px, py, z) for px, py in base]]                         # bottom
+    for i in range(base_sides):
+        (ax, ay), (bx, by) = base[i], base[(i + 1) % base_sides]
+        faces.append([(ax, ay, z + height), (bx, by, z + height), (bx, by, z), (ax, ay, z)])
+
+    # Outward normal of a clockwise face is (c - b) x (b - a)
+    return [(face, cross(sub(face[2], face[1]), sub(face[1], face[0]))) for face in faces]
+
+# Function for generating a VMF with `solid_count` prism solids of `sides_per_solid` sides (at least 5).
+# About 5% of the solids are func_detail entity solids and 1% are hidden by visgroups, like in real maps.
+def generate_vmf(vmf_path, solid_count, sides_per_solid=6, materials=None, smoothing=0.25, seed=1):
+    rnd = random.Random(seed)
+    materials = materials or bench_materials(8)
+    material_names = [name for name, size in materials]
+    base_sides = max(sides_per_solid - 2, 3)
+    next_id = [1]
+
+    def new_id():
+        next_id[0] += 1
+        return next_id[0]
+
+    def solid(indent):
+        grid = int(math.sqrt(solid_count)) + 1
+        x, y, z = rnd.randrange(grid) * 256, rnd.randrange(grid) * 256, rnd.randrange(4) * 128
+        radius = rnd.choice((32, 64, 96))
+        if base_sides == 4 and rnd.random() < 0.8:
+            # Most boxes are axis aligned, with the corners on the grid
+            radius, rotation = radius * math.sqrt(2), math.pi / 4
+        else:
+            rotation = rnd.random()
+        faces = prism_faces(x, y, z, radius, rnd.choice((16, 64, 128)), base_sides, rotation)
+        lines = [f'{indent}solid', f'{indent}{{', f'{indent}\t"id" "{new_id()}"']
+        for face, normal in faces:
+            uaxis, vaxis = texture_axes(normal, rnd)
+            smoothing_groups = rnd.choice((1, 2, 3, 4)) if rnd.random() < smoothing else 0
+            plane = ' '.join(f'({px:g} {py:g} {pz:g})' for px, py, pz in face[:3])
+            lines += [f'{indent}\tside', f'{indent}\t{{', f'{indent}\t\t"id" "{new_id()}"', f'{indent}\t\t"plane" "{plane}"',
+                      f'{indent}\t\tvertices_plus', f'{indent}\t\t{{']
+            lines += [f'{indent}\t\t\t"v" "{px:g} {py:g} {pz:g}"' for px, py, pz in face]
+            lines += [f'{indent}\t\t}}', f'{indent}\t\t"material" "{rnd.choice(material_names)}"',
+                      f'{indent}\t\t"uaxis" "{uaxis}"', f'{indent}\t\t"vaxis" "{vaxis}"', f'{indent}\t\t"rotation" "0"',
+                      f'{indent}\t\t"lightmapscale" "16"', f'{indent}\t\t"smoothing_groups" "{smoothing_groups}"', f'{indent}\t}}']
+        lines += [f'{indent}\teditor', f'{indent}\t{{', f'{indent}\t\t"color" "0 180 0"',
+                  f'{indent}\t\t"visgroupshown" "1"', f'{indent}\t\t"visgroupautoshown" "1"', f'{indent}\t}}', f'{indent}}}']
+        return lines
+
+    detail_count = solid_count // 20
+    hidden_count = solid_count // 100
+    world_count = solid_count - detail_count - hidden_count
+
+    os.makedirs(os.path.dirname(os.path.abspath(vmf_path)), exist_ok=True)
+    with open(vmf_path, 'w', buffering=1 << 20) as f:
+        f.write('versioninfo\n{\n\t"editorversion" "400"\n\t"editorbuild" "8864"\n\t"mapversion" "1"\n\t"formatversion" "100"\n\t"prefab" "0"\n}\n')
+        f.write('visgroups\n{\n}\nviewsettings\n{\n\t"bSnapToGrid" "1"\n}\n')
+        f.write(f'world\n{{\n\t"id" "1"\n\t"mapversion" "1"\n\t"classname" "worldspawn"\n\t"skyname" "sky_day01_01"\n')
+        for i in range(world_count):
+            f.write('\n'.join(solid('\t')) + '\n')
+        if hidden_count:
+            f.write('\thidden\n\t{\n')
+            for i in range(hidden_count):
+                f.write('\n'.join(solid('\t\t')) + '\n')
+            f.write('\t}\n')
+        f.write('}\n')
+
+        for start in range(0, detail_count, 50):
+            f.write(f'entity\n{{\n\t"id" "{new_id()}"\n\t"classname" "func_detail"\n')
+            for i in range(start, min(start + 50, detail_count)):
+                f.write('\n'.join(solid('\t')) + '\n')
+            f.write('}\n')
+
+        f.write(f'entity\n{{\n\t"id" "{new_id()}"\n\t"classname" "info_player_start"\n\t"origin" "0 0 0"\n}}\n')
+        f.write('cameras\n{\n\t"activecamera" "-1"\n}\ncordons\n{\n\t"active" "0"\n}\n')
+
+# Function for generating the fake game folder with a map of `solid_count` solids, returns the VMF path.
+# A map that already exists is reused, generation of the big sizes takes a while.
+def generate_game(root, solid_count, sides_per_solid=6, material_count=8, smoothing=0.25, seed=1):
+    game_dir = os.path.join(root, 'game')
+    os.makedirs(os.path.join(game_dir, 'mapsrc'), exist_ok=True)
+    with open(os.path.join(game_dir, 'gameinfo.txt'), 'w') as f:
+        f.write(GAMEINFO)
+    materials = bench_materials(material_count)
+    write_materials(game_dir, materials)
+
+    vmf_path = os.path.join(game_dir, 'mapsrc', f'bench_{solid_count}_{sides_per_solid}_{material_count}_{smoothing:g}_{seed}.vmf')
+    if not os.path.exists(vmf_path):
+        generate_vmf(vmf_path + '.tmp', solid_count, sides_per_solid, materials, smoothing, seed)
+        os.replace(vmf_path + '.tmp', vmf_path)
+    return vmf_path
+
+# Function for converting one map in this process and printing its run statistics as JSON (child process side)
+def run_single(vmf_path, options):
+    sys.path.insert(0, SCRIPT_DIR)
+    import vmf_to_obj_solids_mats as converter
+
+    work_dir = os.path.dirname(vmf_path)
+    converter.set_log_level(converter.LOG_QUIET)
+    converter.set_log_file(os.path.join(work_dir, 'bench_log.txt'), to_console=False)
+
+    # Cold material lookups with a private disk cache, the shared one next to the script is left alone
+    cache_path = os.path.join(work_dir, 'bench_cache.sqlite')
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(cache_path + suffix):
+            os.remove(cache_path + suffix)
+
+    converter.convert_vmf_file(vmf_path, converter.ConvertOptions(jobs=options['map_jobs'], material_cache_path=cache_path), options['stream'])
+    converter.close_log()
+    print(json.dumps(converter.RUN_STATS.report()))
+
+# Function for converting one map in a fresh process, returns its run statistics
+def run_size(vmf_path, options):
+    command = [sys.executable, os.path.abspath(__file__), '--single', vmf_path, '--map-jobs', str(options['map_jobs'])]
+    if options['stream']:
+        command.append('--stream')
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+# Function for the result of one size: best of the repeats for times, the highest peak memory
+def summarize(reports):
+    best = min(reports, key=lambda report: report['wall_seconds'])
+    sides = best['counters'].get('sides', 0)
+    return {
+        'solids': best['counters'].get('solids', 0),
+        'sides': sides,
+        'wall_seconds': best['wall_seconds'],
+        'sides_per_second': sides / best['wall_seconds'] if best['wall_seconds'] else 0.0,
+        'peak_rss_bytes': max(report['process_peak_rss_bytes'] or 0 for report in reports) or None,
+        'stages': {name: min(report['stages'][name]['seconds'] for report in reports) for name in best['stages']},
+    }
+
+def print_results(results):
+    stage_names = []
+    for result in results.values():
+        stage_names += [name for name in result['stages'] if name not in stage_names]
+
+    print(f"{'solids':>8} {'sides':>9} {'wall s':>8} {'sides/s':>10} {'peak MB':>8}  " + ' '.join(f'{name:>9}' for name in stage_names))
+    for result in results.values():
+        peak = f"{result['peak_rss_bytes'] / (1 << 20):8.1f}" if result['peak_rss_bytes'] else f"{'-':>8}"
+        stages = ' '.join(f"{result['stages'][name]:9.3f}" if name in result['stages'] else f"{'-':>9}" for name in stage_names)
+        print(f"{result['solids']:>8} {result['sides']:>9} {result['wall_seconds']:8.2f} {result['sides_per_second']:10.0f} {peak}  {stages}")
+
+# Function for comparing results with a baseline, returns the list of regressions past the threshold
+def find_regressions(results, baseline, threshold):
+    regressions = []
+    for size, result in results.items():
+        base = baseline.get(size)
+        if base is None:
+            continue
+        if result['sides_per_second'] < base['sides_per_second'] * (1 - threshold):
+            regressions.append(f"{size} solids: {result['sides_per_second']:.0f} sides/s, baseline {base['sides_per_second']:.0f}")
+        if result['peak_rss_bytes'] and base.get('peak_rss_bytes') and result['peak_rss_bytes'] > base['peak_rss_bytes'] * (1 + threshold):
+            regressions.append(f"{size} solids: peak {result['peak_rss_bytes'] >> 20} MB, baseline {base['peak_rss_bytes'] >> 20} MB")
+        for name, seconds in base['stages'].items():
+            if seconds >= MIN_CHECKED_STAGE_SECONDS and result['stages'].get(name, 0.0) > seconds * (1 + threshold):
+                regressions.append(f"{size} solids: stage {name} {result['stages'][name]:.3f}s, baseline {seconds:.3f}s")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark vmf_to_obj_solids_mats.py on synthetic maps.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="solid counts (default 1000 10000 100000)")
+    parser.add_argument('--sides', type=int, default=6, help="sides per solid, at least 5 (default 6)")
+    parser.add_argument('--materials', type=int, default=8, help="number of materials (default 8)")
+    parser.add_argument('--smoothing', type=float, default=0.25, help="part of the sides with smoothing groups (default 0.25)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1, help="runs per size, the fastest is reported (default 1)")
+    parser.add_argument('--map-jobs', type=int, default=1)
+    parser.add_argument('--stream', action='store_true', help="benchmark the streaming mode")
+    parser.add_argument('--work-dir', help="folder for the generated maps, kept between runs (default: a temporary folder)")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--save-baseline', help="write the results as a baseline to this file")
+    parser.add_argument('--baseline', help="compare with this baseline and fail on regressions")
+    parser.add_argument('--threshold', type=float, default=0.2, help="allowed regression against the baseline (default 0.2 = 20%%)")
+    parser.add_argument('--single', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    options = {'map_jobs': args.map_jobs, 'stream': args.stream}
+    if args.single:
+        run_single(args.single, options)
+        return 0
+
+    # The temporary folder is removed after the run, a --work-dir folder is kept
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='vmf_to_obj_bench_')
+    results = {}
+    try:
+        for size in args.sizes:
+            vmf_path = generate_game(work_dir, size, args.sides, args.materials, args.smoothing, args.seed)
+            print(f"{size} solids: {os.path.getsize(vmf_path) >> 20} MB VMF, converting...", flush=True)
+            results[str(size)] = summarize([run_size(vmf_path, options) for i in range(args.repeat)])
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_results(results)
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print(f"No regressions past {args.threshold:.0%} against {args.baseline}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
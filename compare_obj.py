@@ -0,0 +1,469 @@
+import os
+import sys
+import json
+import struct
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+#
+# Semantic OBJ comparison and golden-output check for vmf_to_obj_solids_mats.py.
+#
+# Usage:
+#   python compare_obj.py a.obj b.obj [--tolerance 1e-4]    # compare two OBJs
+#   python compare_obj.py --golden                           # convert the corpus in golden/ and compare with the expected OBJs
+#   python compare_obj.py --golden --update                  # replace the expected OBJs with the current output
+#   python compare_obj.py a.obj b.glb                        # compare an OBJ with a GLB written by the converter
+#
+# Two OBJs are equal when every material has the same polygons: same positions, UVs and normals at the corners
+# (within the tolerance), same winding. Order of elements and faces, duplicate v/vt/vn lines, the way
+# indices share elements, groups and smoothing lines don't matter. Faces are compared as a multiset.
+#
+# A GLB is first checked structurally (header, chunks, buffer views and accessors in bounds, indices in the range of
+# their primitive, POSITION min/max equal to the data, unit normals), then its triangles are compared with the OBJ
+# polygons triangulated the same way the converter does it (fan from the first corner).
+#
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+GOLDEN_DIR = os.path.join(SCRIPT_DIR, 'golden')
+
+# Conversion modes checked against the corpus: name -> (extra arguments of the converter, folder of the expected OBJs).
+# The streaming mode doesn't smooth normals, it is checked against the flat expected OBJs.
+GOLDEN_MODES = {
+    'default': ([], 'expected'),
+    'flat': (['--no-smooth'], 'expected_flat'),
+    'stream': (['--stream'], 'expected_flat'),
+    'incremental': (['--incremental'], 'expected'),
+    'cull': (['--cull-hidden'], 'expected_cull'),
+    'merge': (['--cull-hidden', '--merge-faces'], 'expected_merge'),
+    'select': (['--select-box', '0', '0', '0', '1024', '1024', '1024'], 'expected_select'),
+    'glb': (['--format', 'glb'], 'expected'),
+}
+# Modes whose output is written by --update
+GOLDEN_UPDATE_MODES = ('default', 'flat', 'cull', 'merge', 'select')
+
+GLB_MAGIC = b'glTF'
+GLB_JSON_CHUNK = 0x4E4F534A
+GLB_BIN_CHUNK = 0x004E4942
+# glTF component types and element types: numpy dtype and number of components
+GLTF_COMPONENT_TYPES = {5120: np.int8, 5121: np.uint8, 5122: np.int16, 5123: np.uint16, 5125: np.uint32, 5126: np.float32}
+GLTF_ELEMENT_SIZES = {'SCALAR': 1, 'VEC2': 2, 'VEC3': 3, 'VEC4': 4, 'MAT2': 4, 'MAT3': 9, 'MAT4': 16}
+
+# Loaded OBJ: element arrays and polygons as corner index arrays (0-based, -1 if the corner has no UV/normal)
+class ObjData:
+    def __init__(self, positions, uvs, normals, face_offsets, corners, face_materials, materials):
+        self.positions = positions          # P x 3
+        self.uvs = uvs                      # T x 2
+        self.normals = normals              # N x 3
+        self.face_offsets = face_offsets    # F + 1
+        self.corners = corners              # C x 3 (position, uv, normal)
+        self.face_materials = face_materials
+        self.materials = materials
+
+    @property
+    def face_count(self):
+        return len(self.face_offsets) - 1
+
+    def __repr__(self):
+        return (f'ObjData({len(self.positions)} v, {len(self.uvs)} vt, {len(self.normals)} vn, '
+                f'{self.face_count} faces, {len(self.materials)} materials)')
+
+# Function for parsing the numbers of element lines ("v x y z") into an array of `width` columns
+def parse_element_lines(lines, width):
+    if not lines:
+        return np.zeros((0, width))
+    values = np.array(b' '.join(lines).split(), dtype=bytes).astype(np.float64)
+    if len(values) == len(lines) * (width + 1):    # optional w component
+        return values.reshape(-1, width + 1)[:, :width]
+    return values.reshape(len(lines), width)
+
+# Function for parsing face corners into a C x 3 array of 1-based indices, 0 for missing parts.
+# Files with one corner format are parsed in bulk, mixed formats corner by corner.
+def parse_corners(text, corner_count):
+    corners = np.zeros((corner_count, 3), dtype=np.int64)
+    if not corner_count:
+        return corners
+    
+    first = text.split(None, 1)[0]
+    columns = [0, 2] if b'//' in first else list(range(first.count(b'/') + 1))
+    values = text.replace(b'//', b' ').replace(b'/', b' ').split()
+    if len(values) == corner_count * len(columns) and text.count(b'/') == corner_count * first.count(b'/'):
+        corners[:, columns] = np.array(values, dtype=bytes).astype(np.int64).reshape(corner_count, len(columns))
+        return corners
+    
+    parts = [token.split(b'/') for token in text.split()]
+    for column in range(3):
+        corners[:, column] = [int(part[column]) if len(part) > column and part[column] else 0 for part in parts]
+    return corners
+
+def load_obj(path):
+    with open(path, 'rb') as f:
+        lines = f.read().split(b'\n')
+
+    v_lines, vt_lines, vn_lines, f_lines = [], [], [], []
+    face_materials = []
+    material_ids = {}
+    material = material_ids.setdefault('', 0)
+    for line in lines:
+        prefix = line[:2]
+        if prefix == b'v ':
+            v_lines.append(line[2:])
+        elif prefix == b'vt':
+            vt_lines.append(line[3:])
+        elif prefix == b'vn':
+            vn_lines.append(line[3:])
+        elif prefix == b'f ':
+            f_lines.append(line[2:].strip())
+            face_materials.append(material)
+        elif line.startswith(b'usemtl'):
+            material = material_ids.setdefault(line[6:].strip().decode('utf-8', 'replace'), len(material_ids))
+
+    positions = parse_element_lines(v_lines, 3)
+    uvs = parse_element_lines(vt_lines, 2)
+    normals = parse_element_lines(vn_lines, 3)
+
+    # Corners: "v", "v/vt", "v//vn" or "v/vt/vn", missing parts become 0 before the shift to 0-based
+    sizes = np.array([len(line.split()) for line in f_lines], dtype=np.int64)
+    face_offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=face_offsets[1:])
+    corners = parse_corners(b' '.join(f_lines), int(face_offsets[-1]))
+    if (corners < 0).any():
+        raise ValueError(f"{path}: relative (negative) indices are not supported")
+    corners -= 1
+
+    return ObjData(positions, uvs, normals, face_offsets, corners, np.array(face_materials, dtype=np.int64), list(material_ids))
+
+# Function for clustering the rows of two arrays together, rows closer than the tolerance get the same label.
+# Returns (labels of a, labels of b, value of every label).
+def cluster_rows(a, b, tolerance):
+    from vmf_to_obj_solids_mats import weld_positions
+
+    rows = np.concatenate((a, b))
+    if rows.shape[1] < 3:
+        rows = np.column_stack((rows, np.zeros((len(rows), 3 - rows.shape[1]))))
+    values, labels = weld_positions(rows, tolerance)
+    return labels[:len(a)], labels[len(a):], values[:, :a.shape[1]]
+
+# Function for the corners of every face as tuples of clustered (position, uv, normal) labels, -1 for missing parts
+def corner_labels(obj, position_labels, uv_labels, normal_labels):
+    columns = []
+    for column, labels in enumerate((position_labels, uv_labels, normal_labels)):
+        indices = obj.corners[:, column]
+        columns.append(np.where(indices >= 0, labels[np.maximum(indices, 0)] if len(labels) else -1, -1))
+    return np.column_stack(columns)
+
+# Function for rotating every polygon so that it starts at its smallest corner, keeping the winding
+def canonical_faces(face_offsets, corner_ids):
+    sizes = np.diff(face_offsets)
+    face_count = len(sizes)
+    if not face_count:
+        return corner_ids
+    face_of_corner = np.repeat(np.arange(face_count), sizes)
+    smallest = np.minimum.reduceat(corner_ids, face_offsets[:-1])
+    is_smallest = corner_ids == smallest[face_of_corner]
+    smallest_corners = np.flatnonzero(is_smallest)
+    starts = smallest_corners[np.unique(face_of_corner[smallest_corners], return_index=True)[1]] - face_offsets[:-1]
+    position_in_face = np.arange(len(corner_ids)) - face_offsets[:-1][face_of_corner]
+    rotated = face_offsets[:-1][face_of_corner] + (position_in_face + starts[face_of_corner]) % sizes[face_of_corner]
+    return corner_ids[rotated]
+
+# Function for counting the polygons of every size as unique rows (material, corner ids...)
+def face_table(obj, material_map, corner_ids):
+    corner_ids = canonical_faces(obj.face_offsets, corner_ids)
+    sizes = np.diff(obj.face_offsets)
+    materials = material_map[obj.face_materials] if len(obj.face_materials) else obj.face_materials
+    table = {}
+    for size in np.unique(sizes).tolist():
+        faces = np.flatnonzero(sizes == size)
+        rows = np.column_stack((materials[faces], corner_ids[obj.face_offsets[faces][:, None] + np.arange(size)]))
+        table[size] = np.unique(rows, axis=0, return_counts=True)
+    return table
+
+# Function for the difference of two face tables: list of (size, rows only in a, rows only in b)
+def table_difference(table_a, table_b):
+    differences = []
+    for size in sorted(set(table_a) | set(table_b)):
+        empty = (np.zeros((0, size + 1), dtype=np.int64), np.zeros(0, dtype=np.int64))
+        rows_a, counts_a = table_a.get(size, empty)
+        rows_b, counts_b = table_b.get(size, empty)
+        rows = np.concatenate((rows_a, rows_b))
+        unique_rows, inverse = np.unique(rows, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        balance = np.zeros(len(unique_rows), dtype=np.int64)
+        np.add.at(balance, inverse[:len(rows_a)], counts_a)
+        np.subtract.at(balance, inverse[len(rows_a):], counts_b)
+        if balance.any():
+            differences.append((size, unique_rows[balance > 0], unique_rows[balance < 0]))
+    return differences
+
+# Function for comparing two loaded OBJs, returns a list of messages describing the differences (empty if equal)
+def compare_objs(a, b, tolerance=1e-4):
+    materials = list(dict.fromkeys(a.materials + b.materials))
+    material_map_a = np.array([materials.index(name) for name in a.materials], dtype=np.int64)
+    material_map_b = np.array([materials.index(name) for name in b.materials], dtype=np.int64)
+
+    labels = [cluster_rows(values_a, values_b, tolerance)
+              for values_a, values_b in ((a.positions, b.positions), (a.uvs, b.uvs), (a.normals, b.normals))]
+    corners_a = corner_labels(a, *(label[0] for label in labels))
+    corners_b = corner_labels(b, *(label[1] for label in labels))
+
+    # One id for every distinct corner of both files
+    unique_corners, corner_ids = np.unique(np.concatenate((corners_a, corners_b)), axis=0, return_inverse=True)
+    corner_ids = corner_ids.reshape(-1)
+    table_a = face_table(a, material_map_a, corner_ids[:len(corners_a)])
+    table_b = face_table(b, material_map_b, corner_ids[len(corners_a):])
+
+    # Faces in the messages are shown by the positions and UVs of their corners
+    def describe(row):
+        parts = []
+        for position, uv, normal in unique_corners[row[1:]]:
+            text = ' '.join(f'{x:g}' for x in labels[0][2][position]) if position >= 0 else '?'
+            if uv >= 0:
+                text += ' / ' + ' '.join(f'{x:g}' for x in labels[1][2][uv])
+            parts.append(f'({text})')
+        return f'{materials[row[0]]}: ' + ' '.join(parts)
+
+    messages = []
+    if a.face_count != b.face_count:
+        messages.append(f'face count {a.face_count} != {b.face_count}')
+    for size, only_a, only_b in table_difference(table_a, table_b):
+        messages.append(f'{size}-gons: {len(only_a)} only in the first, {len(only_b)} only in the second')
+        for row in only_a[:3]:
+            messages.append(f'  first only  {describe(row)}')
+        for row in only_b[:3]:
+            messages.append(f'  second only {describe(row)}')
+    return messages
+
+# Function for reading the data of an accessor as a count x components array, errors are appended to the list
+def read_accessor(gltf, binary, index, errors):
+    accessor = gltf['accessors'][index]
+    dtype = np.dtype(GLTF_COMPONENT_TYPES.get(accessor.get('componentType'), np.float32)).newbyteorder('<')
+    components = GLTF_ELEMENT_SIZES.get(accessor.get('type'), 1)
+    count = accessor.get('count', 0)
+    element_size = dtype.itemsize * components
+    if accessor.get('componentType') not in GLTF_COMPONENT_TYPES or accessor.get('type') not in GLTF_ELEMENT_SIZES:
+        errors.append(f"accessor {index}: unknown componentType/type {accessor.get('componentType')}/{accessor.get('type')}")
+    
+    view = gltf['bufferViews'][accessor['bufferView']]
+    stride = view.get('byteStride', element_size)
+    offset = accessor.get('byteOffset', 0)
+    if stride < element_size:
+        errors.append(f"accessor {index}: byteStride {stride} is smaller than the element ({element_size} bytes)")
+    if offset % dtype.itemsize:
+        errors.append(f"accessor {index}: byteOffset {offset} is not aligned to its component size")
+    if count and offset + (count - 1) * stride + element_size > view['byteLength']:
+        errors.append(f"accessor {index}: {count} elements from byte {offset} overflow buffer view {accessor['bufferView']} "
+                      f"({view['byteLength']} bytes)")
+        return np.zeros((0, components), dtype=dtype)
+    
+    start = view.get('byteOffset', 0) + offset
+    data = np.ndarray((count, components), dtype=dtype, buffer=binary, offset=start, strides=(stride, dtype.itemsize))
+    return data.copy()
+
+# Function for loading a GLB written by the converter as triangles, returns (ObjData, list of structural errors).
+# Every primitive gets its own range of positions/uvs/normals, a corner uses the same index for all three.
+def load_glb(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    
+    errors = []
+    empty = ObjData(np.zeros((0, 3)), np.zeros((0, 2)), np.zeros((0, 3)), np.zeros(1, dtype=np.int64),
+                    np.zeros((0, 3), dtype=np.int64), np.zeros(0, dtype=np.int64), [''])
+    if len(data) < 20 or data[:4] != GLB_MAGIC:
+        return empty, ['not a GLB file']
+    version, total_length = struct.unpack_from('<II', data, 4)
+    if version != 2:
+        errors.append(f'version {version} != 2')
+    if total_length != len(data):
+        errors.append(f'header length {total_length} != file size {len(data)}')
+    
+    # Chunks: JSON first, then an optional BIN, every chunk 4-byte aligned and inside the file
+    chunks = []
+    offset = 12
+    while offset + 8 <= len(data):
+        length, chunk_type = struct.unpack_from('<II', data, offset)
+        if length % 4:
+            errors.append(f'chunk {len(chunks)}: length {length} is not a multiple of 4')
+        if offset + 8 + length > len(data):
+            errors.append(f'chunk {len(chunks)}: {length} bytes overflow the file')
+        chunks.append((chunk_type, data[offset + 8:offset + 8 + length]))
+        offset += 8 + length
+    if offset != len(data):
+        errors.append(f'{len(data) - offset} bytes after the last chunk')
+    if not chunks or chunks[0][0] != GLB_JSON_CHUNK:
+        return empty, errors + ['first chunk is not JSON']
+    if len(chunks) > 1 and chunks[1][0] != GLB_BIN_CHUNK:
+        errors.append('second chunk is not BIN')
+    gltf = json.loads(chunks[0][1].decode('utf-8'))
+    binary = chunks[1][1] if len(chunks) > 1 else b''
+    
+    buffers = gltf.get('buffers', [])
+    if len(buffers) > 1:
+        errors.append(f'{len(buffers)} buffers, the converter writes one')
+    if buffers and not buffers[0]['byteLength'] <= len(binary) < buffers[0]['byteLength'] + 4:
+        errors.append(f"buffer byteLength {buffers[0]['byteLength']} doesn't match the BIN chunk ({len(binary)} bytes)")
+    for index, view in enumerate(gltf.get('bufferViews', [])):
+        if view.get('byteOffset', 0) + view['byteLength'] > (buffers[view['buffer']]['byteLength'] if buffers else 0):
+            errors.append(f'buffer view {index} overflows its buffer')
+    if errors:
+        return empty, errors
+    
+    materials = [material.get('name', '') for material in gltf.get('materials', [])]
+    positions, uvs, normals, triangles, triangle_materials = [], [], [], [], []
+    vertex_count = 0
+    for mesh in gltf.get('meshes', []):
+        for number, primitive in enumerate(mesh['primitives']):
+            name = f"{mesh.get('name', 'mesh')} primitive {number}"
+            if primitive.get('mode', 4) != 4:
+                errors.append(f"{name}: mode {primitive['mode']} is not triangles")
+            attributes = primitive['attributes']
+            if set(attributes) != {'POSITION', 'NORMAL', 'TEXCOORD_0'}:
+                errors.append(f'{name}: attributes {sorted(attributes)}')
+                continue
+            primitive_positions = read_accessor(gltf, binary, attributes['POSITION'], errors)
+            primitive_normals = read_accessor(gltf, binary, attributes['NORMAL'], errors)
+            primitive_uvs = read_accessor(gltf, binary, attributes['TEXCOORD_0'], errors)
+            indices = read_accessor(gltf, binary, primitive['indices'], errors).reshape(-1).astype(np.int64)
+            if not len(primitive_positions) == len(primitive_normals) == len(primitive_uvs):
+                errors.append(f'{name}: attribute counts {len(primitive_positions)}/{len(primitive_normals)}/{len(primitive_uvs)} differ')
+                continue
+            
+            position_accessor = gltf['accessors'][attributes['POSITION']]
+            if len(primitive_positions):
+                for key, actual in (('min', primitive_positions.min(axis=0)), ('max', primitive_positions.max(axis=0))):
+                    if key not in position_accessor or (np.float32(position_accessor[key]) != actual).any():
+                        errors.append(f'{name}: POSITION {key} {position_accessor.get(key)} != {actual.tolist()}')
+            if len(indices) % 3:
+                errors.append(f'{name}: {len(indices)} indices are not whole triangles')
+                continue
+            if len(indices) and (indices.min() < 0 or indices.max() >= len(primitive_positions)):
+                errors.append(f'{name}: indices {indices.min()}..{indices.max()} out of the {len(primitive_positions)} vertices')
+                continue
+            if not np.isfinite(primitive_positions).all() or not np.isfinite(primitive_uvs).all():
+                errors.append(f'{name}: non-finite positions or UVs')
+            lengths = np.linalg.norm(primitive_normals, axis=1)
+            if len(lengths) and np.abs(lengths - 1).max() > 1e-3:
+                errors.append(f'{name}: normals are not unit length (max error {np.abs(lengths - 1).max():g})')
+            if not 0 <= primitive.get('material', -1) < len(materials):
+                errors.append(f"{name}: material {primitive.get('material')} out of the {len(materials)} materials")
+                continue
+            
+            positions.append(primitive_positions.astype(np.float64))
+            normals.append(primitive_normals.astype(np.float64))
+            primitive_uvs = primitive_uvs.astype(np.float64)
+            primitive_uvs[:, 1] = 1 - primitive_uvs[:, 1]
+            uvs.append(primitive_uvs)
+            triangles.append(indices.reshape(-1, 3) + vertex_count)
+            triangle_materials.append(np.full(len(indices) // 3, primitive['material'], dtype=np.int64))
+            vertex_count += len(primitive_positions)
+    
+    if not triangles:
+        return ObjData(empty.positions, empty.uvs, empty.normals, empty.face_offsets, empty.corners, empty.face_materials,
+                       materials or empty.materials), errors
+    corners = np.repeat(np.concatenate(triangles).reshape(-1, 1), 3, axis=1)
+    face_materials = np.concatenate(triangle_materials)
+    return ObjData(np.concatenate(positions), np.concatenate(uvs), np.concatenate(normals),
+                   np.arange(len(face_materials) + 1, dtype=np.int64) * 3, corners, face_materials, materials), errors
+
+# Function for triangulating the polygons of an OBJ like the GLB writer: a fan from the first corner of every polygon.
+# Corners without a normal get the plane normal of their triangle, corners without a UV get (0, 0).
+def fan_triangulate(obj):
+    sizes = np.diff(obj.face_offsets)
+    triangle_counts = np.maximum(sizes - 2, 0)
+    faces = np.repeat(np.arange(obj.face_count, dtype=np.int64), triangle_counts)
+    first = obj.face_offsets[:-1][faces]
+    k = np.arange(len(faces), dtype=np.int64) - np.repeat(np.cumsum(triangle_counts) - triangle_counts, triangle_counts)
+    corners = obj.corners[np.column_stack((first, first + k + 1, first + k + 2))]
+    
+    points = obj.positions[corners[:, :, 0]]
+    plane_normals = np.cross(points[:, 1] - points[:, 0], points[:, 2] - points[:, 0])
+    plane_normals /= np.maximum(np.linalg.norm(plane_normals, axis=1), 1e-12)[:, None]
+    normals = np.concatenate((obj.normals, plane_normals))
+    corners[:, :, 2] = np.where(corners[:, :, 2] >= 0, corners[:, :, 2], len(obj.normals) + np.arange(len(corners))[:, None])
+    uvs = np.concatenate((obj.uvs, np.zeros((1, 2))))
+    corners[:, :, 1] = np.where(corners[:, :, 1] >= 0, corners[:, :, 1], len(obj.uvs))
+    
+    return ObjData(obj.positions, uvs, normals, np.arange(len(faces) + 1, dtype=np.int64) * 3, corners.reshape(-1, 3),
+                   obj.face_materials[faces], obj.materials)
+
+# Function for comparing an OBJ with a GLB, returns the structural errors of the GLB and the differences of the triangles.
+# GLB attributes are float32, the tolerance grows with the size of the values so the rounding isn't a difference.
+def compare_obj_glb(obj, glb, glb_errors, tolerance=1e-4):
+    if glb_errors:
+        return glb_errors
+    triangulated = fan_triangulate(obj)
+    largest = max([np.abs(values).max() for values in (triangulated.positions, triangulated.uvs) if values.size] + [0])
+    return compare_objs(triangulated, glb, max(tolerance, float(largest) * 4e-7))
+
+def load_any(path):
+    return load_glb(path) if path.lower().endswith('.glb') else (load_obj(path), [])
+
+def compare_files(path_a, path_b, tolerance=1e-4):
+    (a, errors_a), (b, errors_b) = load_any(path_a), load_any(path_b)
+    if path_b.lower().endswith('.glb') and not path_a.lower().endswith('.glb'):
+        return compare_obj_glb(a, b, errors_b, tolerance)
+    if path_a.lower().endswith('.glb') and not path_b.lower().endswith('.glb'):
+        return compare_obj_glb(b, a, errors_a, tolerance)
+    return errors_a + errors_b + compare_objs(a, b, tolerance)
+
+# Function for converting every map of the corpus in a copy of the corpus game folder and comparing the OBJs (or GLBs)
+# with golden/expected; with update the expected OBJs are replaced by the output of the default mode
+def check_golden(modes, tolerance, update=False):
+    import subprocess
+
+    vmf_names = sorted(name for name in os.listdir(os.path.join(GOLDEN_DIR, 'game', 'mapsrc')) if name.endswith('.vmf'))
+    failures = 0
+    for mode in modes:
+        work_dir = tempfile.mkdtemp(prefix='vmf_to_obj_golden_')
+        try:
+            game_dir = os.path.join(work_dir, 'game')
+            shutil.copytree(os.path.join(GOLDEN_DIR, 'game'), game_dir)
+            vmf_paths = [os.path.join(game_dir, 'mapsrc', name) for name in vmf_names]
+            command = [sys.executable, os.path.join(SCRIPT_DIR, 'vmf_to_obj_solids_mats.py'), '--no-pause',
+                       '--log-level', 'quiet', '--log', os.path.join(work_dir, 'log.txt')] + GOLDEN_MODES[mode][0] + vmf_paths
+            # Incremental mode is run twice, the second run takes every solid from the cache
+            for run in range(2 if mode == 'incremental' else 1):
+                subprocess.run(command, check=True, cwd=work_dir)
+
+            for name, vmf_path in zip(vmf_names, vmf_paths):
+                output_format = 'glb' if '--format' in GOLDEN_MODES[mode][0] else 'obj'
+                obj_path = os.path.splitext(vmf_path)[0] + '.' + output_format
+                expected_path = os.path.join(GOLDEN_DIR, GOLDEN_MODES[mode][1], os.path.splitext(name)[0] + '.obj')
+                if update and mode in GOLDEN_UPDATE_MODES:
+                    os.makedirs(os.path.dirname(expected_path), exist_ok=True)
+                    shutil.copyfile(obj_path, expected_path)
+                    print(f'updated  {expected_path}')
+                    continue
+                messages = compare_files(expected_path, obj_path, tolerance)
+                print(f"{'FAILED' if messages else 'ok':6}  {mode:12} {name}")
+                for message in messages:
+                    print(f'        {message}')
+                failures += bool(messages)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare OBJs semantically, or check the converter against the golden corpus.")
+    parser.add_argument('paths', nargs='*', help="two OBJ or GLB files")
+    parser.add_argument('--tolerance', type=float, default=1e-4, help="values closer than this are equal (default 1e-4)")
+    parser.add_argument('--golden', action='store_true', help="convert golden/game/mapsrc/*.vmf and compare with golden/expected")
+    parser.add_argument('--modes', nargs='+', choices=list(GOLDEN_MODES), default=list(GOLDEN_MODES), help="conversion modes to check")
+    parser.add_argument('--update', action='store_true', help="with --golden: write the current output as the expected OBJs")
+    args = parser.parse_args(argv)
+
+    if args.golden:
+        return 1 if check_golden(args.modes, args.tolerance, args.update) else 0
+
+    if len(args.paths) != 2:
+        parser.error("two OBJ or GLB files are needed")
+    a, b = load_any(args.paths[0])[0], load_any(args.paths[1])[0]
+    messages = compare_files(args.paths[0], args.paths[1], args.tolerance)
+    print(f'{a}\n{b}')
+    print('\n'.join(messages) if messages else 'EQUAL')
+    return 1 if messages else 0
+
+if __name__ == '__main__':
+    sys.path.insert(0, SCRIPT_DIR)
+    sys.exit(main())
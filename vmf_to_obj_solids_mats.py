@@ -1,12 +1,32 @@
 import re
 import os
+import io
 import sys
+import mmap
 import shutil
-from collections import defaultdict
-import numpy as np
-from numpy.linalg import lstsq
+import tempfile
+import time
+import sqlite3
+import hashlib
+import struct
+import json
+import contextlib
+from collections import namedtuple
 from typing import Optional
 
+# Module imported on first use, keeps importing the script (as a library or in worker processes) cheap
+class _LazyModule:
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+    
+    def __getattr__(self, attr):
+        import importlib
+        module = importlib.import_module(self._name)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+np = _LazyModule('numpy')
+
 #
 # Unfinished shitty VMF to OBJ converter script. Converts only solid (brush) geometry;
 # Objects in OBJ are grouped by materials.
@@ -15,18 +35,21 @@ from typing import Optional
 # You will get the OBJ files in the same folder where the VMFs are located.
 #
 # Features:
-# - geometry;
+# - geometry, including func_instance VMFs (nested, each instance file converted once);
 # - UV for default texture resolution;
 # - UV for different texels (only if VTF founded);
 # - materials names;
 # - meshes are grouped by materials (optional);
-# - vertex normals from sides (no smoothing yet);
-# - optional removing geometry with NODRAW material.
+# - vertex normals from sides, averaged across faces sharing a smoothing group;
+# - optional removing geometry by material rules (names, paths, prefixes, globs like tools/*), NODRAW by default;
+# - vertices weld and removal of identical UVs and normals;
+# - optional culling of faces hidden between touching brushes (--cull-hidden): a face is removed when one opposite face contains it,
+#   faces of glass, water, tool brushes and moving brush entities neither hide faces nor get removed;
+# - optional merging of touching coplanar faces with the same material and texture axes (--merge-faces);
+# - partial conversion by box, visgroup, entity class or material through a block index cached in <map>_index.npz (--select-box, --select-visgroup, --select-class, --select-material);
+# - binary glTF (.glb) output instead of OBJ (--format glb).
 #
 # TODO:
-# - smoothing groups;
-# - optimization (removal of identical values);
-# - extra vertices weld;
 # - hierarchy and naming polishing;
 #
 
@@ -34,769 +57,3007 @@ from typing import Optional
 texel_dencity_tex = 2048    # default texture size
 texel_dencity_units = 300   # default size of an area to apply this texture size (hammer units)
 unit_scale = 0.01           # scale OBJ geometry, I need 0.01 because 100 hammer units is 1 meter for my project
+weld_epsilon = 0.000001     # vertices closer than this (OBJ units) are welded
+
+# Settings of one conversion, the global vars above are the defaults.
+# materials_to_remove are material exclusion rules (see MaterialFilter), game_dir is the folder with gameinfo.txt
+# (found next to the VMF if None), jobs is the number of worker processes for the solids of the map,
+# smooth averages the normals of faces sharing a smoothing group, cull_hidden removes faces between touching brushes,
+# merge_coplanar merges touching coplanar faces with the same material and texture mapping, material_cache_path is
+# the SQLite file keeping material metadata across runs (None keeps it in memory only, the CLI uses MATERIAL_CACHE_PATH).
+ConvertOptions = namedtuple('ConvertOptions', ['unit_scale', 'texel_dencity_tex', 'texel_dencity_units', 'materials_to_remove',
+                                               'weld', 'weld_epsilon', 'jobs', 'game_dir', 'smooth', 'cull_hidden', 'merge_coplanar',
+                                               'material_cache_path'],
+                            defaults=(unit_scale, texel_dencity_tex, texel_dencity_units, ('TOOLSNODRAW',), True, weld_epsilon, 1, None, True,
+                                      False, False, None))
 
-# Log file
-LOG_FILE = open('vmf_to_obj_log.txt', 'w', encoding='utf-8')
+# Log levels: quiet logs only warnings and errors, summary adds progress and results, debug dumps every block, side and vertex
+LOG_QUIET = 0
+LOG_SUMMARY = 1
+LOG_DEBUG = 2
+LOG_LEVEL_NAMES = {'quiet': LOG_QUIET, 'summary': LOG_SUMMARY, 'debug': LOG_DEBUG}
+LOG_LEVEL = LOG_SUMMARY
 
-# Func to log and print something
-def log_and_print(data):
-    print(data)
+# Log file, opened on first use. The log is off until set_log_file is called (the CLI does it),
+# so importing the script or calling convert doesn't print or write anything.
+DEFAULT_LOG_FILE = 'vmf_to_obj_log.txt'
+LOG_FILE_PATH = None
+LOG_FILE = None
+LOG_FILE_BUFFER = 1 << 20
+LOG_TO_CONSOLE = False
+LOG_CONSOLE_LINES = []      # console output waiting to be printed
+LOG_CONSOLE_BATCH = 1000    # debug lines are printed in batches of this many lines
+LOG_CAPTURE = None          # list collecting the log instead of printing/writing it (worker processes)
+
+# Func to log and print something, if the log level is at least `level`.
+# Callers building big debug messages should check LOG_LEVEL >= LOG_DEBUG first.
+def log_and_print(data, level=LOG_SUMMARY):
+    global LOG_FILE
+    if level > LOG_LEVEL:
+        return
+    if LOG_CAPTURE is not None:
+        LOG_CAPTURE.append((data, level))
+        return
+    if LOG_TO_CONSOLE:
+        LOG_CONSOLE_LINES.append(data)
+        if level < LOG_DEBUG or len(LOG_CONSOLE_LINES) >= LOG_CONSOLE_BATCH:
+            flush_console()
+    if LOG_FILE_PATH is None:
+        return
+    if LOG_FILE is None:
+        LOG_FILE = open(LOG_FILE_PATH, 'w', encoding='utf-8', buffering=LOG_FILE_BUFFER)
     LOG_FILE.write(data + '\n')
 
-# Function for counting braces
-def find_brace_indices(content, start_index):
-    open_brace_count = 0
-    close_brace_count = 0
-    open_brace_index = -1
-    close_brace_index = -1
-
-    for i in range(start_index, len(content)):
-        if content[i] == '{':
-            if open_brace_index == -1:
-                open_brace_index = i
-            open_brace_count += 1
-        elif content[i] == '}':
-            close_brace_count += 1
-            if open_brace_count == close_brace_count:
-                close_brace_index = i
-                break
+def flush_console():
+    if LOG_CONSOLE_LINES:
+        sys.stdout.write('\n'.join(LOG_CONSOLE_LINES) + '\n')
+        sys.stdout.flush()
+        LOG_CONSOLE_LINES.clear()
+
+# Function for setting the log level, also used as the initializer of worker processes
+def set_log_level(level):
+    global LOG_LEVEL
+    LOG_LEVEL = level
+
+# Function for switching the log to another file, None for no file (and optionally muting the console)
+def set_log_file(log_file_path, to_console=True):
+    global LOG_FILE_PATH, LOG_TO_CONSOLE
+    close_log()
+    LOG_FILE_PATH = log_file_path
+    LOG_TO_CONSOLE = to_console
+
+def close_log():
+    global LOG_FILE
+    flush_console()
+    if LOG_FILE is not None:
+        LOG_FILE.close()
+        LOG_FILE = None
+
+def flush_log():
+    flush_console()
+    if LOG_FILE is not None:
+        LOG_FILE.flush()
+
+# Functions for collecting the log in memory, used by worker processes to send their log back
+def start_log_capture():
+    global LOG_CAPTURE
+    LOG_CAPTURE = []
+
+def stop_log_capture():
+    global LOG_CAPTURE
+    captured, LOG_CAPTURE = LOG_CAPTURE, None
+    return captured or []
+
+# Run statistics: wall time and calls of every pipeline stage, item counters and memory use of the current map.
+# Stages and counters of worker processes are not collected, their time is part of the stage that waits for them.
+REPORT_VERSION = 2
 
-    return open_brace_index, close_brace_index
+# Function for the peak resident memory of this process in bytes, None where the platform doesn't tell
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
 
-# Function for extracting content within braces
-def extract_block_content(content, start_index):
-    open_brace_index, close_brace_index = find_brace_indices(content, start_index)
-    if open_brace_index == -1 or close_brace_index == -1:
+# Function for the current resident memory of this process in bytes, from /proc or psutil; None where neither is available
+def current_rss_bytes():
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
         return None
-    return content[open_brace_index + 1:close_brace_index].strip()
+    return psutil.Process().memory_info().rss
+
+class RunStats:
+    def __init__(self, trace_memory=False):
+        self.start_time = time.perf_counter()
+        self.stages = {}        # name -> {'seconds', 'calls', 'rss_bytes', 'traced_peak_bytes'}
+        self.counters = {}
+        self.trace_memory = trace_memory
+        self.open_stages = []
+        if trace_memory:
+            import tracemalloc
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+        if self.trace_memory:
+            self._fold_traced_peak()
+            stage.setdefault('traced_peak_bytes', 0)
+        self.open_stages.append(stage)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage['seconds'] += time.perf_counter() - start
+            stage['calls'] += 1
+            # The process peak of getrusage only grows, so the stage gets the highest current RSS at its ends
+            rss = current_rss_bytes()
+            if rss is not None:
+                stage['rss_bytes'] = max(stage.get('rss_bytes', 0), rss)
+            if self.trace_memory:
+                self._fold_traced_peak()
+            self.open_stages.pop()
+
+    # Function for adding the traced peak since the last call to all open stages, nested stages don't hide peaks of outer ones
+    def _fold_traced_peak(self):
+        import tracemalloc
+        peak = tracemalloc.get_traced_memory()[1]
+        for stage in self.open_stages:
+            stage['traced_peak_bytes'] = max(stage['traced_peak_bytes'], peak)
+        tracemalloc.reset_peak()
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def stop(self):
+        if self.trace_memory:
+            import tracemalloc
+            tracemalloc.stop()
+            self.trace_memory = False
+
+    def report(self, **info):
+        return dict(info, version=REPORT_VERSION, wall_seconds=time.perf_counter() - self.start_time,
+                    stages=self.stages, counters=self.counters, process_peak_rss_bytes=peak_rss_bytes())
+
+    def log_summary(self):
+        log_and_print('Stages: ' + ', '.join(f"{name} {stage['seconds']:.2f}s" for name, stage in self.stages.items()))
+
+# Statistics of the map being converted, replaced for every map by convert_vmf_file and convert
+RUN_STATS = RunStats()
+
+def run_stage(name):
+    return RUN_STATS.stage(name)
+
+def run_count(name, n=1):
+    RUN_STATS.count(name, n)
+
+# KeyValues tokens: "key" "value" pair, quoted string, brace, comment, [$CONDITIONAL], bare word
+_KV_TOKEN_RE = re.compile(r'"([^"]*)"[ \t]+"([^"]*)"|"([^"]*)"|([{}])|//[^\n]*|\[\$[^\]\n]*\]|([^\s{}"]+)')
+
+# Node of the parsed VMF/KeyValues tree (world -> solid -> side -> key/values)
+class VMFNode:
+    __slots__ = ('name', 'keyvalues', 'children', 'span', 'owner')
+
+    def __init__(self, name):
+        self.name = name
+        self.keyvalues = []     # ordered (key, value) pairs, keys may repeat
+        self.children = []      # nested blocks in file order
+        self.span = None        # (start, end) of the block from '{' to '}' in the parsed text
+        self.owner = None       # classname of the entity of a solid (worldspawn for world solids), set when solids are extracted
+
+    def get(self, key, default=None):
+        for k, v in self.keyvalues:
+            if k == key:
+                return v
+        return default
+
+    def get_all(self, key):
+        return [v for k, v in self.keyvalues if k == key]
+
+    def iter_children(self, name):
+        return (child for child in self.children if child.name == name)
+
+    def __repr__(self):
+        return f'VMFNode({self.name!r}, {len(self.keyvalues)} keys, {len(self.children)} children)'
+
+# Function for parsing KeyValues text into a tree in a single linear pass
+def parse_keyvalues(content):
+    root = VMFNode('')
+    stack = [root]
+    node = root
+    pending_key = None
+
+    for m in _KV_TOKEN_RE.finditer(content):
+        kind = m.lastindex
+        if kind == 2:
+            node.keyvalues.append((m.group(1), m.group(2)))
+        elif kind == 4:
+            if m.group(4) == '{':
+                child = VMFNode(pending_key or '')
+                child.span = m.start()
+                node.children.append(child)
+                stack.append(child)
+                node = child
+            elif len(stack) > 1:
+                node.span = (node.span, m.end())
+                stack.pop()
+                node = stack[-1]
+            pending_key = None
+        elif kind is not None:
+            token = m.group(kind)
+            if pending_key is None:
+                pending_key = token
+            else:
+                node.keyvalues.append((pending_key, token))
+                pending_key = None
+
+    # Blocks left open at the end of the text span to its end
+    for node in stack[1:]:
+        node.span = (node.span, len(content))
+
+    return root
+
+_KV_TOKEN_RE_BYTES = re.compile(_KV_TOKEN_RE.pattern.encode())
+
+# Function for reading the solids of a VMF one by one, in the same order as extract_solids_from_vmf.
+# The file is memory-mapped and tokenized in one pass; only the solid being read is kept as a tree.
+# Spans of the nodes are byte offsets in the file. If instances is a list, the func_instance entities
+# (keyvalues only) are appended to it.
+def iter_vmf_solids(vmf_path, instances=None):
+    with open(vmf_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            block_names = []    # blocks enclosing the current position, outside of solids
+            stack = None        # nodes of the solid being read
+            pending_key = None
+            entity = None       # keyvalues of the entity being read if instances are collected
+            
+            for m in _KV_TOKEN_RE_BYTES.finditer(content):
+                kind = m.lastindex
+                if kind is None:
+                    continue
+                
+                if stack is None:
+                    # Outside of solids only the block structure is followed
+                    if kind == 4:
+                        if m.group(4) == b'{':
+                            name = pending_key.decode('utf-8', 'replace') if pending_key is not None else ''
+                            owners = [block_name for block_name in block_names if block_name != 'hidden']
+                            if name == 'solid' and owners in (['world'], ['entity']):
+                                stack = [VMFNode(name)]
+                                stack[0].span = m.start()
+                            else:
+                                if name == 'entity' and not owners and instances is not None:
+                                    entity = VMFNode(name)
+                                block_names.append(name)
+                        elif block_names:
+                            if block_names.pop() == 'entity' and entity is not None:
+                                if entity.get('classname') == 'func_instance':
+                                    instances.append(entity)
+                                entity = None
+                        pending_key = None
+                    elif kind == 2:
+                        if entity is not None and block_names[-1] == 'entity':
+                            entity.keyvalues.append((m.group(1).decode('utf-8', 'replace'), m.group(2).decode('utf-8', 'replace')))
+                        pending_key = None
+                    else:
+                        pending_key = m.group(kind) if pending_key is None else None
+                    continue
+                
+                node = stack[-1]
+                if kind == 2:
+                    node.keyvalues.append((m.group(1).decode('utf-8', 'replace'), m.group(2).decode('utf-8', 'replace')))
+                elif kind == 4:
+                    if m.group(4) == b'{':
+                        child = VMFNode(pending_key.decode('utf-8', 'replace') if pending_key is not None else '')
+                        child.span = m.start()
+                        node.children.append(child)
+                        stack.append(child)
+                    else:
+                        node.span = (node.span, m.end())
+                        stack.pop()
+                        if not stack:
+                            yield node
+                            stack = None
+                    pending_key = None
+                else:
+                    token = m.group(kind)
+                    if pending_key is None:
+                        pending_key = token
+                    else:
+                        node.keyvalues.append((pending_key.decode('utf-8', 'replace'), token.decode('utf-8', 'replace')))
+                        pending_key = None
 
 # Function for checking the amount of blocks and their IDs
 def check_blocks_info(blocks, name, parent_name):
-    blocks_counter=0
-    for item in blocks:
-        blocks_counter+=1
-    log_and_print(f'{blocks_counter} {name} blocks in {parent_name}:')
+    if LOG_LEVEL < LOG_DEBUG:
+        return
+    
+    log_and_print(f'{len(blocks)} {name} blocks in {parent_name}:', LOG_DEBUG)
     
-    block_id = re.compile(r'"id"\s+"([^"]+)"', re.DOTALL)
     for item in blocks:
-        #log_and_print(item)        # full content output of solid blocks
-        #log_and_print("-" * 50)    # divider for convenience
-        
-        block_id_match = block_id.match(item)
-        if block_id_match:
-            log_and_print(block_id_match.group(0))
+        block_id = item.get('id')
+        if block_id is not None:
+            log_and_print(f'"id" "{block_id}"', LOG_DEBUG)
             
-    log_and_print("")
-    
-# Function for extracting solid blocks from VMF
-def extract_solids_from_vmf(vmf_content):
-    solid_start_indices = [m.start() for m in re.finditer(r'solid\s*{\s*"id"\s*"', vmf_content)]
-    solid_blocks = [extract_block_content(vmf_content, start) for start in solid_start_indices]
+    log_and_print("", LOG_DEBUG)
+
+# Function for collecting solids of a world/entity block, including visgroup-hidden ones
+def collect_solids(block):
+    solids = []
+    for child in block.children:
+        if child.name == 'solid':
+            solids.append(child)
+        elif child.name == 'hidden':
+            solids.extend(child.iter_children('solid'))
+    return solids
+
+# Function for extracting entity blocks from parsed VMF, including visgroup-hidden ones
+def extract_entities_from_vmf(vmf_root):
+    entities = []
+    for child in vmf_root.children:
+        if child.name == 'entity':
+            entities.append(child)
+        elif child.name == 'hidden':
+            entities.extend(child.iter_children('entity'))
+    return entities
+
+# Function for extracting solid blocks from parsed VMF: world solids first, then brush entity solids
+def extract_solids_from_vmf(vmf_root):
+    solid_blocks = []
+    for world in vmf_root.iter_children('world'):
+        world_solids = collect_solids(world)
+        check_blocks_info(world_solids, "solid", "world")
+        for solid in world_solids:
+            solid.owner = 'worldspawn'
+        solid_blocks.extend(world_solids)
     
-    check_blocks_info(solid_blocks, "solid", "VMF")
-    #log_and_print("")
+    for entity in extract_entities_from_vmf(vmf_root):
+        entity_solids = collect_solids(entity)
+        if entity_solids:
+            check_blocks_info(entity_solids, "solid", f"entity {entity.get('id')} ({entity.get('classname')})")
+            for solid in entity_solids:
+                solid.owner = entity.get('classname')
+            solid_blocks.extend(entity_solids)
     
     return solid_blocks
 
 # Extract 'side' blocks from a 'solid' block
-def extract_sides_from_solid(solid_content):
-    side_start_indices = [m.start() for m in re.finditer(r'side\s*{\s*"id"\s*"', solid_content)]
-    side_blocks = [extract_block_content(solid_content, start) for start in side_start_indices]
+def extract_sides_from_solid(solid):
+    side_blocks = list(solid.iter_children('side'))
     
-    solid_parent_id_pattern = re.compile(r'"id"\s+"([^"]+)"', re.DOTALL)
-    solid_match = solid_parent_id_pattern.match(solid_content)
-    if solid_match:
-        solid_parent_id = solid_match.group(1)
-        #log_and_print(f'solid_content id: {solid_parent_id}')
-
-    check_blocks_info(side_blocks, "side", f"solid {solid_parent_id}")
+    check_blocks_info(side_blocks, "side", f"solid {solid.get('id')}")
     
     return side_blocks
 
-# Function to extract vertices from a 'side' block content
-def extract_vertices_from_side(side_content):
-    # Regular expression pattern for extracting vertices
-    vertices_re = re.compile(r'"v" "(.*?)"', re.DOTALL)
-    
-    # Extract vertices
-    vertices_matches = vertices_re.findall(side_content)
-    vertices = [tuple(map(float, v.split())) for v in vertices_matches]
+# Function to extract vertices from a 'side' block
+def extract_vertices_from_side(side):
+    vertices = [tuple(map(float, v.split()))
+                for vertices_plus in side.iter_children('vertices_plus')
+                for v in vertices_plus.get_all('v')]
     vertices.reverse()  # reverse the vertex order to have correct normals in the final mesh
     
-    log_and_print(f"Vertices:\n{vertices}\n")
+    if LOG_LEVEL >= LOG_DEBUG:
+        log_and_print(f"Vertices:\n{vertices}\n", LOG_DEBUG)
     
     return vertices
 
-# Function to extract key attributes from a 'side' block content
-def extract_side_attributes(side_content):
-    # Regular expression patterns for extracting attributes
-    plane_re = re.compile(r'"plane"\s+"([^"]+)"', re.DOTALL)
-    material_re = re.compile(r'"material"\s+".*/([^/"]+)"', re.DOTALL)
-    uaxis_re = re.compile(r'"uaxis"\s+"([^"]+)"', re.DOTALL)
-    vaxis_re = re.compile(r'"vaxis"\s+"([^"]+)"', re.DOTALL)
-    
-    # Extract attributes
-    plane_match = plane_re.search(side_content)
-    material_match = material_re.search(side_content)
-    uaxis_match = uaxis_re.search(side_content)
-    vaxis_match = vaxis_re.search(side_content)
+# Function to extract key attributes from a 'side' block
+def extract_side_attributes(side):
+    plane = side.get('plane')
+    material_path = side.get('material')
+    uaxis = side.get('uaxis')
+    vaxis = side.get('vaxis')
     
-    plane = plane_match.group(1) if plane_match else None
-    material = material_match.group(1) if material_match else None
-    uaxis = uaxis_match.group(1) if uaxis_match else None
-    vaxis = vaxis_match.group(1) if vaxis_match else None
+    # Only the material name is used, without its folder
+    material = material_path.rsplit('/', 1)[1] if material_path and '/' in material_path else None
     
-    log_and_print(f"Material:\n{material}\n")
-    log_and_print(f"UVs:\n{uaxis}\n{vaxis}\n")
+    if LOG_LEVEL >= LOG_DEBUG:
+        log_and_print(f"Material:\n{material}\n", LOG_DEBUG)
+        log_and_print(f"UVs:\n{uaxis}\n{vaxis}\n", LOG_DEBUG)
     
     return plane, material, uaxis, vaxis
     
-# Function to extract smoothing group from a 'side' block content
-def extract_smoothing_group(side_content):
-    sg_re = re.compile(r'"smoothing_groups"\s+"([^"]+)"', re.DOTALL)
+# Function to extract smoothing group from a 'side' block
+def extract_smoothing_group(side):
+    sg = side.get('smoothing_groups')
     
-    sg_match = sg_re.search(side_content)
-    
-    sg = sg_match.group(1) if sg_match else None
-    
-    log_and_print(f"smoothing_group:\n{sg}\n")
+    if LOG_LEVEL >= LOG_DEBUG:
+        log_and_print(f"smoothing_group:\n{sg}\n", LOG_DEBUG)
     
     return sg
 
-def get_vtf_path(side_content, vmf_path):
-    mat_path_re = re.compile(r'"material"\s+"([^"]+)"', re.DOTALL)
-
-    mat_path_match = mat_path_re.search(side_content)
-    
-    mat_path_raw = mat_path_match.group(1) if mat_path_match else None
-   
-    gameinfo_path = None
-    vtf_path = None
-    
-    gameinfo_found = False
-    for dirpath, dirnames, filenames in os.walk(os.path.dirname(os.path.dirname(vmf_path))):
-        if "gameinfo.txt" in filenames:
-            gameinfo_path = dirpath
-            gameinfo_found = True
-            break
-    
-    if not gameinfo_found:
-        for dirpath, dirnames, filenames in os.walk(os.path.dirname(os.path.dirname(os.path.dirname(vmf_path)))):
+# Function for finding the game folder (the one with gameinfo.txt) for a VMF,
+# searched in the VMF's grandparent folder first and then one level higher
+def find_gameinfo_dir(vmf_path):
+    vmf_dir = os.path.dirname(os.path.abspath(vmf_path))
+    for search_root in (os.path.dirname(vmf_dir), os.path.dirname(os.path.dirname(vmf_dir))):
+        for dirpath, dirnames, filenames in os.walk(search_root):
             if "gameinfo.txt" in filenames:
-                gameinfo_path = dirpath
-                gameinfo_found = True
-                break
-    
-    if not gameinfo_found:
-        log_and_print("Cant find gameinfo!!!")
-            
-    materials_path = gameinfo_path + "/materials"
-    
-    vmt_path = materials_path + "/" + mat_path_raw + ".vmt"
+                return dirpath
     
-    if os.path.exists(vmt_path):
-        with open(vmt_path, 'r') as file:
-            vmt_content = file.read()
+    log_and_print("Cant find gameinfo!!!", LOG_QUIET)
+    return None
+
+# Resolved material: VMT file, its $basetexture, the size of that VTF (None if unknown)
+# and whether what is behind its faces stays visible (see vmt_is_translucent)
+MaterialInfo = namedtuple('MaterialInfo', ['vmt_path', 'basetexture', 'vtf_path', 'vtf_size', 'translucent'])
+
+_basetexture_re = re.compile(r'"?\$basetexture"?\s+(?:"([^"]+)"|([^\s"{}]+))', re.IGNORECASE)
+
+# Translucent materials: blended, alpha-tested or additive ones, water and refracting shaders,
+# and tool materials that vbsp doesn't draw (clips, triggers, hints, ...)
+_translucent_re = re.compile(r'"?(?:\$translucent|\$alphatest|\$additive|%compile(?:nodraw|clip|playerclip|npcclip|trigger|invisible|'
+                             r'skip|hint|water|origin|areaportal|fog))"?\s+"?1', re.IGNORECASE)
+_vmt_shader_re = re.compile(r'^(?:\s|//[^\n]*)*"?([^\s"{]+)')
+TRANSLUCENT_SHADERS = ('water', 'refract')
+
+# Function for checking whether the faces of a material let what is behind them be seen
+def vmt_is_translucent(vmt_content):
+    shader = _vmt_shader_re.match(vmt_content)
+    return bool((shader and shader.group(1).lower() in TRANSLUCENT_SHADERS) or _translucent_re.search(vmt_content))
+
+# Location of the persistent material metadata cache used by the CLI (next to this script)
+MATERIAL_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vmf_to_obj_cache.sqlite')
+
+# Function for getting (mtime, size) of a file, used to invalidate cached entries; (-1, -1) if missing
+def file_stamp(path):
+    try:
+        st = os.stat(path)
+    except (OSError, TypeError):
+        return (-1, -1)
+    return (st.st_mtime_ns, st.st_size)
+
+# Persistent material metadata cache shared by all runs (and by concurrent conversions).
+# Entries are keyed by materials folder + material and checked against VMT/VTF mtime and size.
+# A cache written by an older version of the table is dropped.
+MATERIAL_CACHE_VERSION = 2
+
+class MaterialDiskCache:
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.connection = None
+        self.pending = []
+        try:
+            self.connection = sqlite3.connect(cache_path, timeout=30)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            with self.connection:
+                if self.connection.execute('PRAGMA user_version').fetchone()[0] != MATERIAL_CACHE_VERSION:
+                    self.connection.execute('DROP TABLE IF EXISTS materials')
+                    self.connection.execute(f'PRAGMA user_version = {MATERIAL_CACHE_VERSION}')
+                self.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS materials ('
+                    'materials_path TEXT, material TEXT, '
+                    'vmt_path TEXT, vmt_mtime INTEGER, vmt_size INTEGER, basetexture TEXT, '
+                    'vtf_path TEXT, vtf_mtime INTEGER, vtf_size INTEGER, width INTEGER, height INTEGER, translucent INTEGER, '
+                    'PRIMARY KEY (materials_path, material))')
+        except sqlite3.Error as e:
+            log_and_print(f"Material cache {cache_path} is disabled: {e}", LOG_QUIET)
+            self.connection = None
+
+    def get(self, materials_path, material_path, vmt_stamp):
+        if self.connection is None:
+            return None
+        try:
+            row = self.connection.execute(
+                'SELECT vmt_path, vmt_mtime, vmt_size, basetexture, vtf_path, vtf_mtime, vtf_size, width, height, translucent '
+                'FROM materials WHERE materials_path = ? AND material = ?', (materials_path, material_path)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
         
-        vtf_pattern = r'\$basetexture\s+"[^"]+/([^"/]+)"'
-        vtf_match = re.search(vtf_pattern, vmt_content, re.IGNORECASE)
-        if vtf_match:
-            vtf_name = vtf_match.group(1)
+        vmt_path, vmt_mtime, vmt_size, basetexture, vtf_path, vtf_mtime, vtf_size, width, height, translucent = row
+        if is_vpk_path(vmt_path):
+            # Packed VMT: its VPK must be unchanged and no loose VMT may override it
+            if vmt_stamp[0] != -1 or (vmt_mtime, vmt_size) != file_stamp(container_path(vmt_path)):
+                return None
+        elif (vmt_mtime, vmt_size) != vmt_stamp:
+            return None     # VMT changed since the entry was written
+        if vtf_path:
+            if (vtf_mtime, vtf_size) != file_stamp(container_path(vtf_path)):
+                return None     # VTF or its VPK changed since the entry was written
+            if is_vpk_path(vtf_path) and file_stamp(materials_path + "/" + basetexture + ".vtf")[0] != -1:
+                return None
+        elif basetexture and (vtf_mtime, vtf_size) != file_stamp(materials_path + "/" + basetexture + ".vtf"):
+            return None     # the VTF was missing when the entry was written and has been added since
         
-        vtf_raw_path_pattern = r'\$basetexture\s+"([^"]+)"'
-        vtf_raw_path_match = re.search(vtf_raw_path_pattern, vmt_content, re.IGNORECASE)
-        if vtf_raw_path_match:
-            vtf_raw_path = vtf_raw_path_match.group(1)
+        return MaterialInfo(vmt_path, basetexture, vtf_path, (width, height) if width is not None else None, bool(translucent))
+
+    def put(self, materials_path, material_path, info):
+        vmt_stamp = file_stamp(container_path(info.vmt_path))
+        vtf_stamp = file_stamp(container_path(info.vtf_path))
+        width, height = info.vtf_size if info.vtf_size is not None else (None, None)
+        self.pending.append((materials_path, material_path, info.vmt_path, vmt_stamp[0], vmt_stamp[1], info.basetexture,
+                             info.vtf_path, vtf_stamp[0], vtf_stamp[1], width, height, int(info.translucent)))
+
+    def flush(self):
+        if self.connection is None or not self.pending:
+            return
+        try:
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO materials VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', self.pending)
+        except sqlite3.Error as e:
+            log_and_print(f"Cant write material cache {self.cache_path}: {e}", LOG_QUIET)
+        self.pending = []
+
+# Material resolver, every material is looked up on disk only once per run
+# and, with a persistent cache, only once until its VMT/VTF changes
+class MaterialResolver:
+    def __init__(self, gameinfo_dir, cache_path=None):
+        self.gameinfo_dir = gameinfo_dir
+        self.materials_path = gameinfo_dir + "/materials" if gameinfo_dir else None
+        self.disk_cache = MaterialDiskCache(cache_path) if cache_path and self.materials_path else None
+        self.vpks = None    # VPK archives from gameinfo.txt, indexed on first use
+        self.cache = {}
+        self.stamps = {}    # material path -> stamps of the files it was resolved from, see refresh
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.load_seconds = 0.0     # time spent looking up missed materials
+
+    def resolve(self, material_path):
+        info = self.cache.get(material_path)
+        if info is not None:
+            self.hits += 1
+            return info
         
-            vtf_path = materials_path + "/" + vtf_raw_path + ".vtf"
-            
-        return vtf_path
+        self.misses += 1
+        start = time.perf_counter()
+        info = self._load(material_path)
+        self.load_seconds += time.perf_counter() - start
+        self.cache[material_path] = info
+        self.stamps[material_path] = self._file_stamps(material_path, info)
+        return info
+
+    def texture_size(self, material_path):
+        return self.resolve(material_path).vtf_size
+
+    # Function for dropping the materials whose VMT or VTF changed since they were resolved, for long-running processes
+    # (watch mode) that convert maps again after the files were edited; returns the number of dropped materials
+    def refresh(self):
+        changed = [material_path for material_path, stamps in self.stamps.items()
+                   if self._file_stamps(material_path, self.cache[material_path]) != stamps]
+        for material_path in changed:
+            del self.cache[material_path]
+            del self.stamps[material_path]
+        self.vpks = None    # VPK indexes are taken again from get_vpk_archive, which checks the VPK stamps
+        return len(changed)
+
+    # Function for the stamps of the files a material depends on: the loose VMT and VTF that override packed ones,
+    # the files or VPKs it was read from and, if a file wasn't found, all VPKs that were searched
+    def _file_stamps(self, material_path, info):
+        if self.materials_path is None or material_path is None:
+            return ()
         
-            #log_and_print(f"vtf_path: {vtf_path}\n")
-    else:
+        paths = [self.materials_path + "/" + material_path + ".vmt", container_path(info.vmt_path)]
+        if info.basetexture:
+            paths += [self.materials_path + "/" + info.basetexture + ".vtf", container_path(info.vtf_path)]
+        if info.vmt_path is None or (info.basetexture and info.vtf_path is None):
+            paths += [vpk.dir_path for vpk in self.vpks or ()]
+        return tuple(file_stamp(path) for path in paths)
+
+    def _load(self, material_path):
+        if self.materials_path is None or material_path is None:
+            return MaterialInfo(None, None, None, None, False)
+        
+        vmt_path = self.materials_path + "/" + material_path + ".vmt"
+        vmt_stamp = file_stamp(vmt_path)
+        if self.disk_cache is not None:
+            info = self.disk_cache.get(self.materials_path, material_path, vmt_stamp)
+            if info is not None:
+                self.disk_hits += 1
+                return info
+        
+        info = self._read_material(material_path, vmt_path, vmt_stamp)
+        if self.disk_cache is not None and info.vmt_path is not None:
+            self.disk_cache.put(self.materials_path, material_path, info)
+        return info
+
+    def _read_material(self, material_path, vmt_path, vmt_stamp):
+        # Loose files override the ones packed in VPKs, like in the engine
+        if vmt_stamp[0] != -1:
+            with open(vmt_path, 'r', errors='replace') as file:
+                vmt_content = file.read()
+        else:
+            vmt_path, vmt_data = self._read_from_vpks("materials/" + material_path + ".vmt")
+            if vmt_data is None:
+                return MaterialInfo(None, None, None, None, False)
+            vmt_content = vmt_data.decode('utf-8', errors='replace')
+        
+        translucent = vmt_is_translucent(vmt_content)
+        basetexture_match = _basetexture_re.search(vmt_content)
+        if not basetexture_match:
+            return MaterialInfo(vmt_path, None, None, None, translucent)
+        
+        basetexture = (basetexture_match.group(1) or basetexture_match.group(2)).replace('\\', '/')
+        vtf_path = self.materials_path + "/" + basetexture + ".vtf"
+        if os.path.exists(vtf_path):
+            vtf_info = read_vtf_info(vtf_path)
+        else:
+            vtf_path, vtf_header = self._read_from_vpks("materials/" + basetexture + ".vtf", VTF_HEADER_SIZE)
+            vtf_info = parse_vtf_header(vtf_header) if vtf_header is not None else None
+        
+        return MaterialInfo(vmt_path, basetexture, vtf_path, (vtf_info.width, vtf_info.height) if vtf_info else None, translucent)
+
+    # Function for reading a file from the game VPKs, returns (pseudo path, data) or (None, None)
+    def _read_from_vpks(self, inner_path, size=None):
+        if self.vpks is None:
+            self.vpks = [get_vpk_archive(path) for path in find_gameinfo_vpks(self.gameinfo_dir)]
+        
+        for vpk in self.vpks:
+            data = vpk.read(inner_path, size)
+            if data is not None:
+                return vpk.dir_path + "/" + inner_path.lower(), data
+        return None, None
+
+    def flush(self):
+        if self.disk_cache is not None:
+            self.disk_cache.flush()
+
+    # Function for the counters (hits, misses, disk hits, load seconds), taken at the start of a map for its own stats
+    def snapshot(self):
+        return (self.hits, self.misses, self.disk_hits, self.load_seconds)
+
+    # Function for logging the counters since a snapshot; the resolver is shared by all maps of the process
+    def log_stats(self, since=(0, 0, 0, 0.0), level=LOG_SUMMARY):
+        hits, misses, disk_hits = (now - before for now, before in zip(self.snapshot(), since[:3]))
+        log_and_print(f'Material cache: {hits} hits, {misses} misses ({disk_hits} from disk cache), {len(self.cache)} materials', level)
+
+# VTF header fields needed by the converter
+VTFInfo = namedtuple('VTFInfo', ['width', 'height', 'image_format', 'version'])
+
+# Only the fixed part of the VTF header is read: signature, version, header size, width, height, ..., image format
+VTF_HEADER_SIZE = 64
+_vtf_header_struct = struct.Struct('<4s2IIHH')
+
+# Function for parsing the fixed VTF header, returns None if it is not a valid VTF 7.x header
+def parse_vtf_header(header):
+    if len(header) < 56:
+        return None
+    
+    signature, version_major, version_minor, header_size, width, height = _vtf_header_struct.unpack_from(header)
+    if signature != b'VTF\0' or version_major != 7:
         return None
+    
+    image_format = struct.unpack_from('<i', header, 52)[0]
+    return VTFInfo(width, height, image_format, (version_major, version_minor))
+
+# Function for reading the VTF header of a loose file, without reading the image data
+def read_vtf_info(file_path):
+    try:
+        with open(file_path, 'rb') as f:
+            header = f.read(VTF_HEADER_SIZE)
+    except OSError as e:
+        log_and_print(f"Cant read VTF {file_path}: {e}", LOG_QUIET)
+        return None
+    
+    vtf_info = parse_vtf_header(header)
+    if vtf_info is None:
+        log_and_print(f"Not a valid VTF: {file_path}", LOG_QUIET)
+    return vtf_info
 
 def get_vtf_resolution(file_path):
     if file_path is None:
         return None
+    
+    vtf_info = read_vtf_info(file_path)
+    if vtf_info is None:
+        return None
+    
+    return (vtf_info.width, vtf_info.height)
 
-    try:
-        with open(file_path, 'rb') as f:
-            vtf_buffer = f.read()
-    except Exception as e:
-        return f"An error occurred: {e}"
+# Files read from VPKs are reported as "<archive>_dir.vpk/<path inside VPK>"
+def is_vpk_path(path):
+    return path is not None and '_dir.vpk/' in path
+
+# Function for getting the file on disk that holds a material file: the file itself or its _dir.vpk
+def container_path(path):
+    if not is_vpk_path(path):
+        return path
+    return path[:path.index('_dir.vpk/') + len('_dir.vpk')]
+
+# VPK directory entry: CRC, preload bytes, archive index, offset, length, terminator
+_vpk_entry_struct = struct.Struct('<IHHIIH')
+
+# Index of a VPK archive (_dir.vpk + numbered data archives), only VMT and VTF entries are kept.
+# Files are read straight from the archives with seek + read, nothing is extracted.
+class VPKArchive:
+    def __init__(self, dir_path, extensions=('vmt', 'vtf')):
+        self.dir_path = dir_path
+        self.entries = {}   # lowercase path -> (archive index, offset, length, preload offset, preload length)
+        
+        with open(dir_path, 'rb') as f:
+            signature, version, tree_size = struct.unpack('<3I', f.read(12))
+            if signature != 0x55AA1234 or version not in (1, 2):
+                raise ValueError(f"Not a VPK directory file: {dir_path}")
+            self.header_size = 12 if version == 1 else 28
+            f.seek(self.header_size)
+            tree = f.read(tree_size)
+        self.data_offset = self.header_size + tree_size     # embedded data (archive index 0x7fff) starts here
+        
+        pos = 0
+        def read_string():
+            nonlocal pos
+            end = tree.index(b'\0', pos)
+            value = tree[pos:end].decode('utf-8', errors='replace')
+            pos = end + 1
+            return value
+        
+        while True:
+            extension = read_string()
+            if not extension:
+                break
+            keep = extension.lower() in extensions
+            while True:
+                directory = read_string()
+                if not directory:
+                    break
+                prefix = '' if directory == ' ' else directory.lower() + '/'
+                while True:
+                    name = read_string()
+                    if not name:
+                        break
+                    crc, preload_length, archive_index, offset, length, terminator = _vpk_entry_struct.unpack_from(tree, pos)
+                    pos += _vpk_entry_struct.size
+                    if keep:
+                        self.entries[f'{prefix}{name.lower()}.{extension.lower()}'] = (
+                            archive_index, offset, length, self.header_size + pos, preload_length)
+                    pos += preload_length
 
-    # Extracting the width and height from the buffer
-    # According to the VTF header structure, width and height are at 16-byte and 18-byte offsets (unsigned short)
-    width = int.from_bytes(vtf_buffer[16:18], 'little')
-    height = int.from_bytes(vtf_buffer[18:20], 'little')
+    # Function for reading a file (or only its first `size` bytes) from the archive
+    def read(self, inner_path, size=None):
+        entry = self.entries.get(inner_path.lower())
+        if entry is None:
+            return None
+        
+        archive_index, offset, length, preload_offset, preload_length = entry
+        if size is None:
+            size = preload_length + length
+        
+        data = b''
+        if preload_length:
+            with open(self.dir_path, 'rb') as f:
+                f.seek(preload_offset)
+                data = f.read(min(preload_length, size))
+        
+        if len(data) < size and length:
+            if archive_index == 0x7FFF:
+                archive_path, offset = self.dir_path, self.data_offset + offset
+            else:
+                archive_path = f'{self.dir_path[:-len("_dir.vpk")]}_{archive_index:03d}.vpk'
+            with open(archive_path, 'rb') as f:
+                f.seek(offset)
+                data += f.read(min(length, size - len(data)))
+        
+        return data
+
+# VPK indexes are parsed once per process and kept in memory, keyed by path and (mtime, size)
+_vpk_archives = {}
+
+def get_vpk_archive(dir_path):
+    key = (dir_path, file_stamp(dir_path))
+    vpk = _vpk_archives.get(key)
+    if vpk is None:
+        vpk = VPKArchive(dir_path)
+        _vpk_archives[key] = vpk
+    return vpk
+
+# Function for finding the VPKs of the game: SearchPaths of gameinfo.txt, in search order,
+# or every *_dir.vpk next to gameinfo.txt if none are listed
+def find_gameinfo_vpks(gameinfo_dir):
+    if gameinfo_dir is None:
+        return []
+    
+    base_dir = os.path.dirname(os.path.abspath(gameinfo_dir))
+    vpk_paths = []
+    try:
+        with open(os.path.join(gameinfo_dir, "gameinfo.txt"), 'r', errors='replace') as f:
+            gameinfo = parse_keyvalues(f.read())
+    except OSError:
+        gameinfo = VMFNode('')
+    
+    for game_info in gameinfo.children:
+        for file_system in game_info.iter_children('FileSystem'):
+            for search_paths in file_system.iter_children('SearchPaths'):
+                for key, value in search_paths.keyvalues:
+                    if not value.lower().endswith('.vpk'):
+                        continue
+                    value = value.replace('|gameinfo_path|', os.path.abspath(gameinfo_dir) + '/')
+                    value = value.replace('|all_source_engine_paths|', base_dir + '/')
+                    vpk_path = os.path.normpath(os.path.join(base_dir, value[:-len('.vpk')] + '_dir.vpk'))
+                    if os.path.exists(vpk_path) and vpk_path not in vpk_paths:
+                        vpk_paths.append(vpk_path)
     
-    return (width, height)
+    if not vpk_paths:
+        vpk_paths = sorted(os.path.join(gameinfo_dir, name) for name in os.listdir(gameinfo_dir) if name.lower().endswith('_dir.vpk'))
+    
+    return vpk_paths
 
-def find_plane_normal_from_list(vertices):
+def find_plane_normals(A, B, C):
     """
-    Finds the exact normal vector of the plane defined by the given vertices.
+    Finds the exact normal vectors of the planes defined by the given triples of points.
     
     Parameters:
-        vertices (list): A list of tuples containing at least 3 points in 3D space that define a plane.
+        A, B, C (ndarray): N x 3 numpy arrays, row i holds one point of plane i.
         
     Returns:
-        normal (ndarray): A 1 x 3 numpy array containing the components of the normal vector.
+        normals (ndarray): A N x 3 numpy array containing the normalized normal vectors.
     """
-    # Convert the list of tuples to a numpy array
-    points = np.array(vertices)
+    # Calculate the cross product of AB and AC to get the normal vectors
+    normals = np.cross(B - A, C - A)
     
-    # Take the first three vertices to define two vectors on the plane
-    A, B, C = points[0], points[1], points[2]
+    # Normalize the normal vectors; the batched matmul gives the same norms as np.linalg.norm per vector
+    norms = np.sqrt((normals[:, None, :] @ normals[:, :, None]).reshape(-1))
     
-    # Calculate the vectors AB and AC
-    AB = B - A
-    AC = C - A
+    return normals / norms[:, None]
+
+_texture_axis_re = re.compile(r"(-?\d+\.?\d*)")
+
+# Function for parsing "[x y z shift] scale" texture axis into 5 floats
+def parse_texture_axis(axis):
+    values = _texture_axis_re.findall(axis) if axis else []
+    if len(values) != 5:
+        return (0.0, 0.0, 0.0, 0.0, 0.0)
+    return tuple(map(float, values))
+
+# Function for computing positions, UVs and normals of all collected sides in one batch.
+# Per-vertex values are computed with the same operations (and order) as the per-vertex version did,
+# so the numbers are exactly the same.
+def compute_sides_geometry(vertices, side_vertex_counts, side_axes, side_tex_sizes, options=None):
+    if options is None:
+        options = ConvertOptions()
+    scale, texel_tex, texel_units = options.unit_scale, options.texel_dencity_tex, options.texel_dencity_units
+    points = np.array(vertices, dtype=np.float64).reshape(-1, 3)
+    counts = np.array(side_vertex_counts, dtype=np.int64)
+    axes = np.array(side_axes, dtype=np.float64).reshape(-1, 10)
+    tex_sizes = np.array(side_tex_sizes, dtype=np.float64).reshape(-1, 2)
+    
+    x, y, z = points[:, 0], points[:, 1], points[:, 2]
     
-    # Calculate the cross product of AB and AC to get the normal vector
-    normal = np.cross(AB, AC)
+    # Hammer Z-up to OBJ Y-up, scaled
+    positions = np.column_stack((x * scale, z * scale, -y * scale))
     
-    # Normalize the normal vector
-    normal = normal / np.linalg.norm(normal)
+    # UV projection, per-side texture axes repeated for every vertex of the side
+    vertex_axes = np.repeat(axes, counts, axis=0)
+    vertex_tex_sizes = np.repeat(tex_sizes, counts, axis=0)
+    ux, uy, uz, u_shift = vertex_axes[:, 0], vertex_axes[:, 1], vertex_axes[:, 2], vertex_axes[:, 3]
+    vx, vy, vz, v_shift = vertex_axes[:, 5], vertex_axes[:, 6], vertex_axes[:, 7], vertex_axes[:, 8]
+    u = ((x * ux + y * uy + z * uz) / texel_units + u_shift / texel_tex) * texel_tex / vertex_tex_sizes[:, 0]
+    v = -((x * vx + y * vy + z * vz) / texel_units + v_shift / texel_tex) * texel_tex / vertex_tex_sizes[:, 1]
+    uvs = np.column_stack((u, v))
     
-    return normal
+    # One normal per side from its first three vertices (sides with less than 3 vertices get NaN)
+    normals = np.full((len(counts), 3), np.nan)
+    starts = np.cumsum(counts) - counts
+    valid = counts >= 3
+    if valid.any():
+        first = starts[valid]
+        nx, ny, nz = find_plane_normals(points[first], points[first + 1], points[first + 2]).T
+        normals[valid] = np.column_stack((nx, nz, -ny))
+    
+    return positions, uvs, normals
 
-def convert_vmf_to_obj(vmf_content, vmf_path):
-    log_and_print(f"Start convert_vmf_to_obj...\n")
-    obj_data = "".join(f'#\n# Atmus OBJ\n#\n\n')
-    solid_contents = extract_solids_from_vmf(vmf_content)
-    solid_content_index=0
-    vertex_index = 0
-    for solid_content in solid_contents:
-        log_and_print("-" * 50)
-        solid_content_index+=1
-        solid_id_pattern = re.compile(r'"id"\s+"([^"]+)"', re.DOTALL)
-        solid_match = solid_id_pattern.match(solid_content)
-        if solid_match:
-            solid_id = solid_match.group(1)
-        
-        if int(solid_id) <= 9:
-            tripled_solid_id = "00" + f'{solid_id}'
-        elif int(solid_id) <= 99:
-            tripled_solid_id = "0" + f'{solid_id}'
+# In-memory mesh, OBJ-like: positions, UVs and normals are separate arrays, indexed per face corner.
+# Faces are stored as offsets into the corner arrays, with a material and a smoothing group per face.
+class Mesh:
+    def __init__(self, positions, uvs, normals, face_offsets, corner_positions, corner_uvs, corner_normals,
+                 face_materials, face_smoothing, materials, face_occluders=None):
+        self.positions = positions              # P x 3 float64
+        self.uvs = uvs                          # T x 2 float64
+        self.normals = normals                  # N x 3 float64
+        self.face_offsets = face_offsets        # F + 1 int64, corners of face i are face_offsets[i]:face_offsets[i + 1]
+        self.corner_positions = corner_positions    # C int64, 0-based
+        self.corner_uvs = corner_uvs                # C int64, 0-based
+        self.corner_normals = corner_normals        # C int64, 0-based, -1 if the corner has no normal
+        self.face_materials = face_materials    # F int64, index in materials
+        self.face_smoothing = face_smoothing    # F int64, smoothing group bitmask, 0 means not smoothed
+        self.materials = materials              # material names
+        # F bool, faces that hide faces behind them (see find_hidden_faces), all faces if None
+        self.face_occluders = face_occluders if face_occluders is not None else np.ones(len(face_offsets) - 1, dtype=bool)
+
+    @property
+    def face_count(self):
+        return len(self.face_offsets) - 1
+
+    def face_sizes(self):
+        return np.diff(self.face_offsets)
+
+    def __repr__(self):
+        return (f'Mesh({len(self.positions)} positions, {len(self.uvs)} uvs, {len(self.normals)} normals, '
+                f'{self.face_count} faces, {len(self.materials)} materials)')
+
+    # Function for making a mesh from the given faces (subset and/or new order) of this mesh
+    def select_faces(self, faces):
+        sizes = self.face_sizes()[faces]
+        face_offsets = np.zeros(len(faces) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=face_offsets[1:])
+        corners = np.repeat(self.face_offsets[:-1][faces] - face_offsets[:-1], sizes) + np.arange(face_offsets[-1])
+        return Mesh(self.positions, self.uvs, self.normals, face_offsets,
+                    self.corner_positions[corners], self.corner_uvs[corners], self.corner_normals[corners],
+                    self.face_materials[faces], self.face_smoothing[faces], self.materials, self.face_occluders[faces])
+
+    # Function for removing positions, UVs, normals and materials no face uses
+    def compact(self):
+        positions, corner_positions = compact_indexed(self.positions, self.corner_positions)
+        uvs, corner_uvs = compact_indexed(self.uvs, self.corner_uvs)
+        normals, corner_normals = compact_indexed(self.normals, self.corner_normals)
+        used_materials, face_materials = np.unique(self.face_materials, return_inverse=True)
+        return Mesh(positions, uvs, normals, self.face_offsets, corner_positions, corner_uvs, corner_normals,
+                    face_materials.reshape(-1), self.face_smoothing, [self.materials[i] for i in used_materials], self.face_occluders)
+
+# Function for dropping unreferenced rows of an indexed array, keeping the order of the rest; -1 indices stay -1
+def compact_indexed(values, indices):
+    used = np.zeros(len(values) + 1, dtype=bool)
+    used[indices] = True    # -1 marks the extra last slot
+    used = used[:-1]
+    remap = np.full(len(values) + 1, -1, dtype=np.int64)
+    remap[:-1][used] = np.arange(np.count_nonzero(used))
+    return values[used], remap[indices]
+
+# Function for parsing smoothing_groups value into a bitmask
+def parse_smoothing_group(sg):
+    return int(sg) if sg and sg.isdigit() else 0
+
+# Function for joining meshes into one, indices of every mesh are offset by the sizes of the meshes before it.
+# Materials are merged by name in order of first appearance.
+def concatenate_meshes(meshes):
+    material_ids = {}
+    positions, uvs, normals = [], [], []
+    face_offsets = [np.zeros(1, dtype=np.int64)]
+    corner_positions, corner_uvs, corner_normals = [], [], []
+    face_materials, face_smoothing, face_occluders = [], [], []
+    position_offset = uv_offset = normal_offset = corner_offset = 0
+    
+    for mesh in meshes:
+        material_map = np.array([material_ids.setdefault(material, len(material_ids)) for material in mesh.materials], dtype=np.int64)
+        positions.append(mesh.positions)
+        uvs.append(mesh.uvs)
+        normals.append(mesh.normals)
+        face_offsets.append(mesh.face_offsets[1:] + corner_offset)
+        corner_positions.append(mesh.corner_positions + position_offset)
+        corner_uvs.append(mesh.corner_uvs + uv_offset)
+        corner_normals.append(np.where(mesh.corner_normals >= 0, mesh.corner_normals + normal_offset, -1))
+        face_materials.append(material_map[mesh.face_materials] if len(material_map) else mesh.face_materials)
+        face_smoothing.append(mesh.face_smoothing)
+        face_occluders.append(mesh.face_occluders)
+        position_offset += len(mesh.positions)
+        uv_offset += len(mesh.uvs)
+        normal_offset += len(mesh.normals)
+        corner_offset += len(mesh.corner_positions)
+    
+    def join(arrays, shape):
+        return np.concatenate(arrays) if arrays else np.zeros(shape)
+    
+    return Mesh(join(positions, (0, 3)), join(uvs, (0, 2)), join(normals, (0, 3)), np.concatenate(face_offsets),
+                join(corner_positions, 0).astype(np.int64), join(corner_uvs, 0).astype(np.int64), join(corner_normals, 0).astype(np.int64),
+                join(face_materials, 0).astype(np.int64), join(face_smoothing, 0).astype(np.int64), list(material_ids),
+                join(face_occluders, 0).astype(bool))
+
+# func_instance: every instance VMF is converted once and cached by path, file stamps and settings.
+# Occurrences are placed by rotating and moving copies of the cached mesh, all copies of an instance in one batch.
+# UVs are kept, like the texture lock vbsp applies when it merges instances.
+_instance_meshes = {}   # (path, settings) -> (mesh, ((path, stamp) of the instance and its nested instances), excluded sides of its solids)
+
+# Hammer to OBJ axes (Z-up to Y-up), as in compute_sides_geometry
+HAMMER_TO_OBJ = ((1.0, 0.0, 0.0), (0.0, 0.0, 1.0), (0.0, -1.0, 0.0))
+
+# Function for the rotation matrices of "pitch yaw roll" angles in degrees (N x 3 -> N x 3 x 3), the engine's AngleMatrix
+def angles_to_matrices(angles):
+    pitch, yaw, roll = np.radians(np.asarray(angles, dtype=np.float64).reshape(-1, 3)).T
+    sp, cp = np.sin(pitch), np.cos(pitch)
+    sy, cy = np.sin(yaw), np.cos(yaw)
+    sr, cr = np.sin(roll), np.cos(roll)
+    return np.stack((np.stack((cp * cy, sr * sp * cy - cr * sy, cr * sp * cy + sr * sy), axis=-1),
+                     np.stack((cp * sy, sr * sp * sy + cr * cy, cr * sp * sy - sr * cy), axis=-1),
+                     np.stack((-sp, sr * cp, cr * cp), axis=-1)), axis=1)
+
+# Function for parsing a "x y z" value into 3 floats, missing or broken values are zeros
+def parse_vector(value):
+    parts = value.split() if value else []
+    try:
+        return tuple(float(part) for part in parts[:3]) if len(parts) >= 3 else (0.0, 0.0, 0.0)
+    except ValueError:
+        return (0.0, 0.0, 0.0)
+
+# Function for making copies of a mesh, copy i is rotated by rotations[i] and moved by translations[i] (OBJ space)
+def place_mesh(mesh, rotations, translations):
+    count = len(rotations)
+    copies = np.arange(count, dtype=np.int64)[:, None]
+    positions = np.einsum('kij,pj->kpi', rotations, mesh.positions) + translations[:, None, :]
+    normals = np.einsum('kij,pj->kpi', rotations, mesh.normals)
+    corner_count = len(mesh.corner_positions)
+    face_offsets = np.concatenate(([0], (mesh.face_offsets[1:] + copies * corner_count).reshape(-1)))
+    corner_normals = np.where(mesh.corner_normals >= 0, mesh.corner_normals + copies * len(mesh.normals), -1)
+    return Mesh(positions.reshape(-1, 3), np.tile(mesh.uvs, (count, 1)), normals.reshape(-1, 3), face_offsets,
+                (mesh.corner_positions + copies * len(mesh.positions)).reshape(-1), (mesh.corner_uvs + copies * len(mesh.uvs)).reshape(-1),
+                corner_normals.reshape(-1), np.tile(mesh.face_materials, count), np.tile(mesh.face_smoothing, count), mesh.materials,
+                np.tile(mesh.face_occluders, count))
+
+# Function for finding the VMF of a func_instance "file" value: next to the VMF that uses it, then next to the converted map
+def find_instance_path(file_value, vmf_path, root_vmf_path):
+    file_value = file_value.replace('\\', '/')
+    if not file_value.lower().endswith('.vmf'):
+        file_value += '.vmf'
+    for base_path in (vmf_path, root_vmf_path):
+        path = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(base_path)) if base_path else os.getcwd(), file_value))
+        if os.path.isfile(path):
+            return path
+    return None
+
+# Function for converting an instance VMF with its nested instances, cached while the files stay unchanged.
+# The excluded sides of the instance's own solids are kept with the mesh, expand_instances counts them once per file.
+def convert_instance(instance_path, root_vmf_path, material_resolver, options, expanding):
+    key = (instance_path, options._replace(jobs=1))
+    cached = _instance_meshes.get(key)
+    if cached is not None and all(file_stamp(path) == stamp for path, stamp in cached[1]):
+        return cached[0]
+    
+    stamp = file_stamp(instance_path)
+    with open(instance_path, 'r') as f:
+        vmf_root = parse_keyvalues(f.read())
+    excluded = {}
+    mesh = convert_solids(extract_solids_from_vmf(vmf_root), instance_path, material_resolver, options, excluded)[0]
+    nested_mesh, nested_files, nested_count = expand_instances(vmf_root, instance_path, root_vmf_path, material_resolver, options,
+                                                 expanding=expanding + (instance_path,))
+    if nested_mesh is not None:
+        mesh = concatenate_meshes([mesh, nested_mesh])
+    
+    _instance_meshes[key] = (mesh, ((instance_path, stamp),) + nested_files, excluded)
+    return mesh
+
+# Function for expanding the func_instance entities of a parsed VMF into one mesh,
+# returns (mesh or None, files used, number of func_instance entities placed).
+# expanding holds the instance files being expanded, an instance that uses one of them is a cycle and is skipped.
+# The excluded sides of the instance files used are added to excluded, if given.
+def expand_instances(vmf_root, vmf_path, root_vmf_path, material_resolver, options, excluded=None, expanding=()):
+    # Occurrences grouped by instance file
+    occurrences = {}
+    for entity in extract_entities_from_vmf(vmf_root):
+        if entity.get('classname') != 'func_instance' or not entity.get('file'):
+            continue
+        instance_path = find_instance_path(entity.get('file'), vmf_path, root_vmf_path)
+        if instance_path is None:
+            log_and_print(f"Instance {entity.get('file')} of entity {entity.get('id')} not found", LOG_QUIET)
+            continue
+        if instance_path in expanding:
+            log_and_print(f"Instance {entity.get('file')} of entity {entity.get('id')} includes itself, skipped", LOG_QUIET)
+            continue
+        occurrences.setdefault(instance_path, []).append((parse_vector(entity.get('origin')), parse_vector(entity.get('angles'))))
+    
+    meshes = []
+    files = ()
+    hammer_to_obj = np.array(HAMMER_TO_OBJ)
+    for instance_path, placements in occurrences.items():
+        mesh = convert_instance(instance_path, root_vmf_path, material_resolver, options, expanding)
+        files += _instance_meshes[(instance_path, options._replace(jobs=1))][1]
+        if not mesh.face_count:
+            continue
+        origins = np.array([origin for origin, angles in placements], dtype=np.float64)
+        rotations = hammer_to_obj @ angles_to_matrices([angles for origin, angles in placements]) @ hammer_to_obj.T
+        meshes.append(place_mesh(mesh, rotations, origins @ hammer_to_obj.T * options.unit_scale))
+        log_and_print(f"Instance {os.path.basename(instance_path)}: {len(placements)} placed, {mesh.face_count} sides each", LOG_DEBUG)
+    
+    # Excluded sides of every instance file used by the map, cached or not, counted once (nested calls pass no dict)
+    if excluded is not None:
+        for instance_path in dict.fromkeys(path for path, stamp in files):
+            for material_path, count in _instance_meshes[(instance_path, options._replace(jobs=1))][2].items():
+                excluded[material_path] = excluded.get(material_path, 0) + count
+    
+    return (concatenate_meshes(meshes) if meshes else None), files, sum(len(placements) for placements in occurrences.values())
+
+def log_instances(instance_mesh, instance_files, instance_count):
+    run_count('instances', instance_count)
+    if instance_count:
+        log_and_print(f"Instances: {instance_count} placed from {len({path for path, stamp in instance_files})} files, "
+                      f"{instance_mesh.face_count if instance_mesh is not None else 0} sides")
+
+# Block index: a pre-scan of the VMF finds every solid and entity block without parsing it, with its byte range, id,
+# visgroups, materials and bounds, so a part of the map is converted by parsing only the blocks it needs.
+# The scan follows the layout Hammer writes (block names and braces on their own lines, one key/value pair per line)
+# and tokenizes only block names, braces and the keys it indexes; vertices and materials are read per solid.
+# The index is kept in <map>_index.npz next to the VMF and used while the VMF stays unchanged.
+VMF_INDEX_VERSION = 1
+BLOCK_SOLID = 0
+BLOCK_ENTITY = 1
+
+_INDEX_TOKEN_RE = re.compile(rb'^[ \t]*(?:(\w+)\s*\{|"(id|classname|origin|visgroupid|name)"[ \t]+"([^"]*)"|\})', re.M)
+_INDEX_VERTEX_RE = re.compile(rb'^[ \t]*"v"[ \t]+"([^"]*)"', re.M)
+_INDEX_MATERIAL_RE = re.compile(rb'^[ \t]*"material"[ \t]+"([^"]*)"', re.M)
+
+# Indexed blocks in file order. Solids of brush entities have the row of their entity as owner (-1 for world solids),
+# bounds are min and max corners in hammer units (NaN if the block has no vertices and no origin), visgroups and
+# materials of row i are visgroup_ids[visgroup_offsets[i]:visgroup_offsets[i + 1]] and the same for materials.
+VMFIndex = namedtuple('VMFIndex', ['kinds', 'offsets', 'lengths', 'ids', 'owners', 'classnames', 'bounds',
+                                   'visgroup_offsets', 'visgroup_ids', 'material_offsets', 'material_ids', 'materials',
+                                   'visgroup_names', 'visgroup_name_ids'])
+
+# Blocks of a VMF to convert, empty fields select everything: bbox is ((x, y, z), (x, y, z)) in hammer units,
+# visgroups are names or ids, classnames are entity classes (worldspawn for world solids, globs allowed) and
+# materials are rules as in MaterialFilter. A block has to match every given field.
+Selection = namedtuple('Selection', ['bbox', 'visgroups', 'classnames', 'materials'], defaults=(None, (), (), ()))
+
+# Function for the offsets of lists with the given sizes, as int64
+def list_offsets(lists):
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(values) for values in lists], out=offsets[1:])
+    return offsets
+
+# Function for building the block index of VMF content (bytes or a memory map)
+def scan_vmf_blocks(content):
+    kinds, starts, ends, ids, owners, classnames, origins = [], [], [], [], [], [], []
+    block_visgroups = {}    # row -> visgroup ids of its editor block
+    visgroup_names, visgroup_name_ids = [], []
+    stack = []              # (name, row) of the enclosing blocks, row -1 for blocks that aren't indexed
+    entity_row = -1
+    visgroup_name = None
+    
+    for m in _INDEX_TOKEN_RE.finditer(content):
+        name, key = m.group(1), m.group(2)
+        if name is not None:
+            name = name.decode('utf-8', 'replace')
+            row = -1
+            if name in ('solid', 'entity'):
+                owner_names = [block_name for block_name, block_row in stack if block_name != 'hidden']
+                if name == 'solid' and owner_names in (['world'], ['entity']):
+                    row = len(kinds)
+                    kinds.append(BLOCK_SOLID)
+                    owners.append(entity_row if owner_names == ['entity'] else -1)
+                elif name == 'entity' and not owner_names:
+                    row = entity_row = len(kinds)
+                    kinds.append(BLOCK_ENTITY)
+                    owners.append(-1)
+                if row >= 0:
+                    starts.append(m.start(1))
+                    ends.append(len(content))
+                    ids.append(-1)
+                    classnames.append('')
+                    origins.append(None)
+            stack.append((name, row))
+        elif key is None:
+            if stack:
+                name, row = stack.pop()
+                if row >= 0:
+                    ends[row] = m.end()
+                    if row == entity_row:
+                        entity_row = -1
+        elif stack:
+            value = m.group(3)
+            block_name, row = stack[-1]
+            if row >= 0:
+                if key == b'id':
+                    ids[row] = int(value) if value.isdigit() else -1
+                elif key == b'classname':
+                    classnames[row] = value.decode('utf-8', 'replace')
+                elif key == b'origin':
+                    origins[row] = parse_vector(value.decode('utf-8', 'replace'))
+            elif key == b'visgroupid' and value.isdigit():
+                if block_name == 'editor' and len(stack) > 1 and stack[-2][1] >= 0:
+                    block_visgroups.setdefault(stack[-2][1], []).append(int(value))
+                elif block_name == 'visgroup' and visgroup_name is not None:
+                    visgroup_names.append(visgroup_name)
+                    visgroup_name_ids.append(int(value))
+            elif key == b'name' and block_name == 'visgroup':
+                visgroup_name = value.decode('utf-8', 'replace')
+    
+    # Vertices and materials of every solid, read from its byte range
+    bounds = np.full((len(kinds), 6), np.nan)
+    solid_materials = [[] for _ in kinds]
+    vertex_values, vertex_counts, solid_rows = [], [], []
+    for row, kind in enumerate(kinds):
+        if kind != BLOCK_SOLID:
+            continue
+        values = _INDEX_VERTEX_RE.findall(content, starts[row], ends[row])
+        vertex_values.extend(values)
+        vertex_counts.append(len(values))
+        solid_rows.append(row)
+        solid_materials[row] = list(dict.fromkeys(_INDEX_MATERIAL_RE.findall(content, starts[row], ends[row])))
+    
+    coordinates = np.array(b' '.join(vertex_values).split(), dtype=np.float64)
+    if len(coordinates) != 3 * len(vertex_values):
+        coordinates = np.array([parse_vector(value.decode('utf-8', 'replace')) for value in vertex_values], dtype=np.float64)
+    points = coordinates.reshape(-1, 3)
+    vertex_counts = np.array(vertex_counts, dtype=np.int64)
+    solid_rows = np.array(solid_rows, dtype=np.int64)
+    with_vertices = vertex_counts > 0
+    if with_vertices.any():
+        firsts = (np.cumsum(vertex_counts) - vertex_counts)[with_vertices]
+        bounds[solid_rows[with_vertices], :3] = np.minimum.reduceat(points, firsts)
+        bounds[solid_rows[with_vertices], 3:] = np.maximum.reduceat(points, firsts)
+    
+    # Entities cover their solids and their origin
+    owners = np.array(owners, dtype=np.int64)
+    entity_solids = np.flatnonzero((owners >= 0) & ~np.isnan(bounds[:, 0]))
+    for row, origin in enumerate(origins):
+        if origin is not None:
+            bounds[row] = origin + origin
+    np.fmin.at(bounds[:, :3], owners[entity_solids], bounds[entity_solids, :3])
+    np.fmax.at(bounds[:, 3:], owners[entity_solids], bounds[entity_solids, 3:])
+    
+    # Materials are stored once, blocks refer to them
+    material_table = {}
+    material_ids = [material_table.setdefault(material.decode('utf-8', 'replace'), len(material_table))
+                    for materials in solid_materials for material in materials]
+    visgroup_lists = [block_visgroups.get(row, []) for row in range(len(kinds))]
+    
+    return VMFIndex(np.array(kinds, dtype=np.int64), np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64) - np.array(starts, dtype=np.int64),
+                    np.array(ids, dtype=np.int64), owners, np.array(classnames, dtype=str), bounds,
+                    list_offsets(visgroup_lists), np.array([i for ids in visgroup_lists for i in ids], dtype=np.int64),
+                    list_offsets(solid_materials), np.array(material_ids, dtype=np.int64), np.array(list(material_table), dtype=str),
+                    np.array(visgroup_names, dtype=str), np.array(visgroup_name_ids, dtype=np.int64))
+
+# Function for the path of the block index of a VMF
+def vmf_index_path_for(vmf_path):
+    return f"{os.path.splitext(vmf_path)[0]}_index.npz"
+
+# Function for the block index of a VMF file, read from <map>_index.npz if it was made from the same file,
+# otherwise the VMF is scanned and the index written
+def get_vmf_index(vmf_path):
+    index_path = vmf_index_path_for(vmf_path)
+    stamp = file_stamp(vmf_path)
+    try:
+        with np.load(index_path, allow_pickle=False) as data:
+            if int(data['version']) == VMF_INDEX_VERSION and tuple(data['stamp'].tolist()) == stamp:
+                log_and_print(f"Block index {index_path} loaded", LOG_DEBUG)
+                return VMFIndex(*(data[field] for field in VMFIndex._fields))
+    except (OSError, ValueError, KeyError):
+        pass
+    
+    with open(vmf_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            index = scan_vmf_blocks(b'')
         else:
-            tripled_solid_id = solid_id
-        
-        log_and_print(f"Converting Solid_{tripled_solid_id}...")
-        
-        converted_solid = ""
-        converted_solid += f'#\n# Solid_{tripled_solid_id}\n#\n\n'
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                index = scan_vmf_blocks(content)
+    
+    # Written to a temporary file first, so an interrupted run doesn't leave a broken index
+    temp_path = f"{index_path}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            np.savez(f, version=np.int64(VMF_INDEX_VERSION), stamp=np.array(stamp, dtype=np.int64), **index._asdict())
+        os.replace(temp_path, index_path)
+        log_and_print(f"Block index written to {index_path}", LOG_DEBUG)
+    except OSError as e:
+        log_and_print(f"Block index {index_path} is not written ({e})", LOG_QUIET)
+    return index
+
+# Function for the rows of the blocks matching a selection: solids in the order of extract_solids_from_vmf and
+# func_instance entities. Instances match by their origin and can't match a material query.
+def select_blocks(index, selection):
+    import fnmatch
+    matched = np.ones(len(index.kinds), dtype=bool)
+    solids = index.kinds == BLOCK_SOLID
+    owners = np.where(solids & (index.owners >= 0), index.owners, np.arange(len(index.kinds)))
+    
+    if selection.bbox is not None:
+        low, high = np.minimum(*np.array(selection.bbox, dtype=np.float64)), np.maximum(*np.array(selection.bbox, dtype=np.float64))
+        matched &= (index.bounds[:, :3] <= high).all(axis=1) & (index.bounds[:, 3:] >= low).all(axis=1)
+    
+    if selection.visgroups:
+        wanted = {str(visgroup).lower() for visgroup in selection.visgroups}
+        visgroup_ids = {int(visgroup) for visgroup in wanted if visgroup.isdigit()}
+        visgroup_ids.update(int(i) for name, i in zip(index.visgroup_names.tolist(), index.visgroup_name_ids) if name.lower() in wanted)
+        rows = np.repeat(np.arange(len(index.kinds), dtype=np.int64), np.diff(index.visgroup_offsets))
+        in_visgroup = np.zeros(len(index.kinds), dtype=bool)
+        in_visgroup[rows[np.isin(index.visgroup_ids, list(visgroup_ids))]] = True
+        matched &= in_visgroup | in_visgroup[owners]
+    
+    if selection.classnames:
+        patterns = [classname.lower() for classname in selection.classnames]
+        classnames = np.where(solids & (index.owners < 0), 'worldspawn', index.classnames[owners])
+        names, name_ids = np.unique(classnames, return_inverse=True)
+        name_matches = np.array([any(fnmatch.fnmatchcase(name.lower(), pattern) for pattern in patterns) for name in names.tolist()], dtype=bool)
+        matched &= name_matches[name_ids.reshape(-1)] if len(names) else matched
+    
+    if selection.materials:
+        material_filter = get_material_filter(selection.materials)
+        material_matches = np.array([material_filter.excludes(material) for material in index.materials.tolist()], dtype=bool)
+        rows = np.repeat(np.arange(len(index.kinds), dtype=np.int64), np.diff(index.material_offsets))
+        with_material = np.zeros(len(index.kinds), dtype=bool)
+        with_material[rows[material_matches[index.material_ids]] if len(material_matches) else rows[:0]] = True
+        matched &= with_material
+    
+    solid_rows = np.flatnonzero(matched & solids)
+    solid_rows = solid_rows[np.lexsort((index.offsets[solid_rows], index.owners[solid_rows] >= 0))]
+    instance_rows = np.flatnonzero(matched & (index.kinds == BLOCK_ENTITY) & (index.classnames == 'func_instance'))
+    return solid_rows, instance_rows
+
+# Function for converting the blocks of a VMF matching a selection into one mesh (see convert_vmf_to_mesh).
+# source is the path of the VMF or its content as bytes; the index of a file is cached next to it.
+def convert_vmf_selection(source, selection, material_resolver=None, options=None):
+    if options is None:
+        options = ConvertOptions()
+    vmf_path = None if isinstance(source, (bytes, bytearray, memoryview)) else os.fspath(source)
+    if material_resolver is None:
+        material_resolver = get_material_resolver(vmf_path, options.game_dir, options.material_cache_path)
+    
+    with run_stage('index'):
+        index = get_vmf_index(vmf_path) if vmf_path is not None else scan_vmf_blocks(bytes(source))
+    solid_rows, instance_rows = select_blocks(index, selection)
+    
+    # Only the selected blocks are read and parsed
+    with run_stage('parse'):
+        rows = np.concatenate((solid_rows, instance_rows))
+        if vmf_path is None:
+            blocks = [bytes(source[start:start + length]) for start, length in zip(index.offsets[rows].tolist(), index.lengths[rows].tolist())]
+        else:
+            with open(vmf_path, 'rb') as f:
+                blocks = []
+                for start, length in zip(index.offsets[rows].tolist(), index.lengths[rows].tolist()):
+                    f.seek(start)
+                    blocks.append(f.read(length))
+        vmf_root = parse_keyvalues(b'\n'.join(blocks).decode('utf-8', errors='replace'))
+        solids = list(vmf_root.iter_children('solid'))
+        owners = index.owners[solid_rows]
+        for solid, owner in zip(solids, owners.tolist()):
+            solid.owner = str(index.classnames[owner]) if owner >= 0 else 'worldspawn'
+    
+    parsed_bytes = sum(len(block) for block in blocks)
+    run_count('vmf_bytes', parsed_bytes)
+    run_count('indexed_blocks', len(index.kinds))
+    run_count('selected_blocks', len(rows))
+    solid_count = int(np.count_nonzero(index.kinds == BLOCK_SOLID))
+    instance_count = int(np.count_nonzero(index.classnames == 'func_instance'))
+    log_and_print(f"{os.path.basename(vmf_path) if vmf_path else 'VMF'}: selected {len(solids)} of {solid_count} solids and "
+                  f"{len(instance_rows)} of {instance_count} instances, {parsed_bytes} bytes parsed")
+    return convert_vmf_root(vmf_root, solids, vmf_path, material_resolver, options)
+
+# Maps with fewer solids are always converted in one process
+MAP_JOBS_MIN_SOLIDS = 1000
+
+def convert_vmf_to_mesh(vmf_content, vmf_path, material_resolver=None, options=None, solid_cache_path=None):
+    log_and_print(f"Start convert_vmf_to_mesh...\n", LOG_DEBUG)
+    if options is None:
+        options = ConvertOptions()
+    if material_resolver is None:
+        material_resolver = get_material_resolver(vmf_path, options.game_dir, options.material_cache_path)
+    with run_stage('parse'):
+        vmf_root = parse_keyvalues(vmf_content)
+        solids = extract_solids_from_vmf(vmf_root)
+    log_and_print(f"{os.path.basename(vmf_path) if vmf_path else 'VMF'}: {len(solids)} solids")
+    return convert_vmf_root(vmf_root, solids, vmf_path, material_resolver, options, vmf_content, solid_cache_path)
+
+# Function for converting the given solids and the func_instance entities of a parsed VMF into one mesh
+def convert_vmf_root(vmf_root, solids, vmf_path, material_resolver, options, vmf_content=None, solid_cache_path=None):
+    materials_before = material_resolver.snapshot()
+    excluded = {}
+    with run_stage('convert'):
+        if solid_cache_path is not None:
+            mesh = convert_solids_incremental(solids, vmf_content, vmf_path, material_resolver, options, solid_cache_path, excluded)
+        else:
+            mesh = convert_solids(solids, vmf_path, material_resolver, options, excluded)[0]
+    
+    with run_stage('instances'):
+        instance_mesh, instance_files, instance_count = expand_instances(vmf_root, vmf_path, vmf_path, material_resolver, options, excluded,
+                                                                         (os.path.abspath(vmf_path),) if vmf_path else ())
+    log_instances(instance_mesh, instance_files, instance_count)
+    if instance_mesh is not None:
+        mesh = concatenate_meshes([mesh, instance_mesh])
+    
+    log_excluded_sides(excluded)
+    run_count('solids', len(solids))
+    run_count('sides', mesh.face_count)
+    run_count('corners', len(mesh.corner_positions))
+    
+    material_resolver.log_stats(materials_before)
+    log_and_print(f"Converted {len(solids)} solids: {mesh.face_count} sides")
+    return mesh
+
+# Function for converting solids in one process or, for big lists, in options.jobs worker processes.
+# Returns the mesh and the number of faces of every solid, sides skipped by the material rules are added to excluded.
+def convert_solids(solids, vmf_path, material_resolver, options, excluded=None):
+    if excluded is None:
+        excluded = {}
+    jobs = options.jobs
+    if jobs <= 1 or len(solids) < MAP_JOBS_MIN_SOLIDS:
+        solid_face_counts = []
+        mesh = convert_solids_to_mesh(solids, material_resolver, solid_face_counts, options, excluded)
+        return mesh, solid_face_counts
+    
+    # Contiguous chunks of solids are converted in worker processes into meshes with local indices,
+    # joined in chunk order the result is the same as in one process
+    chunk_count = jobs * 4
+    chunk_size = -(-len(solids) // chunk_count)
+    chunks = [solids[start:start + chunk_size] for start in range(0, len(solids), chunk_size)]
+    log_and_print(f"Converting {len(solids)} solids in {len(chunks)} chunks with {jobs} workers...")
+    
+    from concurrent.futures import ProcessPoolExecutor
+    flush_log()     # forked workers must not inherit unwritten log lines
+    with ProcessPoolExecutor(max_workers=jobs, initializer=set_log_level, initargs=(LOG_LEVEL,)) as executor:
+        meshes = []
+        solid_face_counts = []
+        for mesh, chunk_face_counts, chunk_excluded, chunk_log in executor.map(convert_solids_chunk, chunks, [vmf_path] * len(chunks),
+                                                                               [options] * len(chunks)):
+            for line, level in chunk_log:
+                log_and_print(line, level)
+            meshes.append(mesh)
+            solid_face_counts.extend(chunk_face_counts)
+            for material_path, count in chunk_excluded.items():
+                excluded[material_path] = excluded.get(material_path, 0) + count
+    
+    return concatenate_meshes(meshes), solid_face_counts
+
+# Worker process side of convert_solids, returns the chunk mesh, faces per solid, excluded sides and the chunk log
+def convert_solids_chunk(solids, vmf_path, options):
+    start_log_capture()
+    try:
+        solid_face_counts = []
+        excluded = {}
+        mesh = convert_solids_to_mesh(solids, get_material_resolver(vmf_path, options.game_dir, options.material_cache_path), solid_face_counts, options, excluded)
+    finally:
+        chunk_log = stop_log_capture()
+    return mesh, solid_face_counts, excluded, chunk_log
+
+# Incremental conversion: converted solids are kept in a cache file next to the OBJ, keyed by a hash of the solid text,
+# the texture sizes of its materials and the conversion settings. Only new and changed solids are converted again.
+SOLID_CACHE_VERSION = 2
+
+# Function for the path of the solid cache of an OBJ
+def solid_cache_path_for(obj_file_path):
+    return f"{os.path.splitext(obj_file_path)[0]}_solids.npz"
+
+# Function for hashing every solid with the texture sizes and translucency of its materials, whether its entity hides
+# faces behind it (see solid_is_occluder) and the conversion settings.
+# Sides excluded by the material rules are not resolved, their number per material path is added to excluded:
+# this pass sees every solid, the cached ones too.
+def hash_solids(solids, vmf_content, material_resolver, options, excluded):
+    settings = (f'{SOLID_CACHE_VERSION} {options.unit_scale!r} {options.texel_dencity_tex!r} {options.texel_dencity_units!r} '
+                f'{tuple(options.materials_to_remove or ())!r}').encode()
+    material_filter = get_material_filter(options.materials_to_remove)
+    keys = []
+    for solid in solids:
+        h = hashlib.blake2b(settings, digest_size=16)
+        start, end = solid.span
+        h.update(vmf_content[start:end].encode('utf-8', 'surrogatepass'))
+        h.update(b'1' if solid_is_occluder(solid) else b'0')
+        for side in solid.iter_children('side'):
+            material_path = side.get('material')
+            if material_filter.excludes(material_path):
+                excluded[material_path] = excluded.get(material_path, 0) + 1
+                continue
+            info = material_resolver.resolve(material_path)
+            h.update(repr((info.vtf_size, info.translucent)).encode())
+        keys.append(h.hexdigest())
+    return keys
+
+# Solid caches read or written by this process, by path; the watch mode converts maps again without reading the file
+_solid_caches = {}
+
+# Function for reading a solid cache, returns (solid index by key, mesh, solid face offsets) or None
+def load_solid_cache(path):
+    if path in _solid_caches:
+        return _solid_caches[path]
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if int(data['version']) != SOLID_CACHE_VERSION:
+                return None
+            mesh = Mesh(data['positions'], data['uvs'], data['normals'], data['face_offsets'],
+                        data['corner_positions'], data['corner_uvs'], data['corner_normals'],
+                        data['face_materials'], data['face_smoothing'], data['materials'].tolist(), data['face_occluders'])
+            keys = data['keys'].tolist()
+            solid_face_offsets = data['solid_face_offsets']
+    except (OSError, ValueError, KeyError) as e:
+        if os.path.exists(path):
+            log_and_print(f"Solid cache {path} is not readable ({e}), converting all solids", LOG_QUIET)
+        return None
+    return {key: i for i, key in enumerate(keys)}, mesh, solid_face_offsets
+
+# Function for writing a solid cache; written to a temporary file first, so an interrupted run keeps the old cache
+def save_solid_cache(path, keys, mesh, solid_face_offsets):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'wb') as f:
+        np.savez(f, version=np.int64(SOLID_CACHE_VERSION), keys=np.array(keys, dtype=str),
+                 solid_face_offsets=solid_face_offsets, positions=mesh.positions, uvs=mesh.uvs, normals=mesh.normals,
+                 face_offsets=mesh.face_offsets, corner_positions=mesh.corner_positions, corner_uvs=mesh.corner_uvs,
+                 corner_normals=mesh.corner_normals, face_materials=mesh.face_materials, face_smoothing=mesh.face_smoothing,
+                 materials=np.array(mesh.materials, dtype=str), face_occluders=mesh.face_occluders)
+    os.replace(temp_path, path)
+    _solid_caches[path] = ({key: i for i, key in enumerate(keys)}, mesh, solid_face_offsets)
+
+# Function for giving every corner its own position and UV and every face its own normal, in face order
+# (the layout of freshly converted solids)
+def flatten_mesh(mesh):
+    corner_count = len(mesh.corner_positions)
+    corners = np.arange(corner_count, dtype=np.int64)
+    sizes = mesh.face_sizes()
+    return Mesh(mesh.positions[mesh.corner_positions], mesh.uvs[mesh.corner_uvs],
+                mesh.normals[mesh.corner_normals[mesh.face_offsets[:-1]]], mesh.face_offsets, corners, corners.copy(),
+                np.repeat(np.arange(len(sizes), dtype=np.int64), sizes), mesh.face_materials, mesh.face_smoothing, mesh.materials,
+                mesh.face_occluders)
+
+def convert_solids_incremental(solids, vmf_content, vmf_path, material_resolver, options, solid_cache_path, excluded=None):
+    if excluded is None:
+        excluded = {}
+    keys = hash_solids(solids, vmf_content, material_resolver, options, excluded)
+    cache = load_solid_cache(solid_cache_path)
+    if cache is None:
+        cached_solids, cached_mesh, cached_face_offsets = {}, None, np.zeros(1, dtype=np.int64)
+    else:
+        cached_solids, cached_mesh, cached_face_offsets = cache
+    
+    rebuilt = [i for i, key in enumerate(keys) if key not in cached_solids]
+    new_mesh, new_face_counts = convert_solids([solids[i] for i in rebuilt], vmf_path, material_resolver, options)
+    
+    # Faces of every solid in the cached mesh followed by the new one
+    cached_face_count = int(cached_face_offsets[-1])
+    new_face_starts = cached_face_count + np.concatenate(([0], np.cumsum(new_face_counts, dtype=np.int64)))
+    face_starts = np.empty(len(solids), dtype=np.int64)
+    face_counts = np.empty(len(solids), dtype=np.int64)
+    reused = np.ones(len(solids), dtype=bool)
+    reused[rebuilt] = False
+    cached_index = np.array([cached_solids[key] for key, is_reused in zip(keys, reused) if is_reused], dtype=np.int64)
+    face_starts[reused] = cached_face_offsets[cached_index]
+    face_counts[reused] = cached_face_offsets[cached_index + 1] - cached_face_offsets[cached_index]
+    face_starts[~reused] = new_face_starts[:-1]
+    face_counts[~reused] = new_face_counts
+    
+    solid_face_offsets = np.zeros(len(solids) + 1, dtype=np.int64)
+    np.cumsum(face_counts, out=solid_face_offsets[1:])
+    faces = np.repeat(face_starts - solid_face_offsets[:-1], face_counts) + np.arange(solid_face_offsets[-1])
+    
+    combined = concatenate_meshes([cached_mesh, new_mesh] if cached_mesh is not None else [new_mesh])
+    mesh = flatten_mesh(combined.select_faces(faces)).compact()
+    
+    save_solid_cache(solid_cache_path, keys, mesh, solid_face_offsets)
+    run_count('reused_solids', int(np.count_nonzero(reused)))
+    run_count('rebuilt_solids', len(rebuilt))
+    log_and_print(f"Incremental: {int(np.count_nonzero(reused))} solids reused, {len(rebuilt)} rebuilt, cache {solid_cache_path}")
+    return mesh
+
+# Material exclusion rules, compiled once per rule set. Rules are case-insensitive and use '/' as the separator:
+# - a name without folder ("TOOLSNODRAW") matches that material in any folder,
+# - a path ("tools/toolsclip") matches exactly that material,
+# - a path ending with '*' and no other wildcard ("tools/toolsblock*") is a prefix match,
+# - any other rule with '*', '?' or '[' ("tools/*", "*/dev_*") is a glob on the full path.
+class MaterialFilter:
+    def __init__(self, rules):
+        import fnmatch
+        self.rules = tuple(rules)
+        self.names = set()
+        self.paths = set()
+        prefixes = []
+        globs = []
+        for rule in self.rules:
+            rule = rule.replace('\\', '/').strip('/').upper()
+            if not rule:
+                continue
+            wildcards = [char for char in '*?[' if char in rule]
+            if wildcards == ['*'] and rule.endswith('*') and rule.count('*') == 1:
+                prefixes.append(rule[:-1])
+            elif wildcards:
+                globs.append(fnmatch.translate(rule))
+            elif '/' in rule:
+                self.paths.add(rule)
+            else:
+                self.names.add(rule)
+        self.prefixes = tuple(prefixes)
+        self.glob_re = re.compile('|'.join(globs)) if globs else None
+        self.decisions = {}     # material path -> excluded, materials repeat on most sides
+
+    def excludes(self, material_path):
+        excluded = self.decisions.get(material_path)
+        if excluded is None:
+            path = (material_path or '').replace('\\', '/').strip('/').upper()
+            excluded = (path in self.paths or path.rsplit('/', 1)[-1] in self.names or path.startswith(self.prefixes)
+                        or (self.glob_re is not None and self.glob_re.match(path) is not None))
+            self.decisions[material_path] = excluded
+        return excluded
+
+# Compiled filters by rule set, worker processes compile their own
+_material_filters = {}
+
+def get_material_filter(rules):
+    rules = tuple(rules or ())
+    if rules not in _material_filters:
+        _material_filters[rules] = MaterialFilter(rules)
+    return _material_filters[rules]
+
+# Function for logging and counting the sides skipped by the material rules, excluded is material path -> sides
+def log_excluded_sides(excluded):
+    side_count = sum(excluded.values())
+    run_count('excluded_sides', side_count)
+    run_count('excluded_materials', len(excluded))
+    if excluded:
+        top = sorted(excluded.items(), key=lambda item: -item[1])
+        details = ', '.join(f'{material} {count}' for material, count in top[:5]) + (', ...' if len(top) > 5 else '')
+        log_and_print(f"Excluded {side_count} sides of {len(excluded)} materials before conversion ({details})")
+
+# Solids of these entities always hide what they touch. Other brush entities can move, toggle or break (func_door, func_brush,
+# func_breakable, ...), so faces behind them are kept. Solids with no known entity count as world brushes.
+OCCLUDER_CLASSNAMES = ('worldspawn', 'func_detail')
+
+# Function for checking whether the faces of a solid can hide faces of other solids (see find_hidden_faces)
+def solid_is_occluder(solid):
+    return solid.owner is None or solid.owner.lower() in OCCLUDER_CLASSNAMES
+
+# Function for converting solids into one mesh, faces of every solid follow the faces of the previous one.
+# The number of faces of every solid is appended to solid_face_counts if it is given.
+# Sides with materials excluded by options.materials_to_remove are skipped before any other work,
+# their number per material path is added to excluded if it is given. Sides of translucent materials and of solids
+# that aren't occluders are marked as not hiding other faces.
+def convert_solids_to_mesh(solids, material_resolver, solid_face_counts=None, options=None, excluded=None):
+    if options is None:
+        options = ConvertOptions()
+    # Collect the vertices and texture settings of all sides first, geometry is then computed in one batch
+    vertices = []
+    side_vertex_counts = []
+    side_axes = []
+    side_tex_sizes = []
+    side_materials = []
+    side_smoothing = []
+    side_occluders = []
+    material_ids = {}
+    material_filter = get_material_filter(options.materials_to_remove)
+    if excluded is None:
+        excluded = {}
+    for solid in solids:
+        if LOG_LEVEL >= LOG_DEBUG:
+            log_and_print("-" * 50, LOG_DEBUG)
+            solid_id = solid.get('id')
+            
+            if int(solid_id) <= 9:
+                tripled_solid_id = "00" + f'{solid_id}'
+            elif int(solid_id) <= 99:
+                tripled_solid_id = "0" + f'{solid_id}'
+            else:
+                tripled_solid_id = solid_id
+            
+            log_and_print(f"Converting Solid_{tripled_solid_id}...", LOG_DEBUG)
         
-        sides = extract_sides_from_solid(solid_content)
-        side_index = 0
+        first_side = len(side_vertex_counts)
+        occluder = solid_is_occluder(solid)
+        sides = extract_sides_from_solid(solid)
         for side in sides:
-            side_index += 1
-          
-            side_id_pattern = re.compile(r'"id"\s+"([^"]+)"', re.DOTALL)
-            side_match = side_id_pattern.match(side)
-            if side_match:
-                side_id = side_match.group(1)
-                
-            if int(side_id) <= 9:
-                tripled_side_id = "00" + f'{side_id}'
-            elif int(side_id) <= 99:
-                tripled_side_id = "0" + f'{side_id}'
-            else:
-                tripled_side_id = side_id
+            material_path = side.get('material')
+            if material_filter.excludes(material_path):
+                excluded[material_path] = excluded.get(material_path, 0) + 1
+                continue
             
-            vertices = extract_vertices_from_side(side)
-            plane, material, uaxis, vaxis = extract_side_attributes(side)
+            side_vertices = extract_vertices_from_side(side)
+            if len(side_vertices) < 3:
+                log_and_print(f"Side {side.get('id')} has no polygon, skipped", LOG_DEBUG)
+                continue
             
-            vtf_path = get_vtf_path(side, vmf_path)
+            plane, material, uaxis, vaxis = extract_side_attributes(side)
             
-            vtf_resolution = get_vtf_resolution(vtf_path)
+            material_info = material_resolver.resolve(material_path)
+            vtf_resolution = material_info.vtf_size
             if vtf_resolution is not None:
-                vtf_width, vtf_height = get_vtf_resolution(vtf_path)
-                u_tex = vtf_width
-                v_tex = vtf_height
+                u_tex, v_tex = vtf_resolution
             else: 
-                vtf_width, vtf_height = None, None
-                u_tex = texel_dencity_tex
-                v_tex = texel_dencity_tex
-            
-            #log_and_print(f'u_tex: {u_tex}')
-            #log_and_print(f'v_tex: {u_tex}')
-            
-            #log_and_print(f'vtf_width: {vtf_width}')
-            #log_and_print(f'vtf_height: {vtf_height}')
-    
-            for vert_x, vert_y, vert_z in vertices:
-                vertex_index += 1
-                converted_solid += f'v {vert_x * unit_scale} {vert_z * unit_scale} {-vert_y * unit_scale}\n'
-                
-                # UV
-                uv_pattern = re.compile(r"(-?\d+\.?\d*)", re.DOTALL)
-                u_match = re.findall(uv_pattern, uaxis)
-                if u_match:
-                    ux, uy, uz, u_shift, u_tex_scale = map(float, u_match)
-                v_match = re.findall(uv_pattern, vaxis)
-                if v_match:
-                    vx, vy, vz, v_shift, v_tex_scale = map(float, v_match)
-
-                u = ((vert_x * ux + vert_y * uy + vert_z * uz) / texel_dencity_units + u_shift / texel_dencity_tex) * texel_dencity_tex / u_tex
-                v = -((vert_x * vx + vert_y * vy + vert_z * vz) / texel_dencity_units + v_shift / texel_dencity_tex) * texel_dencity_tex / v_tex
-                
-                converted_solid += f'vt {u} {v}\n'
-                
-                nx, ny, nz = find_plane_normal_from_list(vertices)
-                converted_solid += f'vn {nx} {nz} {-ny} \n'
-            
-            converted_solid += f'usemtl {material}\n'           # materials per side
+                u_tex = options.texel_dencity_tex
+                v_tex = options.texel_dencity_tex
             
             sg = extract_smoothing_group(side)
             
-            converted_solid += f's {sg}\n'
-            
-            #converted_solid += f's off\n'                       # temp smoothing groups
-            #converted_solid += f's 1\n'                        # temp smoothing groups
+            vertices.extend(side_vertices)
+            side_vertex_counts.append(len(side_vertices))
+            side_axes.append(parse_texture_axis(uaxis) + parse_texture_axis(vaxis))
+            side_tex_sizes.append((u_tex, v_tex))
+            side_materials.append(material_ids.setdefault(str(material), len(material_ids)))
+            side_smoothing.append(parse_smoothing_group(sg))
+            side_occluders.append(occluder and not material_info.translucent)
+        
+        if solid_face_counts is not None:
+            solid_face_counts.append(len(side_vertex_counts) - first_side)
 
-            converted_solid += f'o Side_{tripled_side_id}\n'    # temp object
-            converted_solid += f'g Side_{tripled_side_id}\n'    # temp group
+    material_resolver.flush()
+    material_resolver.log_stats(level=LOG_DEBUG)
+    log_and_print(f"Converted {len(solids)} solids: {len(side_vertex_counts)} sides, {len(vertices)} corners", LOG_DEBUG)
+    
+    # Every side corner gets its own position and UV, every side one normal
+    with run_stage('geometry'):
+        positions, uvs, normals = compute_sides_geometry(vertices, side_vertex_counts, side_axes, side_tex_sizes, options)
+    counts = np.array(side_vertex_counts, dtype=np.int64)
+    face_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=face_offsets[1:])
+    corners = np.arange(len(positions), dtype=np.int64)
+    
+    return Mesh(positions, uvs, normals, face_offsets, corners, corners.copy(),
+                np.repeat(np.arange(len(counts), dtype=np.int64), counts),
+                np.array(side_materials, dtype=np.int64), np.array(side_smoothing, dtype=np.int64), list(material_ids),
+                np.array(side_occluders, dtype=bool))
 
-            # Faces generation
-            converted_solid += f'f '
-            for i in range(len(vertices)):
-                converted_solid += f'{vertex_index-len(vertices)+i+1}/{vertex_index-len(vertices)+i+1}/{vertex_index-len(vertices)+i+1} '
-            converted_solid += f'\n'
-            
-        converted_data = converted_solid
+# Function for merge objects by material, unused materials are dropped.
+# Sides excluded by the material rules are already skipped by the conversion. Faces are grouped by material in order of the first appearance of the material, keeping their order inside the group.
+def merge_and_filter_objects_by_material(mesh):
+    face_materials = mesh.face_materials
+    
+    # Rank of each material by its first face
+    used_materials, first_faces = np.unique(face_materials, return_index=True)
+    material_rank = np.zeros(len(mesh.materials), dtype=np.int64)
+    material_rank[used_materials[np.argsort(first_faces)]] = np.arange(len(used_materials))
+    
+    faces = np.argsort(material_rank[face_materials], kind='stable')
+    return mesh.select_faces(faces).compact()
+
+# Hidden face culling: a face lying on the plane of an opposite-facing face and fully inside it is sandwiched between
+# two touching brushes and can't be seen. Faces are indexed by quantized plane and, inside a plane, by a coarse 2D grid:
+# the covering face is registered in every cell its bounds touch and the covered face is looked up by the cell of its
+# centroid, so only nearby faces of the same plane are tested. Only occluder faces (Mesh.face_occluders) cover others
+# or get hidden: faces of translucent materials (glass, water, grates, tool brushes) are seen through, and brush
+# entities other than func_detail (doors, func_brush, breakables) can move away. A face is hidden only when one single
+# face contains it, a face covered jointly by several touching brushes is kept. Distances are in hammer units,
+# scaled to OBJ units.
+CULL_EPSILON_UNITS = 0.01
+CULL_NORMAL_STEP = 1e-4
+CULL_CELL_UNITS = 256
+
+# Function for the faces of the mesh hidden by opposite coplanar faces, returns a boolean mask over the faces
+def find_hidden_faces(mesh, epsilon, cell_size):
+    face_count = mesh.face_count
+    hidden = np.zeros(face_count, dtype=bool)
+    sizes = mesh.face_sizes()
+    if not face_count:
+        return hidden
+    
+    first_normals = mesh.corner_normals[mesh.face_offsets[:-1]]
+    normals = np.where((first_normals >= 0)[:, None], mesh.normals[first_normals] if len(mesh.normals) else np.nan, np.nan)
+    candidates = np.flatnonzero((sizes >= 3) & np.isfinite(normals).all(axis=1) & mesh.face_occluders)
+    if not len(candidates):
+        return hidden
+    
+    # Plane key: normal and distance with the sign making the dominant normal axis positive, the sign is the facing
+    corner_points = mesh.positions[mesh.corner_positions]
+    normals = normals[candidates]
+    axes = np.argmax(np.abs(normals), axis=1)
+    facing = np.sign(normals[np.arange(len(candidates)), axes])
+    distances = (normals * corner_points[mesh.face_offsets[:-1][candidates]]).sum(axis=1)
+    plane_keys = np.column_stack((np.round(normals * facing[:, None] / CULL_NORMAL_STEP),
+                                  np.round(distances * facing / epsilon), axes)).astype(np.int64)
+    plane_ids = dedup_rows(plane_keys)[1]
+    
+    # 2D projection dropping the dominant axis, faces of one plane share it
+    u_axes, v_axes = (axes + 1) % 3, (axes + 2) % 3
+    corner_faces = np.repeat(np.arange(len(candidates), dtype=np.int64), sizes[candidates])
+    corners = (np.repeat(mesh.face_offsets[:-1][candidates] - np.cumsum(sizes[candidates]) + sizes[candidates], sizes[candidates])
+               + np.arange(len(corner_faces), dtype=np.int64))
+    points_u = corner_points[corners, u_axes[corner_faces]]
+    points_v = corner_points[corners, v_axes[corner_faces]]
+    
+    def per_face(values, reduce):
+        return reduce.reduceat(values, np.cumsum(sizes[candidates]) - sizes[candidates])
+    
+    u_min, u_max = per_face(points_u, np.minimum), per_face(points_u, np.maximum)
+    v_min, v_max = per_face(points_v, np.minimum), per_face(points_v, np.maximum)
+    counts = sizes[candidates].astype(np.float64)
+    center_u, center_v = per_face(points_u, np.add) / counts, per_face(points_v, np.add) / counts
+    
+    # Covering faces in every grid cell of their bounds, covered faces in the cell of their centroid
+    cell_u0, cell_u1 = np.floor(u_min / cell_size).astype(np.int64), np.floor(u_max / cell_size).astype(np.int64)
+    cell_v0, cell_v1 = np.floor(v_min / cell_size).astype(np.int64), np.floor(v_max / cell_size).astype(np.int64)
+    spans_u, spans_v = cell_u1 - cell_u0 + 1, cell_v1 - cell_v0 + 1
+    entry_faces = np.repeat(np.arange(len(candidates), dtype=np.int64), spans_u * spans_v)
+    entry_index = np.arange(len(entry_faces), dtype=np.int64) - np.repeat(np.cumsum(spans_u * spans_v) - spans_u * spans_v, spans_u * spans_v)
+    entry_u = cell_u0[entry_faces] + entry_index % spans_u[entry_faces]
+    entry_v = cell_v0[entry_faces] + entry_index // spans_u[entry_faces]
+    
+    def cell_keys(faces, cells_u, cells_v, face_facing):
+        return np.column_stack((plane_ids[faces], cells_u, cells_v, face_facing > 0)).astype(np.int64)
+    
+    entry_keys = cell_keys(entry_faces, entry_u, entry_v, facing[entry_faces])
+    lookup_keys = cell_keys(np.arange(len(candidates)), np.floor(center_u / cell_size).astype(np.int64),
+                            np.floor(center_v / cell_size).astype(np.int64), -facing)
+    key_ids = dedup_rows(np.concatenate((entry_keys, lookup_keys)))[1]
+    entry_ids, lookup_ids = key_ids[:len(entry_faces)], key_ids[len(entry_faces):]
+    order = np.argsort(entry_ids, kind='stable')
+    entry_faces, entry_ids = entry_faces[order], entry_ids[order]
+    starts = np.searchsorted(entry_ids, lookup_ids, 'left')
+    ends = np.searchsorted(entry_ids, lookup_ids, 'right')
+    
+    # Pairs (covered, covering) of faces sharing a cell, prefiltered by bounds
+    pair_counts = ends - starts
+    covered = np.repeat(np.arange(len(candidates), dtype=np.int64), pair_counts)
+    covering = entry_faces[np.repeat(starts - np.cumsum(pair_counts) + pair_counts, pair_counts) + np.arange(len(covered), dtype=np.int64)]
+    inside = ((u_min[covered] >= u_min[covering] - epsilon) & (u_max[covered] <= u_max[covering] + epsilon) &
+              (v_min[covered] >= v_min[covering] - epsilon) & (v_max[covered] <= v_max[covering] + epsilon))
+    covered, covering = covered[inside], covering[inside]
+    if not len(covered):
+        return hidden
+    
+    # Containment: every corner of the covered face is inside every edge of the (convex) covering face
+    face_starts = np.cumsum(sizes[candidates]) - sizes[candidates]
+    covered_sizes, covering_sizes = sizes[candidates][covered], sizes[candidates][covering]
+    rows = np.repeat(np.arange(len(covered), dtype=np.int64), covered_sizes * covering_sizes)
+    row_index = np.arange(len(rows), dtype=np.int64) - np.repeat(np.cumsum(covered_sizes * covering_sizes) - covered_sizes * covering_sizes,
+                                                                 covered_sizes * covering_sizes)
+    point = face_starts[covered][rows] + row_index // covering_sizes[rows]
+    edge = row_index % covering_sizes[rows]
+    edge_start = face_starts[covering][rows] + edge
+    edge_end = face_starts[covering][rows] + (edge + 1) % covering_sizes[rows]
+    edge_u, edge_v = points_u[edge_end] - points_u[edge_start], points_v[edge_end] - points_v[edge_start]
+    cross = edge_u * (points_v[point] - points_v[edge_start]) - edge_v * (points_u[point] - points_u[edge_start])
+    
+    # Orientation of the covering face in the projection, from its signed area
+    next_corners = np.arange(1, len(points_u) + 1, dtype=np.int64)
+    next_corners[face_starts + sizes[candidates] - 1] = face_starts
+    signed_areas = np.add.reduceat(points_u * points_v[next_corners] - points_u[next_corners] * points_v, face_starts)
+    edge_lengths = np.sqrt(edge_u * edge_u + edge_v * edge_v)
+    outside = cross * np.sign(signed_areas[covering][rows]) < -epsilon * edge_lengths
+    contained = np.bincount(rows, outside, len(covered)) == 0
+    
+    hidden[candidates[covered[contained]]] = True
+    return hidden
+
+# Function for removing the hidden faces of the mesh (see find_hidden_faces)
+def cull_hidden_faces(mesh, options):
+    hidden = find_hidden_faces(mesh, CULL_EPSILON_UNITS * options.unit_scale, CULL_CELL_UNITS * options.unit_scale)
+    run_count('culled_faces', int(np.count_nonzero(hidden)))
+    log_and_print(f'Culling: removed {np.count_nonzero(hidden)} hidden faces of {mesh.face_count}')
+    return mesh.select_faces(np.flatnonzero(~hidden)).compact()
+
+# Coplanar face merging: Hammer leaves runs of touching coplanar sides with the same material and texture axes, like
+# floors made of blocks. Faces are grouped by plane, material, smoothing group, occluder flag and UV mapping (the texture axes with
+# their scale and shift, taken as the affine map from position to UV of every face), and two faces of a group sharing
+# a chain of edges are merged when the result stays convex; UVs of merged faces are computed again from the mapping.
+# Vertices are matched through the weld grid, so only faces meeting at a vertex are compared. Every round merges a set
+# of disjoint pairs (a pair is taken when its rank is the highest among the pairs of both its faces): first only across
+# edges along one world axis, which makes strips out of grids of blocks, then in any direction until no pair is left.
+# A corner left on a straight edge is dropped when its vertex is on a straight edge of every face using it, so no
+# T-junctions are added. Distances are in OBJ units.
+MERGE_NORMAL_STEP = 1e-4
+MERGE_UV_STEP = 1e-7
+
+# Function for the index of the largest value in every run, runs start at firsts and runs[i] is the run of values[i]
+def run_argmax(values, firsts, runs):
+    maxima = np.maximum.reduceat(values, firsts)
+    hits = np.flatnonzero(values == maxima[runs])
+    return hits[np.unique(runs[hits], return_index=True)[1]]
+
+# Function for the UV mapping of faces, uv = position @ gradients[i] + offsets[i] on face i, solved from 3 corners spread
+# over the face. Returns (gradients F x 3 x 2, offsets F x 2, valid), faces with (nearly) collinear corners aren't valid.
+def face_uv_maps(mesh, faces, normals, epsilon):
+    sizes = mesh.face_sizes()[faces]
+    firsts = np.cumsum(sizes) - sizes
+    runs = np.repeat(np.arange(len(faces), dtype=np.int64), sizes)
+    corners = np.repeat(mesh.face_offsets[:-1][faces] - firsts, sizes) + np.arange(len(runs), dtype=np.int64)
+    points = mesh.positions[mesh.corner_positions[corners]]
+    uvs = mesh.uvs[mesh.corner_uvs[corners]]
+    gradients = np.zeros((len(faces), 3, 2))
+    offsets = np.zeros((len(faces), 2))
+    if not len(faces):
+        return gradients, offsets, np.zeros(0, dtype=bool)
+    
+    # Second corner is the farthest from the first, third is the farthest from the line of the first two
+    deltas = points - points[firsts][runs]
+    second = run_argmax((deltas * deltas).sum(axis=1), firsts, runs)
+    spans = np.cross(deltas[second][runs], deltas)
+    third = run_argmax((spans * spans).sum(axis=1), firsts, runs)
+    edge_a, edge_b = deltas[second], deltas[third]
+    valid = np.sqrt((spans[third] * spans[third]).sum(axis=1)) > epsilon * np.sqrt((edge_a * edge_a).sum(axis=1))
+    
+    if valid.any():
+        matrices = np.stack((edge_a[valid], edge_b[valid], normals[valid]), axis=1)
+        uv_deltas = np.stack((uvs[second][valid] - uvs[firsts][valid], uvs[third][valid] - uvs[firsts][valid],
+                              np.zeros((np.count_nonzero(valid), 2))), axis=1)
+        gradients[valid] = np.linalg.solve(matrices, uv_deltas)
+        offsets[valid] = uvs[firsts][valid] - np.einsum('fi,fij->fj', points[firsts][valid], gradients[valid])
+    return gradients, offsets, valid
+
+# Function for the offsets of faces with the given sizes
+def sizes_to_offsets(sizes):
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    return offsets
+
+# Function for merging the faces of one plane, material, smoothing group and UV mapping (see above)
+def merge_coplanar_faces(mesh, options):
+    if not mesh.face_count:
+        return mesh
+    
+    epsilon = options.weld_epsilon
+    sizes = mesh.face_sizes()
+    face_of_corner = np.repeat(np.arange(mesh.face_count, dtype=np.int64), sizes)
+    labels = weld_positions(mesh.positions, epsilon)[1][mesh.corner_positions] if len(mesh.positions) else np.zeros(0, dtype=np.int64)
+    vertices_before = len(np.unique(labels))
+    
+    # Faces that can be merged, with their plane (and winding around its normal) and UV mapping
+    first_normals = mesh.corner_normals[mesh.face_offsets[:-1]]
+    normals = np.where((first_normals >= 0)[:, None], mesh.normals[first_normals] if len(mesh.normals) else np.nan, np.nan)
+    candidates = np.flatnonzero((sizes >= 3) & np.isfinite(normals).all(axis=1))
+    gradients, offsets, valid = face_uv_maps(mesh, candidates, normals[candidates], epsilon)
+    candidates, gradients, offsets, normals = candidates[valid], gradients[valid], offsets[valid], normals[candidates][valid]
+    
+    corner_points = mesh.positions[mesh.corner_positions]
+    next_corners = np.arange(1, len(face_of_corner) + 1, dtype=np.int64)
+    next_corners[mesh.face_offsets[1:][sizes > 0] - 1] = mesh.face_offsets[:-1][sizes > 0]
+    edge_cross = np.cross(corner_points, corner_points[next_corners])
+    area_vectors = np.column_stack([np.bincount(face_of_corner, edge_cross[:, axis], mesh.face_count) for axis in range(3)])
+    windings = np.where((area_vectors[candidates] * normals).sum(axis=1) < 0, -1, 1)
+    distances = (normals * corner_points[mesh.face_offsets[:-1][candidates]]).sum(axis=1)
+    group_keys = np.column_stack((np.round(normals / MERGE_NORMAL_STEP), np.round(distances / epsilon), windings,
+                                  mesh.face_materials[candidates], mesh.face_smoothing[candidates], mesh.face_occluders[candidates],
+                                  np.round(gradients.reshape(-1, 6) / MERGE_UV_STEP), np.round(offsets / MERGE_UV_STEP))).astype(np.int64)
+    group_ids = dedup_rows(group_keys)[1]
+    group_firsts = np.unique(group_ids, return_index=True)[1]
+    group_normals = normals[group_firsts] * windings[group_firsts][:, None]
+    group_axes = np.argmin(np.abs(group_normals), axis=1)
+    face_groups = np.full(mesh.face_count, -1, dtype=np.int64)
+    face_groups[candidates] = group_ids
+    
+    # Number of faces using every vertex
+    face_labels = dedup_rows(np.column_stack((face_of_corner, labels)))[0]
+    label_faces = np.bincount(face_labels[:, 1])
+    
+    # Faces as corner lists (indices of the corners of the mesh), merged faces take the place of their first face
+    corners, face_sizes = np.arange(len(labels), dtype=np.int64), sizes
+    groups, places, merged = face_groups, np.arange(mesh.face_count, dtype=np.int64), np.zeros(mesh.face_count, dtype=bool)
+    done = []
+    rng = np.random.default_rng(0)
+    strips = True
+    while len(face_sizes):
+        # Faces without a vertex shared with another face of their group are done
+        faces = np.repeat(np.arange(len(face_sizes), dtype=np.int64), face_sizes)
+        vertex_ids = dedup_rows(np.column_stack((groups[faces], labels[corners])))[1]
+        shared = (np.bincount(vertex_ids)[vertex_ids] > 1) & (groups[faces] >= 0)
+        active = np.bincount(faces, shared, len(face_sizes)) > 0
+        done.append((corners[~active[faces]], face_sizes[~active], groups[~active], places[~active], merged[~active]))
+        corners, face_sizes = corners[active[faces]], face_sizes[active]
+        groups, places, merged = groups[active], places[active], merged[active]
+        if not len(face_sizes):
+            break
         
-        if converted_data is not None:
-            obj_data += converted_data
-            obj_data += "\n"
-        else:
-            print(f"Warning: convert_solid_to_obj_with_uvs returned None for solid_content: {solid_content_index}")
+        # Edges (corner to the next one) found once more in the opposite direction, in another face of the group
+        face_offsets = sizes_to_offsets(face_sizes)
+        faces = np.repeat(np.arange(len(face_sizes), dtype=np.int64), face_sizes)
+        next_corners = np.arange(1, len(corners) + 1, dtype=np.int64)
+        next_corners[face_offsets[1:] - 1] = face_offsets[:-1]
+        previous_corners = np.empty_like(next_corners)
+        previous_corners[next_corners] = np.arange(len(corners), dtype=np.int64)
+        starts, ends = labels[corners], labels[corners][next_corners]
+        edge_ids = dedup_rows(np.column_stack((groups[faces], np.minimum(starts, ends), np.maximum(starts, ends))))[1]
+        edge_order = np.argsort(edge_ids, kind='stable')
+        sorted_ids = edge_ids[edge_order]
+        twice = np.flatnonzero((sorted_ids[:-1] == sorted_ids[1:]) & (np.bincount(edge_ids)[sorted_ids[:-1]] == 2))
+        edge_a, edge_b = edge_order[twice], edge_order[twice + 1]
+        opposite = (starts[edge_a] != ends[edge_a]) & (starts[edge_a] == ends[edge_b]) & (faces[edge_a] != faces[edge_b])
+        edge_a, edge_b = edge_a[opposite], edge_b[opposite]
+        
+        # Pairs of faces sharing a chain of edges, face a runs a0 ... ak and face b ak ... a0 (face a is the first one).
+        # The merged face is ak, the rest of face a up to a0, then the rest of face b; it has to be convex at a0 and ak.
+        swap = faces[edge_a] > faces[edge_b]
+        edge_a, edge_b = np.where(swap, edge_b, edge_a), np.where(swap, edge_a, edge_b)
+        pair_ids = dedup_rows(np.column_stack((faces[edge_a], faces[edge_b])))[1]
+        pair_count = int(pair_ids.max()) + 1 if len(pair_ids) else 0
+        corner_pairs = np.full(len(corners), -1, dtype=np.int64)
+        corner_pairs[edge_a], corner_pairs[edge_b] = pair_ids, pair_ids
+        
+        # The chain of a pair starts at the only shared edge after an edge the pair doesn't share
+        chain_a, chain_b = np.full(pair_count, -1, dtype=np.int64), np.full(pair_count, -1, dtype=np.int64)
+        first_a = corner_pairs[previous_corners[edge_a]] != pair_ids
+        first_b = corner_pairs[previous_corners[edge_b]] != pair_ids
+        chain_a[pair_ids[first_a]], chain_b[pair_ids[first_b]] = edge_a[first_a], edge_b[first_b]
+        lengths = np.bincount(pair_ids, minlength=pair_count)
+        face_a, face_b = faces[chain_a], faces[chain_b]
+        size_a, size_b = face_sizes[face_a], face_sizes[face_b]
+        contiguous = ((np.bincount(pair_ids[first_a], minlength=pair_count) == 1) & (np.bincount(pair_ids[first_b], minlength=pair_count) == 1) &
+                      (size_a + size_b - 2 * lengths >= 3))
+        chain_a, chain_b, lengths, face_a, face_b, size_a, size_b = (values[contiguous] for values in
+                                                                     (chain_a, chain_b, lengths, face_a, face_b, size_a, size_b))
+        
+        points = mesh.positions[mesh.corner_positions[corners]]
+        pair_normals = group_normals[groups[face_a]]
+        
+        def junction(previous, at, following):
+            incoming, outgoing = points[at] - points[previous], points[following] - points[at]
+            chord = points[following] - points[previous]
+            turns = (np.cross(incoming, outgoing) * pair_normals).sum(axis=1) / np.maximum(np.sqrt((chord * chord).sum(axis=1)), epsilon)
+            straight = (incoming * outgoing).sum(axis=1) > 0
+            return turns > epsilon, (np.abs(turns) <= epsilon) & straight
+        
+        local_a, local_b = chain_a - face_offsets[face_a], chain_b - face_offsets[face_b]
+        end_a = face_offsets[face_a] + (local_a + lengths) % size_a
+        after_b = face_offsets[face_b] + (local_b + lengths + 1) % size_b
+        convex_a0, flat_a0 = junction(previous_corners[chain_a], chain_a, after_b)
+        convex_ak, flat_ak = junction(previous_corners[chain_b], end_a, next_corners[end_a])
+        mergeable = (convex_a0 | flat_a0) & (convex_ak | flat_ak)
+        if strips:
+            chains = points[end_a] - points[chain_a]
+            along = np.abs(chains[np.arange(len(chains)), group_axes[groups[face_a]]])
+            mergeable &= along >= np.sqrt((chains * chains).sum(axis=1)) - epsilon
+        if not mergeable.any():
+            if strips:
+                strips = False
+                continue
+            done.append((corners, face_sizes, groups, places, merged))
+            break
+        
+        # Disjoint pairs: the highest rank among the pairs of both faces, longer chains first and ties in random order
+        ranks = np.where(mergeable, lengths * len(mergeable) + rng.permutation(len(mergeable)), -1)
+        best = np.full(len(face_sizes), -1, dtype=np.int64)
+        np.maximum.at(best, face_a, ranks)
+        np.maximum.at(best, face_b, ranks)
+        chosen = mergeable & (best[face_a] == ranks) & (best[face_b] == ranks)
+        chain_a, chain_b, lengths, face_a, face_b, size_a, size_b, local_a, local_b, end_a, flat_a0, flat_ak = (
+            values[chosen] for values in (chain_a, chain_b, lengths, face_a, face_b, size_a, size_b, local_a, local_b, end_a, flat_a0, flat_ak))
+        
+        # Ends of the chain are used by one face less, the vertices between them by none of the two faces.
+        # Straight ends used by the merged face only are dropped.
+        rows = np.repeat(np.arange(len(chain_a), dtype=np.int64), lengths + 1)
+        steps = np.arange(len(rows), dtype=np.int64) - np.repeat(np.cumsum(lengths + 1) - lengths - 1, lengths + 1)
+        chain_labels = labels[corners[face_offsets[face_a][rows] + (local_a[rows] + steps) % size_a[rows]]]
+        np.subtract.at(label_faces, chain_labels, np.where((steps == 0) | (steps == lengths[rows]), 1, 2))
+        label_a0, label_ak = labels[corners[chain_a]], labels[corners[end_a]]
+        merged_sizes = size_a + size_b - 2 * lengths
+        drop_ak = flat_ak & (label_faces[label_ak] == 1) & (merged_sizes > 3)
+        drop_a0 = flat_a0 & (label_faces[label_a0] == 1) & (merged_sizes - drop_ak > 3)
+        np.subtract.at(label_faces, label_ak[drop_ak], 1)
+        np.subtract.at(label_faces, label_a0[drop_a0], 1)
+        
+        rows = np.repeat(np.arange(len(chain_a), dtype=np.int64), merged_sizes)
+        steps = np.arange(len(rows), dtype=np.int64) - np.repeat(np.cumsum(merged_sizes) - merged_sizes, merged_sizes)
+        from_a = steps <= (size_a - lengths)[rows]
+        merged_corners = np.where(from_a, face_offsets[face_a][rows] + ((local_a + lengths)[rows] + steps) % size_a[rows],
+                                  face_offsets[face_b][rows] + ((local_b + 2 * lengths - size_a)[rows] + steps) % size_b[rows])
+        keep = ~((steps == 0) & drop_ak[rows]) & ~((steps == (size_a - lengths)[rows]) & drop_a0[rows])
+        
+        untouched = np.ones(len(face_sizes), dtype=bool)
+        untouched[face_a] = untouched[face_b] = False
+        run_count('merged_faces', len(chain_a))
+        corners = np.concatenate((corners[untouched[faces]], corners[merged_corners[keep]]))
+        face_sizes = np.concatenate((face_sizes[untouched], merged_sizes - drop_a0 - drop_ak))
+        groups = np.concatenate((groups[untouched], groups[face_a]))
+        places = np.concatenate((places[untouched], np.minimum(places[face_a], places[face_b])))
+        merged = np.concatenate((merged[untouched], np.ones(len(chain_a), dtype=bool)))
+    
+    corners, face_sizes, groups, places, merged = (np.concatenate(parts) for parts in zip(*done))
+    
+    # Vertices on a straight edge of every face using them (like between a merged floor and a merged wall) are dropped
+    face_offsets = sizes_to_offsets(face_sizes)
+    faces = np.repeat(np.arange(len(face_sizes), dtype=np.int64), face_sizes)
+    next_corners = np.arange(1, len(corners) + 1, dtype=np.int64)
+    next_corners[face_offsets[1:][face_sizes > 0] - 1] = face_offsets[:-1][face_sizes > 0]
+    previous_corners = np.empty_like(next_corners)
+    previous_corners[next_corners] = np.arange(len(corners), dtype=np.int64)
+    points = mesh.positions[mesh.corner_positions[corners]]
+    incoming, outgoing = points - points[previous_corners], points[next_corners] - points
+    chords = points[next_corners] - points[previous_corners]
+    spans = np.cross(incoming, outgoing)
+    straight = (((spans * spans).sum(axis=1) <= epsilon * epsilon * (chords * chords).sum(axis=1)) &
+                ((incoming * outgoing).sum(axis=1) > 0))
+    drop = straight & (np.bincount(labels[corners], ~straight)[labels[corners]] == 0)
+    drop &= (face_sizes - np.bincount(faces, drop, len(face_sizes)) >= 3)[faces]
+    corners, face_sizes = corners[~drop], face_sizes - np.bincount(faces, drop, len(face_sizes)).astype(np.int64)
+
+    # UVs of the merged faces from the mapping of their group
+    merged_corners = np.repeat(merged, face_sizes)
+    merged_groups = np.repeat(groups, face_sizes)[merged_corners]
+    merged_points = mesh.positions[mesh.corner_positions[corners[merged_corners]]]
+    group_candidates = group_firsts[merged_groups]
+    merged_uvs = np.einsum('ci,cij->cj', merged_points, gradients[group_candidates]) + offsets[group_candidates]
+    corner_uvs = mesh.corner_uvs[corners]
+    corner_uvs[merged_corners] = len(mesh.uvs) + np.arange(len(merged_uvs), dtype=np.int64)
+    
+    result = Mesh(mesh.positions, np.concatenate((mesh.uvs, merged_uvs)), mesh.normals, sizes_to_offsets(face_sizes),
+                  mesh.corner_positions[corners], corner_uvs, mesh.corner_normals[corners],
+                  mesh.face_materials[places], mesh.face_smoothing[places], mesh.materials, mesh.face_occluders[places])
+    result = result.select_faces(np.argsort(places, kind='stable')).compact()
+    
+    vertices_after = len(np.unique(labels[corners]))
+    log_and_print(f'Merge coplanar: {mesh.face_count} faces into {result.face_count}, {len(mesh.corner_positions)} corners into '
+                  f'{len(result.corner_positions)}, {vertices_before} vertices into {vertices_after}')
+    return result
+
+# Forward half of the 26 neighbor cells, every pair of neighboring cells is checked once
+_WELD_NEIGHBOR_OFFSETS = [(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1) if (dx, dy, dz) > (0, 0, 0)]
+
+# Function for renumbering cluster labels by first occurrence, returns (first row of each cluster, remap)
+def first_occurrence_remap(labels):
+    unique_labels, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return first[order], rank[inverse.reshape(-1)]
 
-    return obj_data
+# Function for removing duplicate rows, keeps the first occurrence; returns (unique rows, remap)
+# Rows are sorted with a stable lexsort on the columns, much faster than np.unique(axis=0) on float rows.
+def dedup_rows(values):
+    if not len(values):
+        return values, np.zeros(0, dtype=np.int64)
+    order = np.lexsort(values.T[::-1])
+    sorted_values = values[order]
+    changed = np.ones(len(values), dtype=bool)
+    changed[1:] = (sorted_values[1:] != sorted_values[:-1]).any(axis=1)
+    
+    # The stable sort puts the first occurrence of every row first in its run
+    run_ids = np.cumsum(changed) - 1
+    first = order[changed]
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(first)] = np.arange(len(first))
+    remap = np.empty(len(values), dtype=np.int64)
+    remap[order] = rank[run_ids]
+    return values[np.sort(first)], remap
 
-# Function for merge objects by material and remove geometry with some material (TOOLSNODRAW)
-def merge_and_filter_objects_by_material_inplace(obj_file_path, materials_to_remove=None):
-    temp_file_path = obj_file_path + '.tmp'
+# Function for welding positions closer than epsilon with a spatial hash on a grid of epsilon-sized cells.
+# Points in one cell are welded, neighboring cells are welded when any of their points are within epsilon
+# (so chains of near points across cells are welded into one vertex).
+# Welded vertices keep the value and the order of their first occurrence; returns (positions, remap).
+def weld_positions(positions, epsilon):
+    if not len(positions):
+        return positions, np.zeros(0, dtype=np.int64)
     
-    material_to_faces_and_smoothing_groups = defaultdict(list)
-    current_material = None
-    current_smoothing_group = None
+    cells = np.floor(positions / epsilon).astype(np.int64)
     
-    vertices = []
-    texture_coords = []
-    normals = []
-    
-    if materials_to_remove is None:
-        materials_to_remove = set()
-    
-    # Read the OBJ file and group faces by material, also collect vertices, texture coordinates, and normals
-    with open(obj_file_path, 'r') as infile:
-        for line in infile:
-            line = line.strip()
-            if line.startswith('usemtl'):
-                current_material = line.split()[1]
-            elif line.startswith('s '):
-                current_smoothing_group = line
-            elif line.startswith('f'):
-                if current_material is not None and current_material not in materials_to_remove:
-                    material_to_faces_and_smoothing_groups[current_material].append((current_smoothing_group, line))
-            elif line.startswith('v '):
-                vertices.append(line)
-            elif line.startswith('vt '):
-                texture_coords.append(line)
-            elif line.startswith('vn '):
-                normals.append(line)
-    
-    # Write the new content to a temporary OBJ file
-    with open(temp_file_path, 'w') as outfile:
-        # Write vertices, texture coordinates, and normals
-        outfile.write('\n'.join(vertices) + '\n')
-        outfile.write('\n'.join(texture_coords) + '\n')
-        outfile.write('\n'.join(normals) + '\n')
-        
-        # Write grouped faces by material
-        for material, faces_and_smoothing_groups in material_to_faces_and_smoothing_groups.items():
-            outfile.write(f'g {material}\n')
-            outfile.write(f'usemtl {material}\n')
-            last_smoothing_group = None
-            for smoothing_group, face in faces_and_smoothing_groups:
-                if smoothing_group != last_smoothing_group:
-                    outfile.write(smoothing_group + '\n')
-                    last_smoothing_group = smoothing_group
-                outfile.write(face + '\n')
-                
-    # Replace the original OBJ file with the new content
-    shutil.move(temp_file_path, obj_file_path)
-
-def optimize_vertexes(obj_file_path: str, remove_vn: Optional[bool] = False):
-    unique_vertices = {}
-    blocks = []
-    other_lines = []
-    index_offset = 1
-    new_index = 1
-    current_block = []
-    current_smoothing_group = '0'  # Default smoothing group
-    last_group_name = None  # Last group name
-    first_smoothing_group_for_last_group = True  # Flag to check if it's the first smoothing group for the last 'g' group
-
-    with open(obj_file_path, 'r') as f:
-        lines = [line.strip() for line in f.readlines()]
-
-    for line in lines:
-        if line.startswith('v '):
-            vertex_str = ' '.join(format(float(x), '.6f') for x in line[2:].split())
-            if vertex_str not in unique_vertices:
-                unique_vertices[vertex_str] = new_index
-                new_index += 1
-        elif line.startswith('f '):
-            vertex_parts = re.findall(r'(\d+/[\d/]*)', line)
-            updated_face = 'f'
-            for vp in vertex_parts:
-                vertex_idx, *other_indices = vp.split('/')
-                old_index = int(vertex_idx) - index_offset
-                vertex_str = ' '.join(format(float(x), '.6f') for x in lines[old_index][2:].split())
-                new_index = unique_vertices[vertex_str]
-
-                if remove_vn and current_smoothing_group not in ['0', 'off']:
-                    updated_face += f' {new_index}/' + '/'.join(other_indices[:-1])
-                else:
-                    updated_face += f' {new_index}/' + '/'.join(other_indices)
-            current_block.append(updated_face)
-        elif line.startswith('s '):
-            new_smoothing_group = line[2:].strip()
-            if new_smoothing_group != current_smoothing_group:
-                current_smoothing_group = new_smoothing_group
-                if current_block:
-                    blocks.append(current_block)
-                current_block = [f's {current_smoothing_group}']
-                if last_group_name and not first_smoothing_group_for_last_group:
-                    current_block.insert(0, f'g {last_group_name}_sg{current_smoothing_group}')
-                first_smoothing_group_for_last_group = False  # Reset the flag as we have encountered a smoothing group for this 'g' group
-        elif line.startswith('g '):
-            last_group_name = line[2:].strip()
-            first_smoothing_group_for_last_group = True  # Reset the flag as we have a new 'g' group
-            if current_block:
-                blocks.append(current_block)
-            current_block = [line.strip()]
-        elif line.startswith('usemtl '):
-            current_block.append(line.strip())
+    # Cells are packed into int64 keys through the ranks of their coordinates on each axis,
+    # which keeps the keys small for any map size and epsilon
+    axis_values = []
+    axis_ranks = []
+    for axis in range(3):
+        values, ranks = np.unique(cells[:, axis], return_inverse=True)
+        axis_values.append(values)
+        axis_ranks.append(ranks.reshape(-1))
+    sizes = [len(values) for values in axis_values]
+    if sizes[0] * sizes[1] * sizes[2] >= 2 ** 62:
+        # Too many distinct coordinates to pack cells into int64 keys: weld points of the same cell only
+        unique_cells, inverse = np.unique(cells, axis=0, return_inverse=True)
+        first, remap = first_occurrence_remap(inverse.reshape(-1))
+        return positions[first], remap
+    
+    strides = (sizes[1] * sizes[2], sizes[2], 1)
+    keys = axis_ranks[0] * strides[0] + axis_ranks[1] * strides[1] + axis_ranks[2]
+    cell_keys, cell_first, cell_of_point = np.unique(keys, return_index=True, return_inverse=True)
+    cell_of_point = cell_of_point.reshape(-1)
+    cell_ranks = [axis_ranks[axis][cell_first] for axis in range(3)]
+    
+    # Rank of the neighbor coordinate (value - 1, value, value + 1) on each axis, -1 if no cell uses it
+    neighbor_ranks = []
+    for values in axis_values:
+        steps = {}
+        for step in (-1, 0, 1):
+            found = np.minimum(np.searchsorted(values, values + step), len(values) - 1)
+            steps[step] = np.where(values[found] == values + step, found, -1)
+        neighbor_ranks.append(steps)
+    
+    # Pairs of neighboring cells
+    pairs_a = []
+    pairs_b = []
+    for offset in _WELD_NEIGHBOR_OFFSETS:
+        ranks = [neighbor_ranks[axis][offset[axis]][cell_ranks[axis]] for axis in range(3)]
+        candidates = np.flatnonzero((ranks[0] >= 0) & (ranks[1] >= 0) & (ranks[2] >= 0))
+        neighbor_keys = ranks[0][candidates] * strides[0] + ranks[1][candidates] * strides[1] + ranks[2][candidates]
+        found = np.minimum(np.searchsorted(cell_keys, neighbor_keys), len(cell_keys) - 1)
+        exists = cell_keys[found] == neighbor_keys
+        pairs_a.append(candidates[exists])
+        pairs_b.append(found[exists])
+    pairs_a = np.concatenate(pairs_a)
+    pairs_b = np.concatenate(pairs_b)
+    
+    # Neighboring cells are joined when a point of one is within epsilon of a point of the other.
+    # Every distinct point of a cell with neighbors is compared with every distinct point of the neighbor cell.
+    if len(pairs_a):
+        involved = np.zeros(len(cell_keys), dtype=bool)
+        involved[pairs_a] = True
+        involved[pairs_b] = True
+        points = np.flatnonzero(involved[cell_of_point])
+        distinct, distinct_remap = dedup_rows(positions[points])
+        distinct_cells = np.empty(len(distinct), dtype=np.int64)
+        distinct_cells[distinct_remap] = cell_of_point[points]
+        order = np.argsort(distinct_cells, kind='stable')
+        cell_sizes = np.bincount(distinct_cells, minlength=len(cell_keys))
+        cell_starts = np.cumsum(cell_sizes) - cell_sizes
+        
+        sizes_b = cell_sizes[pairs_b]
+        test_counts = cell_sizes[pairs_a] * sizes_b
+        test_pairs = np.repeat(np.arange(len(pairs_a)), test_counts)
+        test_local = np.arange(len(test_pairs)) - np.repeat(np.cumsum(test_counts) - test_counts, test_counts)
+        points_a = order[cell_starts[pairs_a][test_pairs] + test_local // sizes_b[test_pairs]]
+        points_b = order[cell_starts[pairs_b][test_pairs] + test_local % sizes_b[test_pairs]]
+        delta = distinct[points_a] - distinct[points_b]
+        close = np.zeros(len(pairs_a), dtype=bool)
+        close[test_pairs[np.einsum('ij,ij->i', delta, delta) <= epsilon * epsilon]] = True
+        pairs_a = pairs_a[close]
+        pairs_b = pairs_b[close]
+    
+    # Connected cells get the smallest cell index of their group
+    labels = np.arange(len(cell_keys))
+    while len(pairs_a):
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, pairs_a, labels[pairs_b])
+        np.minimum.at(new_labels, pairs_b, labels[pairs_a])
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+    
+    first, remap = first_occurrence_remap(labels[cell_of_point])
+    return positions[first], remap
+
+# Function to weld positions closer than weld_epsilon and merge identical UVs and normals,
+# optionally dropping the normals of smoothed faces
+def optimize_vertexes(mesh, remove_vn: Optional[bool] = False, epsilon=None):
+    if epsilon is None:
+        epsilon = weld_epsilon
+    
+    positions, position_remap = weld_positions(mesh.positions, epsilon)
+    uvs, uv_remap = dedup_rows(mesh.uvs)
+    normals, normal_remap = dedup_rows(mesh.normals)
+    
+    corner_normals = np.where(mesh.corner_normals >= 0, normal_remap[mesh.corner_normals], -1) if len(normals) else mesh.corner_normals
+    if remove_vn:
+        smoothed_corners = np.repeat(mesh.face_smoothing != 0, mesh.face_sizes())
+        corner_normals = np.where(smoothed_corners, -1, corner_normals)
+    
+    run_count('welded_vertices', len(mesh.positions) - len(positions))
+    run_count('merged_uvs', len(mesh.uvs) - len(uvs))
+    run_count('merged_normals', len(mesh.normals) - len(normals))
+    log_and_print(f'Weld: removed {len(mesh.positions) - len(positions)} of {len(mesh.positions)} vertices, '
+                  f'{len(mesh.uvs) - len(uvs)} of {len(mesh.uvs)} uvs, {len(mesh.normals) - len(normals)} of {len(mesh.normals)} normals')
+    
+    optimized = Mesh(positions, uvs, normals, mesh.face_offsets, position_remap[mesh.corner_positions], uv_remap[mesh.corner_uvs],
+                     corner_normals, mesh.face_materials, mesh.face_smoothing, mesh.materials, mesh.face_occluders)
+    return optimized.compact() if remove_vn else optimized
+
+# Smoothing groups to vertex normals. A corner of a smoothed face gets the area-weighted average normal of all faces
+# at its position that share a smoothing group bit with its face (bitmask AND != 0), like Hammer and studiomdl do.
+# Faces are grouped per (position, bitmask), so the work is linear in corners plus the pairs of distinct bitmasks
+# meeting at a position. position_labels maps positions to shared vertices when the mesh isn't welded.
+# Returns the mesh with the smoothed normals added (deduplicated) and the unused face normals removed.
+def sg_to_vn(mesh, position_labels=None):
+    sizes = mesh.face_sizes()
+    face_of_corner = np.repeat(np.arange(mesh.face_count, dtype=np.int64), sizes)
+    first_normals = mesh.corner_normals[mesh.face_offsets[:-1]] if mesh.face_count else np.zeros(0, dtype=np.int64)
+    face_normals = mesh.normals[first_normals] if len(mesh.normals) else np.zeros((mesh.face_count, 3))
+    smoothed_faces = (mesh.face_smoothing != 0) & (first_normals >= 0) & np.isfinite(face_normals).all(axis=1) & (sizes >= 3)
+    smoothed_corners = np.flatnonzero(smoothed_faces[face_of_corner])
+    if not len(smoothed_corners):
+        log_and_print('Smoothing: no smoothed faces', LOG_DEBUG)
+        return mesh
+    
+    # Face areas from the cross products of the corner edges (shoelace formula in 3D)
+    corner_points = mesh.positions[mesh.corner_positions]
+    next_corners = np.arange(1, len(face_of_corner) + 1, dtype=np.int64)
+    next_corners[mesh.face_offsets[1:][sizes > 0] - 1] = mesh.face_offsets[:-1][sizes > 0]
+    edge_cross = np.cross(corner_points, corner_points[next_corners])
+    area_vectors = np.column_stack([np.bincount(face_of_corner, edge_cross[:, axis], mesh.face_count) for axis in range(3)])
+    face_areas = 0.5 * np.sqrt((area_vectors * area_vectors).sum(axis=1))
+    
+    # Groups of smoothed corners with the same position and bitmask, sorted by position
+    labels = mesh.corner_positions[smoothed_corners]
+    if position_labels is not None:
+        labels = position_labels[labels]
+    corner_faces = face_of_corner[smoothed_corners]
+    masks, mask_ids = np.unique(mesh.face_smoothing[corner_faces], return_inverse=True)
+    group_keys, corner_groups = np.unique(labels * len(masks) + mask_ids.reshape(-1), return_inverse=True)
+    corner_groups = corner_groups.reshape(-1)
+    group_labels, group_masks = group_keys // len(masks), masks[group_keys % len(masks)]
+    weighted = face_normals[corner_faces] * face_areas[corner_faces][:, None]
+    group_sums = np.column_stack([np.bincount(corner_groups, weighted[:, axis], len(group_keys)) for axis in range(3)])
+    
+    # Every group is paired with every group at the same position (itself included), pairs sharing a bit are summed
+    run_starts = np.flatnonzero(np.concatenate(([True], group_labels[1:] != group_labels[:-1])))
+    run_lengths = np.diff(np.append(run_starts, len(group_keys)))
+    group_run_starts = np.repeat(run_starts, run_lengths)
+    group_run_lengths = np.repeat(run_lengths, run_lengths)
+    pairs_a = np.repeat(np.arange(len(group_keys), dtype=np.int64), group_run_lengths)
+    pair_firsts = np.cumsum(group_run_lengths) - group_run_lengths
+    pairs_b = np.repeat(group_run_starts - pair_firsts, group_run_lengths) + np.arange(len(pairs_a), dtype=np.int64)
+    shared = (group_masks[pairs_a] & group_masks[pairs_b]) != 0
+    pairs_a, pairs_b = pairs_a[shared], pairs_b[shared]
+    group_normals = np.column_stack([np.bincount(pairs_a, group_sums[pairs_b, axis], len(group_keys)) for axis in range(3)])
+    
+    # Normalized, corners whose sum cancels out (opposite faces) keep their face normal
+    corner_normals = group_normals[corner_groups]
+    lengths = np.sqrt((corner_normals * corner_normals).sum(axis=1))
+    degenerate = lengths < 1e-12
+    corner_normals = np.where(degenerate[:, None], face_normals[corner_faces], corner_normals / np.where(degenerate, 1, lengths)[:, None])
+    
+    normals, normal_remap = dedup_rows(np.concatenate((mesh.normals, corner_normals)))
+    new_corner_normals = np.where(mesh.corner_normals >= 0, normal_remap[mesh.corner_normals], -1)
+    new_corner_normals[smoothed_corners] = normal_remap[len(mesh.normals):]
+    normals, new_corner_normals = compact_indexed(normals, new_corner_normals)
+    
+    run_count('smoothed_corners', len(smoothed_corners))
+    log_and_print(f'Smoothing: {len(smoothed_corners)} corners of {np.count_nonzero(smoothed_faces)} faces in '
+                  f'{len(group_keys)} vertex groups, {len(normals)} normals')
+    
+    return Mesh(mesh.positions, mesh.uvs, normals, mesh.face_offsets, mesh.corner_positions, mesh.corner_uvs, new_corner_normals,
+                mesh.face_materials, mesh.face_smoothing, mesh.materials, mesh.face_occluders)
+
+# Rows per formatting batch of the OBJ writer, bounds the size of the temporary strings
+OBJ_WRITE_CHUNK = 65536
+
+# Function for writing "<prefix> x y z" rows of an array, formatted in bulk.
+# precision is the number of digits after the point, None writes the shortest exact representation.
+def write_obj_rows(f, prefix, values, precision=None):
+    if not len(values):
+        return
+    number_format = '%r' if precision is None else f'%.{precision}f'
+    row_format = prefix + (' ' + number_format) * values.shape[1] + '\n'
+    for start in range(0, len(values), OBJ_WRITE_CHUNK):
+        chunk = values[start:start + OBJ_WRITE_CHUNK]
+        f.write((row_format * len(chunk)) % tuple(chunk.ravel().tolist()))
+
+# Function for writing the mesh as OBJ: v/vt/vn first, then faces grouped by material.
+# Smoothing group changes inside a material group start a "<material>_sg<group>" group.
+# Faces are formatted in bulk, one batch per run of faces with the same material, smoothing group and size.
+def write_obj(mesh, obj_file_path, position_precision=6, float_precision=None):
+    with open(obj_file_path, 'w', buffering=1 << 20) as f:
+        f.write('#\n# Atmus OBJ\n#\n\n')
+        write_obj_rows(f, 'v', mesh.positions, position_precision)
+        write_obj_rows(f, 'vt', mesh.uvs, float_precision)
+        write_obj_rows(f, 'vn', mesh.normals, float_precision)
+        write_obj_faces(f, mesh)
+
+# Function for writing the faces of the mesh with their group/usemtl/s lines.
+# first_indices are the OBJ indices of the first position, uv and normal of the mesh; last_material and
+# last_smoothing_group continue a group written before. Returns the last material and smoothing group.
+def write_obj_faces(f, mesh, first_indices=(1, 1, 1), last_material=None, last_smoothing_group=None):
+    face_count = mesh.face_count
+    if not face_count:
+        return last_material, last_smoothing_group
+    
+    sizes = mesh.face_sizes()
+    has_normals = mesh.corner_normals[mesh.face_offsets[:-1]] >= 0
+    corners = np.column_stack((mesh.corner_positions + first_indices[0], mesh.corner_uvs + first_indices[1],
+                               mesh.corner_normals + first_indices[2]))
+    
+    # Runs of faces that share material, smoothing group, size and normal presence
+    keys = (mesh.face_materials, mesh.face_smoothing, sizes, has_normals)
+    changed = np.zeros(face_count, dtype=bool)
+    changed[0] = True
+    for key in keys:
+        changed[1:] |= key[1:] != key[:-1]
+    run_starts = np.flatnonzero(changed).tolist()
+    run_ends = run_starts[1:] + [face_count]
+    
+    face_offsets = mesh.face_offsets.tolist()
+    face_materials = mesh.face_materials.tolist()
+    face_smoothing = mesh.face_smoothing.tolist()
+    sizes = sizes.tolist()
+    has_normals = has_normals.tolist()
+    
+    for run_start, run_end in zip(run_starts, run_ends):
+        material_id = face_materials[run_start]
+        material = mesh.materials[material_id]
+        smoothing_group = face_smoothing[run_start]
+        if material_id != last_material:
+            f.write(f'g {material}\nusemtl {material}\ns {smoothing_group}\n')
+            last_material = material_id
+        elif smoothing_group != last_smoothing_group:
+            f.write(f'g {material}_sg{smoothing_group}\ns {smoothing_group}\n')
+        last_smoothing_group = smoothing_group
+        
+        size = sizes[run_start]
+        if has_normals[run_start]:
+            face_format = 'f' + ' %d/%d/%d' * size + '\n'
+            run_corners = corners
         else:
-            other_lines.append(line.strip())
-
-    if current_block:
-        blocks.append(current_block)
-
-    with open(obj_file_path, 'w') as f:
-        for vertex_str, index in unique_vertices.items():
-            f.write(f'v {vertex_str}\n')
-        for line in other_lines:
-            f.write(f'{line}\n')
-        for block in blocks:
-            for line in block:
-                f.write(f'{line}\n')
-
-def find_smoothed_faces(file_path):
-    smoothed_faces = {}
-    current_s = '0'  # Initialize with a value that excludes non-smoothed faces
-    global_face_count = 0
-
-    with open(file_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            tokens = line.split()
-            if len(tokens) == 0:
-                continue
+            face_format = 'f' + ' %d/%d' * size + '\n'
+            run_corners = corners[:, :2]
+        for chunk_start in range(run_start, run_end, OBJ_WRITE_CHUNK):
+            chunk_end = min(chunk_start + OBJ_WRITE_CHUNK, run_end)
+            chunk = run_corners[face_offsets[chunk_start]:face_offsets[chunk_end]]
+            f.write((face_format * (chunk_end - chunk_start)) % tuple(chunk.ravel().tolist()))
+    
+    return last_material, last_smoothing_group
+
+# glTF constants: component types, buffer view targets and the GLB chunk types
+GLTF_FLOAT = 5126
+GLTF_UNSIGNED_INT = 5125
+GLTF_ARRAY_BUFFER = 34962
+GLTF_ELEMENT_ARRAY_BUFFER = 34963
+GLB_MAGIC = 0x46546C67      # "glTF"
+GLB_JSON_CHUNK = 0x4E4F534A
+GLB_BIN_CHUNK = 0x004E4942
+
+# Function for triangulating the faces as fans, returns the corner indices of the triangles (T x 3) and their faces.
+# Brush sides are convex, so a fan from the first corner is enough.
+def triangulate_faces(mesh):
+    sizes = mesh.face_sizes()
+    triangle_counts = np.maximum(sizes - 2, 0)
+    faces = np.repeat(np.arange(mesh.face_count, dtype=np.int64), triangle_counts)
+    first = mesh.face_offsets[:-1][faces]
+    # k-th triangle of a face: corners 0, k + 1, k + 2
+    k = np.arange(len(faces), dtype=np.int64) - np.repeat(np.cumsum(triangle_counts) - triangle_counts, triangle_counts)
+    triangles = np.column_stack((first, first + k + 1, first + k + 2))
+    return triangles, faces
+
+# Function for the glTF vertices of the triangles: every distinct (material, position, uv, normal) corner is one vertex.
+# Vertices are ordered by material so every material uses one contiguous range of them.
+# Corners without a normal get the plane normal of their triangle.
+def gltf_vertices(mesh, triangles, triangle_faces):
+    corner_normals = mesh.corner_normals[triangles]
+    normals = mesh.normals
+    missing = corner_normals < 0
+    if missing.any():
+        corner_points = mesh.positions[mesh.corner_positions[triangles]]
+        plane_normals = find_plane_normals(corner_points[:, 0], corner_points[:, 1], corner_points[:, 2])
+        normals = np.concatenate((normals, plane_normals))
+        corner_normals = np.where(missing, len(mesh.normals) + np.arange(len(triangles))[:, None], corner_normals)
+    
+    keys = np.column_stack((np.repeat(mesh.face_materials[triangle_faces], 3), mesh.corner_positions[triangles].reshape(-1),
+                            mesh.corner_uvs[triangles].reshape(-1), corner_normals.reshape(-1)))
+    
+    # The columns are packed into one int64 (material first, so the sort order stays the same) when they fit,
+    # sorting single numbers is much faster than sorting rows
+    radixes = [len(mesh.materials), len(mesh.positions), len(mesh.uvs), len(normals)]
+    if np.prod([float(radix) for radix in radixes]) < 2 ** 62:
+        packed = np.zeros(len(keys), dtype=np.int64)
+        for column, radix in enumerate(radixes):
+            packed = packed * radix + keys[:, column]
+        unique_packed, first, indices = np.unique(packed, return_index=True, return_inverse=True)
+        vertices = keys[first]
+    else:
+        vertices, indices = np.unique(keys, axis=0, return_inverse=True)
+    return vertices, indices.reshape(-1, 3), normals
 
-            # Processing 's' string
-            if tokens[0] == 's':
-                current_s = tokens[1]
+# Function for writing the mesh as binary glTF: one mesh with one primitive per material, triangulated.
+# Every primitive has its own range of the shared vertex buffers (with position bounds) and its own indices.
+# Arrays are written to the file as they are, there is no per-element formatting.
+def write_glb(mesh, glb_file_path, name=None):
+    triangles, triangle_faces = triangulate_faces(mesh)
+    vertices, indices, normals = gltf_vertices(mesh, triangles, triangle_faces)
+    
+    # glTF wants float32 attributes and UVs with the origin at the top left
+    positions = mesh.positions[vertices[:, 1]].astype(np.float32)
+    uvs = mesh.uvs[vertices[:, 2]].astype(np.float32)
+    uvs[:, 1] = 1 - uvs[:, 1]
+    vertex_normals = normals[vertices[:, 3]].astype(np.float32)
+    
+    # Triangles grouped by material (stable, so faces keep their order), indices local to the material's vertex range
+    triangle_materials = vertices[indices[:, 0], 0]
+    order = np.argsort(triangle_materials, kind='stable')
+    triangle_materials = triangle_materials[order]
+    vertex_starts = np.searchsorted(vertices[:, 0], np.arange(len(mesh.materials) + 1))
+    triangle_starts = np.searchsorted(triangle_materials, np.arange(len(mesh.materials) + 1))
+    local_indices = (indices[order] - vertex_starts[triangle_materials][:, None]).astype(np.uint32)
+    
+    # Binary chunk: positions, normals, uvs, indices, every block is a multiple of 4 bytes
+    blocks = [positions, vertex_normals, uvs, local_indices]
+    block_offsets = np.cumsum([0] + [block.nbytes for block in blocks]).tolist()
+    buffer_views = [{'buffer': 0, 'byteOffset': block_offsets[i], 'byteLength': blocks[i].nbytes,
+                     'target': GLTF_ELEMENT_ARRAY_BUFFER if i == 3 else GLTF_ARRAY_BUFFER} for i in range(len(blocks))]
+    for i in range(3):
+        buffer_views[i]['byteStride'] = blocks[i].shape[1] * 4
+    
+    accessors = []
+    primitives = []
+    for material_id, material in enumerate(mesh.materials):
+        vertex_start, vertex_end = int(vertex_starts[material_id]), int(vertex_starts[material_id + 1])
+        triangle_start, triangle_end = int(triangle_starts[material_id]), int(triangle_starts[material_id + 1])
+        if triangle_start == triangle_end:
+            continue
+        
+        material_positions = positions[vertex_start:vertex_end]
+        attributes = {}
+        for view, (attribute, accessor_type, width) in enumerate((('POSITION', 'VEC3', 12), ('NORMAL', 'VEC3', 12), ('TEXCOORD_0', 'VEC2', 8))):
+            attributes[attribute] = len(accessors)
+            accessors.append({'bufferView': view, 'byteOffset': vertex_start * width, 'componentType': GLTF_FLOAT,
+                              'count': vertex_end - vertex_start, 'type': accessor_type})
+        accessors[attributes['POSITION']]['min'] = material_positions.min(axis=0).tolist()
+        accessors[attributes['POSITION']]['max'] = material_positions.max(axis=0).tolist()
+        
+        primitives.append({'attributes': attributes, 'indices': len(accessors), 'material': material_id})
+        accessors.append({'bufferView': 3, 'byteOffset': triangle_start * 12, 'componentType': GLTF_UNSIGNED_INT,
+                          'count': (triangle_end - triangle_start) * 3, 'type': 'SCALAR'})
+    
+    if name is None:
+        name = os.path.splitext(os.path.basename(glb_file_path))[0]
+    gltf = {'asset': {'version': '2.0', 'generator': 'vmf_to_obj_solids_mats'},
+            'scene': 0, 'scenes': [{'nodes': [0]}], 'nodes': [{'mesh': 0, 'name': name}],
+            'meshes': [{'name': name, 'primitives': primitives}],
+            'materials': [{'name': material} for material in mesh.materials],
+            'accessors': accessors, 'bufferViews': buffer_views, 'buffers': [{'byteLength': block_offsets[-1]}]}
+    if not primitives:
+        # Empty buffers are not allowed, a map without faces gets an empty node
+        for key in ('meshes', 'materials', 'accessors', 'bufferViews', 'buffers'):
+            del gltf[key]
+        del gltf['nodes'][0]['mesh']
+        blocks = []
+    
+    json_chunk = json.dumps(gltf, separators=(',', ':')).encode('utf-8')
+    json_chunk += b' ' * (-len(json_chunk) % 4)
+    total_length = 12 + 8 + len(json_chunk) + (8 + block_offsets[-1] if blocks else 0)
+    with open(glb_file_path, 'wb') as f:
+        f.write(struct.pack('<III', GLB_MAGIC, 2, total_length))
+        f.write(struct.pack('<II', len(json_chunk), GLB_JSON_CHUNK))
+        f.write(json_chunk)
+        if blocks:
+            f.write(struct.pack('<II', block_offsets[-1], GLB_BIN_CHUNK))
+            for block in blocks:
+                f.write(memoryview(np.ascontiguousarray(block)).cast('B'))
+    
+    run_count('glb_vertices', len(vertices))
+    run_count('glb_triangles', len(triangles))
+
+# Solids converted per batch in streaming mode, and the size of face text kept in memory before it is spilled to disk
+STREAM_BATCH_SOLIDS = 1000
+STREAM_SPILL_BUFFER = 8 * 1024 * 1024
+
+# Function for converting a VMF with bounded memory: solids are read from the memory-mapped VMF one by one,
+# converted in batches and appended to spill files (v, vt, vn and faces per material) next to the OBJ,
+# the OBJ is then assembled from those files. Vertices are not welded in this mode.
+def convert_vmf_streaming(vmf_path, obj_file_path, material_resolver=None, options=None,
+                          position_precision=6, float_precision=None):
+    log_and_print(f"Start convert_vmf_streaming...\n", LOG_DEBUG)
+    if options is None:
+        options = ConvertOptions()
+    if material_resolver is None:
+        material_resolver = get_material_resolver(vmf_path, options.game_dir, options.material_cache_path)
+    materials_before = material_resolver.snapshot()
+    
+    spill_dir = tempfile.mkdtemp(prefix='vmf_to_obj_', dir=os.path.dirname(os.path.abspath(obj_file_path)))
+    try:
+        element_files = [open(os.path.join(spill_dir, name), 'w', buffering=1 << 20) for name in ('v', 'vt', 'vn')]
+        material_spills = {}    # material -> [spill path, buffered face text, last smoothing group]
+        buffered_size = 0
+        first_indices = [1, 1, 1]
+        solid_count = 0
+        face_count = 0
+        excluded = {}
+        
+        def convert_batch_of_solids(solids):
+            write_batch(convert_solids_to_mesh(solids, material_resolver, options=options, excluded=excluded))
+        
+        def write_batch(mesh):
+            nonlocal buffered_size, face_count
+            mesh = merge_and_filter_objects_by_material(mesh)
+            write_obj_rows(element_files[0], 'v', mesh.positions, position_precision)
+            write_obj_rows(element_files[1], 'vt', mesh.uvs, float_precision)
+            write_obj_rows(element_files[2], 'vn', mesh.normals, float_precision)
             
-            # Processing 'f' string
-            elif tokens[0] == 'f':
-                global_face_count += 1
-                #log_and_print(f'\nglobal_face_count:{global_face_count}\n')
-                #log_and_print(f'\ncurrent_s:{current_s}\n')
-                
-                if current_s not in {'0', 'off'}:
-                    face_key = f'f_{global_face_count}'
-                    face_vertices = []
-                    for face_data in tokens[1:]:
-                        v_index, vt_index, vn_index = map(int, face_data.split('/'))
-                        face_vertex = [v_index, vt_index, vn_index]
-                        face_vertices.append(face_vertex)
-                    smoothed_faces[face_key] = face_vertices
-
-    return smoothed_faces
-
-# Does not work and useless
-#def find_identical_vertices(obj_file_path, target_vertex_index):
-#    identical_vertex_indices = []
-#    target_vertex_value = None
-#
-#    with open(obj_file_path, 'r') as f:
-#        lines = f.readlines()
-#
-#    vertex_count = 0
-#    for i, line in enumerate(lines):
-#        line = line.strip()
-#        if line.startswith("v "):  # This line defines a vertex
-#            vertex_count += 1
-#            tokens = line.split()
-#            vertex_value = tuple(map(float, tokens[1:]))  # Extract x, y, z coordinates and convert them to float
-#
-#            if vertex_count == target_vertex_index:  # This is the target vertex
-#                target_vertex_value = vertex_value
-#
-#            if target_vertex_value and vertex_value == target_vertex_value:
-#                identical_vertex_indices.append(vertex_count)
-#
-#    return identical_vertex_indices
-
-def find_smoothed_vertices(file_path):
-    smoothed_vertices = {}
-    current_s = '0'  # Initialize with a value that excludes non-smoothed faces
-    global_vertices_count = 0
-
-    smoothed_faces = find_smoothed_faces(file_path)
-    
-    for face in smoothed_faces:
-        for face_vertex in smoothed_faces[face]:
-            for face_vertex in smoothed_faces[face]:
-                v_index, vt_index, vn_index = face_vertex
-                smoothed_vertices[v_index] = face, face_vertex
-    #log_and_print(f'smoothed_vertices:\n{smoothed_vertices}')
-    
-    return smoothed_vertices
-
-# Function to read a specific vertex from an OBJ file by index
-def read_vertex_from_obj(obj_file_path, vertex_number):
-    vertex_count = 0
-    vertex_value = None
-    
-    # Open the OBJ file and read line by line
-    with open(obj_file_path, 'r') as file:
-        for line in file:
-            # Lines that define vertices start with 'v'
-            if line.startswith('v '):
-                vertex_count += 1
+            # Faces are grouped by material after the merge, every group goes to its material's spill
+            group_starts = np.flatnonzero(np.diff(mesh.face_materials, prepend=-1)).tolist()
+            group_ends = group_starts[1:] + [mesh.face_count]
+            for start, end in zip(group_starts, group_ends):
+                material_id = int(mesh.face_materials[start])
+                material = mesh.materials[material_id]
+                spill = material_spills.get(material)
+                if spill is None:
+                    spill = material_spills[material] = [os.path.join(spill_dir, f'f{len(material_spills)}'), io.StringIO(), None]
+                    last_material = None
+                else:
+                    last_material = material_id
                 
-                # If the current vertex is the one we are looking for, store its value
-                if vertex_count == vertex_number:
-                    vertex_value = line.strip().split(' ')[1:]
-                    break
-                    
-    if vertex_value is None:
-        return "Vertex not found."
-    
-    return ' '.join(vertex_value)
-
-# Smoothing groups to vertex normals
-def sg_to_vn(obj_file_path):
-    smoothed_faces = find_smoothed_faces(obj_file_path) # Vocab with faces and vertexes
-    smoothed_vertices = find_smoothed_vertices(obj_file_path)
-    vertex_normals = {}
-    
-    #log_and_print(f'\nSmoothed faces separated:')
-    #for face in smoothed_faces:
-    #    log_and_print(f'{face}')
-    #    for face_vertex in smoothed_faces[face]:
-    #        log_and_print(f'    {face_vertex}')
-    #        
-    #for face in smoothed_faces:
-    #    for face_vertex in smoothed_faces[face]:
-    #        v_index, vt_index, vn_index = face_vertex
-            
-    #log_and_print(f'smoothed_vertices:\n{smoothed_vertices}')
-    
-    #log_and_print(f'smoothed_faces: {smoothed_faces}')
-    for face, vertices in smoothed_faces.items():
-        #log_and_print(f'face: {face}')
-        #log_and_print(f'vertices: {vertices}')
-        for vertex_data in vertices:
-            v, vt, vn = vertex_data
-            #log_and_print(f'v: {v}')
-            #log_and_print(f'vt: {vt}')
-            #log_and_print(f'vn: {vn}')
-            vertex_key = f'v_{v}'
+                buffer = spill[1]
+                before = buffer.tell()
+                last_material, spill[2] = write_obj_faces(buffer, mesh.select_faces(np.arange(start, end)), first_indices,
+                                                          last_material, spill[2])
+                buffered_size += buffer.tell() - before
             
-            # Initialize the list for this vertex if it's not already in the dictionary
-            if vertex_key not in vertex_normals:
-                vertex_normals[vertex_key] = []
+            first_indices[0] += len(mesh.positions)
+            first_indices[1] += len(mesh.uvs)
+            first_indices[2] += len(mesh.normals)
+            face_count += mesh.face_count
             
-            vertex_normals[vertex_key].append(vn)
-            
-    log_and_print(f'vertex_normals: {vertex_normals}')
-    
-    #for face in smoothed_faces:
-    #    for face_vertex in smoothed_faces[face]:
-    #        for face_vertex in smoothed_faces[face]:
-    #            v_index, vt_index, vn_index = face_vertex
-    
-    #log_and_print(f'smoothed_vertices:')
-    #for vertex_index in smoothed_vertices:
-        #log_and_print(f'{vertex_index}')
-        
-        #find_identical_vertices(obj_file_path, vertex_index):
-        #log_and_print(f'Same vertices:')
-        #log_and_print(f'    {ident_v}')
-    
-    #for vertex_index in smoothed_vertices:
-    #    for content in smoothed_vertices[vertex_index]:
-    #        log_and_print(f'vertex content: {content}')
-    #        #face, face_vertex = content
-    #        #log_and_print(f'vertex: {face_vertex}')
-    #find_identical_vertices(obj_file_path, target_vertex_index)
-    
-    
-        #for vertex in smoothed_vertices:
-    #    log_and_print(f'vertex {vertex}:')
-    #    vertex_content = smoothed_vertices[vertex]:
-    #        log_and_print(f'    {vertex_content}:')
-    
-    #with open(file_path, 'r') as f:
-    #    for line in f:
-    #        line = line.strip()
-    #        tokens = line.split()
-    #        if len(tokens) == 0:
-    #            continue
-    #
-    #        # Processing 's' string
-    #        if tokens[0] == 's':
-    #            current_s = tokens[1]
-    #        
-    #        # Processing 'f' string
-    #        elif tokens[0] == 'f':
-    #            global_face_count += 1
-    #            #log_and_print(f'\nglobal_face_count:{global_face_count}\n')
-    #            #log_and_print(f'\ncurrent_s:{current_s}\n')
-    #            
-    #            if current_s not in {'0', 'off'}:
-    #                face_key = f'f_{global_face_count}'
-    #                face_vertices = []
-    #                for face_data in tokens[1:]:
-    #                    v_index, vt_index, vn_index = map(int, face_data.split('/'))
-    #                    face_vertex = [v_index, vt_index, vn_index]
-    #                    face_vertices.append(face_vertex)
-    #                smoothed_faces[face_key] = face_vertices
-    #
-    #return smoothed_faces
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    #smoothed_faces = {
-    #'f': [face_vertex, face_vertex, face_vertex],
-    #}
-    #
-    #face_vertex = [v_index, vt_index, vn_index]
-    #
-    #face_pattern = re.compile(r'f\s+((\d+/\d+/\d+\s+)+\d+/\d+/\d+)', re.DOTALL)
-    #
-    #u_match = re.findall(uv_pattern, uaxis)
-    #            if u_match:
-    #                ux, uy, uz, u_shift, u_tex_scale = map(float, u_match)
-    
-
-    
-    #with open(obj_file_path, 'r') as f:
-    #    lines = [line.strip() for line in f.readlines()]
-    #    
-    #for line in lines:
-    #    if line.startswith('f ')
-    #        
-    #
-    #for line in lines:
-    #    if line.startswith('v '):
-    #        vertex_str = ' '.join(format(float(x), '.6f') for x in line[2:].split())
-    #        if vertex_str not in unique_vertices:
-    #            unique_vertices[vertex_str] = new_index
-    #            new_index += 1
-    #    elif line.startswith('f '):
-    #        vertex_parts = re.findall(r'(\d+/[\d/]*)', line)
-    #        updated_face = 'f'
-    #        for vp in vertex_parts:
-    #            vertex_idx, *other_indices = vp.split('/')
-    #            old_index = int(vertex_idx) - index_offset
-    #            vertex_str = ' '.join(format(float(x), '.6f') for x in lines[old_index][2:].split())
-    #            new_index = unique_vertices[vertex_str]
-    #
-    #            if remove_vn and current_smoothing_group not in ['0', 'off']:
-    #                updated_face += f' {new_index}/' + '/'.join(other_indices[:-1])
-    #            else:
-    #                updated_face += f' {new_index}/' + '/'.join(other_indices)
-    #        current_block.append(updated_face)
-    #    elif line.startswith('s '):
-    #        new_smoothing_group = line[2:].strip()
-    #        if new_smoothing_group != current_smoothing_group:
-    #            current_smoothing_group = new_smoothing_group
-    #            if current_block:
-    #                blocks.append(current_block)
-    #            current_block = [f's {current_smoothing_group}']
-    #            if last_group_name and not first_smoothing_group_for_last_group:
-    #                current_block.insert(0, f'g {last_group_name}_sg{current_smoothing_group}')
-    #            first_smoothing_group_for_last_group = False  # Reset the flag as we have encountered a smoothing group for this 'g' group
-    #    elif line.startswith('g '):
-    #        last_group_name = line[2:].strip()
-    #        first_smoothing_group_for_last_group = True  # Reset the flag as we have a new 'g' group
-    #        if current_block:
-    #            blocks.append(current_block)
-    #        current_block = [line.strip()]
-    #    elif line.startswith('usemtl '):
-    #        current_block.append(line.strip())
-    #    else:
-    #        other_lines.append(line.strip())
-    #
-    #if current_block:
-    #    blocks.append(current_block)
-    #
-    #with open(obj_file_path, 'w') as f:
-    #    for vertex_str, index in unique_vertices.items():
-    #        f.write(f'v {vertex_str}\n')
-    #    for line in other_lines:
-    #        f.write(f'{line}\n')
-    #    for block in blocks:
-    #        for line in block:
-    #            f.write(f'{line}\n')
-    
-def main():
-    # Assuming the VMF files are dragged onto the script
-    for vmf_path in sys.argv[1:]:
-        #log_and_print(f'vmf_path: {vmf_path}')
-        if vmf_path.lower().endswith('.vmf'):
+            if buffered_size >= STREAM_SPILL_BUFFER:
+                spill_faces()
+        
+        def spill_faces():
+            nonlocal buffered_size
+            for spill_path, buffer, last_smoothing_group in material_spills.values():
+                if buffer.tell():
+                    with open(spill_path, 'a') as spill_file:
+                        spill_file.write(buffer.getvalue())
+                    buffer.seek(0)
+                    buffer.truncate()
+            buffered_size = 0
+        
+        batch = []
+        instances = []
+        for solid in iter_vmf_solids(vmf_path, instances):
+            batch.append(solid)
+            solid_count += 1
+            if len(batch) >= STREAM_BATCH_SOLIDS:
+                convert_batch_of_solids(batch)
+                batch = []
+        if batch:
+            convert_batch_of_solids(batch)
+        
+        # Instances after the solids, as in convert_vmf_to_mesh
+        instance_root = VMFNode('')
+        instance_root.children = instances
+        instance_mesh, instance_files, instance_count = expand_instances(instance_root, vmf_path, vmf_path, material_resolver, options,
+                                                                         excluded, (os.path.abspath(vmf_path),))
+        log_instances(instance_mesh, instance_files, instance_count)
+        if instance_mesh is not None:
+            write_batch(instance_mesh)
+        spill_faces()
+        
+        for element_file in element_files:
+            element_file.close()
+        
+        # OBJ assembly: v/vt/vn, then the faces of every material in order of first appearance
+        with open(obj_file_path, 'w', buffering=1 << 20) as f:
+            f.write('#\n# Atmus OBJ\n#\n\n')
+            for spill_path in [os.path.join(spill_dir, name) for name in ('v', 'vt', 'vn')] + [spill[0] for spill in material_spills.values()]:
+                if os.path.exists(spill_path):
+                    with open(spill_path, 'r') as spill_file:
+                        shutil.copyfileobj(spill_file, f, 1 << 20)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    
+    material_resolver.log_stats(materials_before)
+    log_excluded_sides(excluded)
+    run_count('solids', solid_count)
+    run_count('sides', face_count)
+    log_and_print(f'Streamed {solid_count} solids: {first_indices[0] - 1} positions, {first_indices[1] - 1} uvs, '
+                  f'{first_indices[2] - 1} normals, {face_count} faces, {len(material_spills)} materials written to {obj_file_path}')
+    return obj_file_path
+
+# Game folder per VMF folder and one material resolver per game folder and disk cache, shared by all VMFs converted in this process
+_gameinfo_dirs = {}
+_material_resolvers = {}
+
+# Function for the shared material resolver of a game folder, given directly or found next to the VMF.
+# Without both the resolver knows no materials and the default texture size is used.
+# cache_path is the persistent material cache of the resolver (see MaterialDiskCache), None for none.
+def get_material_resolver(vmf_path=None, gameinfo_dir=None, cache_path=None):
+    if gameinfo_dir is None and vmf_path is not None:
+        vmf_dir = os.path.dirname(os.path.abspath(vmf_path))
+        if vmf_dir not in _gameinfo_dirs:
+            _gameinfo_dirs[vmf_dir] = find_gameinfo_dir(vmf_path)
+        gameinfo_dir = _gameinfo_dirs[vmf_dir]
+    key = (gameinfo_dir, cache_path)
+    if key not in _material_resolvers:
+        _material_resolvers[key] = MaterialResolver(gameinfo_dir, cache_path)
+    return _material_resolvers[key]
+
+# Function for dropping changed materials from all shared resolvers, returns the number of dropped materials.
+# Cached instance meshes have UVs of the old texture sizes, they are dropped too when a material changed.
+def refresh_material_resolvers():
+    dropped = sum(resolver.refresh() for resolver in _material_resolvers.values())
+    if dropped:
+        _instance_meshes.clear()
+    return dropped
+
+# Function for reading a whole VMF (path or bytes) and converting it into one mesh (see convert_vmf_to_mesh)
+def convert_vmf_content(source, options, material_resolver=None, solid_cache_path=None):
+    with run_stage('read'):
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            vmf_path = None
+            vmf_content = bytes(source).decode('utf-8', errors='replace')
+        else:
+            vmf_path = os.fspath(source)
             with open(vmf_path, 'r') as f:
                 vmf_content = f.read()
-            obj_content = convert_vmf_to_obj(vmf_content, vmf_path)
-            
-            # Save the OBJ content to a file in the same directory as the VMF file
-            obj_file_path = os.path.join(os.path.dirname(vmf_path), f"{os.path.splitext(os.path.basename(vmf_path))[0]}.obj")
-            with open(obj_file_path, 'w') as f:
-                f.write(obj_content)
-            
-            # Merge by materials
-            merge_and_filter_objects_by_material_inplace(obj_file_path, "TOOLSNODRAW")
+    run_count('vmf_bytes', len(vmf_content))
+    
+    if material_resolver is None:
+        material_resolver = get_material_resolver(vmf_path, options.game_dir, options.material_cache_path)
+    return convert_vmf_to_mesh(vmf_content, vmf_path, material_resolver, options, solid_cache_path)
+
+# Library entry point: converts a VMF into a mesh merged by materials (and welded), ready for write_obj.
+# source is the path of the VMF or its content as bytes; for bytes the game folder comes from options.game_dir.
+# Nothing is printed or written to files unless the log is set up with set_log_file, options.material_cache_path or
+# solid_cache_path is set, or a selection is given for a VMF path (its block index is kept next to the map).
+# With a selection only the matching blocks are parsed and converted (see Selection), the solid cache isn't used then.
+# Stages and counters of the call are collected in stats, a new RunStats if None, which is RUN_STATS afterwards.
+def convert(source, options=None, material_resolver=None, solid_cache_path=None, selection=None, stats=None):
+    global RUN_STATS
+    RUN_STATS = stats if stats is not None else RunStats()
+    if options is None:
+        options = ConvertOptions()
+    
+    if selection is not None:
+        mesh = convert_vmf_selection(source, selection, material_resolver, options)
+    else:
+        mesh = convert_vmf_content(source, options, material_resolver, solid_cache_path)
+    
+    # Merge by materials
+    with run_stage('merge'):
+        mesh = merge_and_filter_objects_by_material(mesh)
+    
+    # Faces between touching brushes
+    if options.cull_hidden:
+        with run_stage('cull'):
+            mesh = cull_hidden_faces(mesh, options)
+    
+    # Coplanar faces of one material and texture mapping
+    if options.merge_coplanar:
+        with run_stage('merge_coplanar'):
+            mesh = merge_coplanar_faces(mesh, options)
+    
+    # Same vertices weld
+    if options.weld:
+        with run_stage('weld'):
+            mesh = optimize_vertexes(mesh, False, options.weld_epsilon)
+    
+    # Smoothing groups, faces are smoothed across positions that the weld would join
+    if options.smooth:
+        with run_stage('sg_to_vn'):
+            position_labels = None if options.weld else weld_positions(mesh.positions, options.weld_epsilon)[1]
+            mesh = sg_to_vn(mesh, position_labels)
+    
+    return mesh
+
+# Function for converting one VMF file, the OBJ (or GLB with output_format="glb") is saved in the same directory as the VMF file.
+# With a selection only the matching part of the map is converted (see Selection).
+def convert_vmf_file(vmf_path, options=None, stream=False, incremental=False, report=False, trace_memory=False, output_format='obj',
+                     selection=None):
+    global RUN_STATS
+    RUN_STATS = RunStats(trace_memory)
+    if options is None:
+        options = ConvertOptions()
+    if selection is not None and (stream or incremental):
+        log_and_print("The streaming mode and incremental conversion are not used with a selection", LOG_QUIET)
+        stream = incremental = False
+    if stream and output_format != 'obj':
+        log_and_print("The streaming mode writes OBJ only", LOG_QUIET)
+        output_format = 'obj'
+    obj_file_path = os.path.join(os.path.dirname(vmf_path), f"{os.path.splitext(os.path.basename(vmf_path))[0]}.{output_format}")
+    material_resolver = get_material_resolver(vmf_path, options.game_dir, options.material_cache_path)
+    materials_before = material_resolver.snapshot()
+    
+    try:
+        if stream:
+            if incremental:
+                log_and_print("Incremental conversion is not used in the streaming mode", LOG_QUIET)
+            if options.cull_hidden:
+                log_and_print("Hidden faces are not culled in the streaming mode", LOG_QUIET)
+            if options.merge_coplanar:
+                log_and_print("Coplanar faces are not merged in the streaming mode", LOG_QUIET)
+            with run_stage('stream'):
+                convert_vmf_streaming(vmf_path, obj_file_path, material_resolver, options)
+        else:
+            solid_cache_path = solid_cache_path_for(obj_file_path) if incremental else None
+            mesh = convert(vmf_path, options, material_resolver, solid_cache_path, selection, RUN_STATS)
             
-            # Same vertices weld
-            optimize_vertexes(obj_file_path, False)
+            with run_stage('write'):
+                if output_format == 'glb':
+                    write_glb(mesh, obj_file_path)
+                else:
+                    write_obj(mesh, obj_file_path)
+            log_and_print(f'{mesh} written to {obj_file_path}')
             
-            #find_smoothed_vertices(obj_file_path)
+            run_count('obj_positions', len(mesh.positions))
+            run_count('obj_uvs', len(mesh.uvs))
+            run_count('obj_normals', len(mesh.normals))
+            run_count('obj_faces', mesh.face_count)
+            run_count('obj_materials', len(mesh.materials))
+    finally:
+        RUN_STATS.stop()
+    
+    for name, before, after in zip(('material_hits', 'material_misses', 'material_disk_hits'), materials_before,
+                                   material_resolver.snapshot()):
+        run_count(name, after - before)
+    RUN_STATS.stages['materials'] = {'seconds': material_resolver.load_seconds - materials_before[3], 'calls': RUN_STATS.counters['material_misses']}
+    RUN_STATS.log_summary()
+    
+    if report:
+        report_path = os.path.splitext(obj_file_path)[0] + '_report.json'
+        settings = dict(options._asdict(), stream=stream, incremental=incremental,
+                        selection=selection._asdict() if selection is not None else None)
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(RUN_STATS.report(vmf_path=os.path.abspath(vmf_path), obj_path=os.path.abspath(obj_file_path),
+                                       python=sys.version.split()[0], numpy=np.__version__, settings=settings), f, indent=2)
+        log_and_print(f'Report written to {report_path}')
+    
+    return obj_file_path
+
+# Result of one map of a batch
+BatchResult = namedtuple('BatchResult', ['vmf_path', 'obj_path', 'seconds', 'error', 'log_path'])
+
+# Function for converting one map of a batch: errors are caught and returned, so one bad map doesn't stop the batch.
+# With log_path the map gets its own log file and nothing is printed.
+def run_batch_job(vmf_path, log_path=None, options=None, stream=False, incremental=False, report=False, trace_memory=False,
+                  output_format='obj', selection=None):
+    if log_path is not None:
+        set_log_file(log_path, to_console=False)
+    
+    start_time = time.perf_counter()
+    obj_path = None
+    error = None
+    try:
+        obj_path = convert_vmf_file(vmf_path, options, stream, incremental, report, trace_memory, output_format, selection)
+    except Exception as e:
+        import traceback
+        error = f"{type(e).__name__}: {e}"
+        log_and_print(f"An error occurred: {e}\n{traceback.format_exc()}", LOG_QUIET)
+    seconds = time.perf_counter() - start_time
+    
+    if log_path is not None:
+        close_log()
+    
+    return BatchResult(vmf_path, obj_path, seconds, error, log_path)
+
+# Function for converting many VMFs, in a pool of `jobs` worker processes if jobs > 1.
+# In the pool every map logs to "<map>_vmf_to_obj_log.txt" next to the VMF.
+# options.jobs > 1 converts the solids of each map in parallel, only used when maps are converted one by one.
+def convert_batch(vmf_paths, jobs=1, options=None, stream=False, incremental=False, report=False, trace_memory=False,
+                  output_format='obj', selection=None):
+    start_time = time.perf_counter()
+    results = []
+    if options is None:
+        options = ConvertOptions()
+    
+    if jobs <= 1 or len(vmf_paths) <= 1:
+        for vmf_path in vmf_paths:
+            results.append(run_batch_job(vmf_path, options=options, stream=stream, incremental=incremental,
+                                         report=report, trace_memory=trace_memory, output_format=output_format, selection=selection))
+    else:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(max_workers=jobs, initializer=set_log_level, initargs=(LOG_LEVEL,)) as executor:
+            futures = {}
+            for vmf_path in vmf_paths:
+                log_path = os.path.splitext(vmf_path)[0] + '_vmf_to_obj_log.txt'
+                futures[executor.submit(run_batch_job, vmf_path, log_path, options._replace(jobs=1), stream, incremental, report, trace_memory,
+                                         output_format, selection)] = (vmf_path, log_path)
             
-            sg_to_vn(obj_file_path)
+            for future in as_completed(futures):
+                vmf_path, log_path = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:     # the worker process itself died
+                    result = BatchResult(vmf_path, None, 0.0, f"{type(e).__name__}: {e}", log_path)
+                status = 'FAILED' if result.error else 'ok'
+                log_and_print(f'[{len(results) + 1}/{len(vmf_paths)}] {status} {result.seconds:.2f}s {vmf_path}', LOG_SUMMARY)
+                flush_log()
+                results.append(result)
+        
+        # Summary in the order the maps were given
+        order = {vmf_path: index for index, vmf_path in enumerate(vmf_paths)}
+        results.sort(key=lambda result: order[result.vmf_path])
+    
+    log_batch_summary(results, time.perf_counter() - start_time)
+    return results
+
+def log_batch_summary(results, wall_seconds):
+    failed = [result for result in results if result.error]
+    log_and_print("-" * 50)
+    log_and_print(f'Batch summary: {len(results) - len(failed)} converted, {len(failed)} failed, '
+                  f'{wall_seconds:.2f}s wall, {sum(result.seconds for result in results):.2f}s total map time')
+    for result in results:
+        status = f'FAILED ({result.error})' if result.error else 'ok'
+        log_line = f' [log: {result.log_path}]' if result.log_path and result.error else ''
+        log_and_print(f'  {result.seconds:8.2f}s  {result.vmf_path}  {status}{log_line}')
+
+# Function for collecting VMFs from the arguments, directories are searched recursively
+def collect_vmf_paths(paths):
+    vmf_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                vmf_paths.extend(os.path.join(dirpath, name) for name in sorted(filenames) if name.lower().endswith('.vmf'))
+        elif path.lower().endswith('.vmf'):
+            vmf_paths.append(path)
+    return vmf_paths
+
+# Watch mode: VMFs are polled for changes and converted again after they stay unchanged for the debounce time,
+# so a save that writes the file in several steps is converted once. The process keeps the material resolvers
+# and the solid caches warm, only the changed solids of a saved map are converted again. Materials whose VMT or VTF
+# changed are dropped from the resolvers before every conversion.
+WATCH_POLL_SECONDS = 0.25
+WATCH_DEBOUNCE_SECONDS = 0.2
 
-try:
-    if __name__ == '__main__':
-        main()
+# Function for checking that the OBJ of a map is newer than the map
+def is_obj_up_to_date(vmf_path, output_format='obj'):
+    obj_path = os.path.splitext(vmf_path)[0] + '.' + output_format
+    vmf_stamp, obj_stamp = file_stamp(vmf_path), file_stamp(obj_path)
+    return obj_stamp[1] >= 0 and obj_stamp[0] >= vmf_stamp[0]
+
+def watch(paths, options=None, poll_seconds=WATCH_POLL_SECONDS, debounce_seconds=WATCH_DEBOUNCE_SECONDS, output_format='obj',
+          selection=None):
+    converted = {}      # vmf path -> stamp of the converted version
+    pending = {}        # vmf path -> (stamp, time the stamp was first seen)
+    
+    for vmf_path in collect_vmf_paths(paths):
+        if is_obj_up_to_date(vmf_path, output_format):
+            converted[vmf_path] = file_stamp(vmf_path)
+    log_and_print(f"Watching {len(converted)} up-to-date maps in {', '.join(paths)}, press Ctrl+C to stop")
+    flush_log()
+    
+    try:
+        while True:
+            now = time.monotonic()
+            for vmf_path in collect_vmf_paths(paths):
+                stamp = file_stamp(vmf_path)
+                if stamp[1] < 0 or stamp == converted.get(vmf_path):
+                    pending.pop(vmf_path, None)
+                    continue
+                if pending.get(vmf_path, (None,))[0] != stamp:
+                    pending[vmf_path] = (stamp, now)
+                    continue
+                if now - pending[vmf_path][1] < debounce_seconds:
+                    continue
+                
+                del pending[vmf_path]
+                # Materials edited since the last conversion are resolved again, their texture sizes are also part of the solid cache keys
+                changed_materials = refresh_material_resolvers()
+                if changed_materials:
+                    log_and_print(f'[watch] {changed_materials} changed materials are resolved again')
+                result = run_batch_job(vmf_path, options=options, incremental=selection is None, output_format=output_format,
+                                       selection=selection)
+                converted[vmf_path] = stamp
+                status = f'FAILED ({result.error})' if result.error else 'ok'
+                log_and_print(f'[watch] {time.strftime("%H:%M:%S")} {status} {result.seconds:.2f}s {vmf_path}')
+                flush_log()
+            time.sleep(poll_seconds)
+    except KeyboardInterrupt:
+        log_and_print("Watch stopped")
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert VMF brush geometry to OBJ grouped by materials.")
+    parser.add_argument('paths', nargs='*', help="VMF files or folders with VMF files")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="worker processes for batch conversion, 0 = one per CPU (default 1)")
+    parser.add_argument('--map-jobs', type=int, default=1, help="worker processes for the solids of one map, 0 = one per CPU (default 1)")
+    parser.add_argument('--format', choices=('obj', 'glb'), default='obj', help="output file format (default obj)")
+    parser.add_argument('--stream', action='store_true', help="bounded-memory conversion for very large maps (no vertex weld, smoothing, culling or face merging)")
+    parser.add_argument('--incremental', action='store_true', help="keep converted solids in <map>_solids.npz next to the OBJ and convert only changed ones")
+    parser.add_argument('--watch', action='store_true', help="keep running and convert maps again when they are saved (implies --incremental)")
+    parser.add_argument('--report', action='store_true', help="write stage timings, counters, RSS per stage and the process peak to <map>_report.json next to the OBJ")
+    parser.add_argument('--trace-memory', action='store_true', help="also trace Python allocations per stage for the report (slower)")
+    parser.add_argument('--scale', type=float, default=unit_scale, help=f"OBJ units per hammer unit (default {unit_scale})")
+    parser.add_argument('--texel-size', type=int, default=texel_dencity_tex,
+                        help=f"texture size for materials without a VTF and of the texel density (default {texel_dencity_tex})")
+    parser.add_argument('--texel-units', type=float, default=texel_dencity_units,
+                        help=f"hammer units covered by --texel-size texels (default {texel_dencity_units})")
+    parser.add_argument('--remove-material', action='append', metavar='RULE',
+                        help="skip sides with this material: a name without folder, a path, a path prefix ending with * "
+                             "or a glob like tools/*; case-insensitive, can be repeated (default TOOLSNODRAW)")
+    parser.add_argument('--no-weld', action='store_true', help="don't weld vertices and merge identical UVs and normals")
+    parser.add_argument('--no-smooth', action='store_true', help="keep flat side normals on faces with smoothing groups")
+    parser.add_argument('--cull-hidden', action='store_true', help="remove faces lying entirely inside one opposite face of a touching world or "
+                             "func_detail brush; faces covered only by several brushes together are kept, faces of translucent "
+                             "materials and other brush entities like doors neither cover faces nor get removed")
+    parser.add_argument('--merge-faces', action='store_true',
+                        help="merge touching coplanar faces with the same material and texture axes into bigger convex faces")
+    parser.add_argument('--game-dir', help="folder with gameinfo.txt (default: found next to every VMF)")
+    parser.add_argument('--select-box', type=float, nargs=6, metavar=('X1', 'Y1', 'Z1', 'X2', 'Y2', 'Z2'),
+                        help="convert only solids and instances touching this box (hammer units)")
+    parser.add_argument('--select-visgroup', action='append', metavar='VISGROUP',
+                        help="convert only solids and instances in this visgroup (name or id), can be repeated")
+    parser.add_argument('--select-class', action='append', metavar='CLASSNAME',
+                        help="convert only solids of entities of this class (worldspawn for world brushes, globs like func_*), can be repeated")
+    parser.add_argument('--select-material', action='append', metavar='RULE',
+                        help="convert only solids with a side of this material (rules as for --remove-material), can be repeated")
+    parser.add_argument('--log-level', choices=list(LOG_LEVEL_NAMES), default='summary',
+                        help="quiet: warnings and errors, summary: progress and results (default), debug: every solid, side and vertex")
+    parser.add_argument('--log', default=DEFAULT_LOG_FILE, help=f"log file of this run (default {DEFAULT_LOG_FILE} in the current folder)")
+    parser.add_argument('--no-pause', action='store_true', help="don't wait for Enter at the end")
+    args = parser.parse_args(argv)
+    set_log_level(LOG_LEVEL_NAMES[args.log_level])
+    set_log_file(args.log)
+    
+    # Assuming the VMF files are dragged onto the script
+    vmf_paths = collect_vmf_paths(args.paths)
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    options = ConvertOptions(unit_scale=args.scale, texel_dencity_tex=args.texel_size, texel_dencity_units=args.texel_units,
+                             materials_to_remove=tuple(args.remove_material or ConvertOptions().materials_to_remove),
+                             weld=not args.no_weld, jobs=args.map_jobs if args.map_jobs > 0 else (os.cpu_count() or 1),
+                             game_dir=args.game_dir, smooth=not args.no_smooth, cull_hidden=args.cull_hidden,
+                             merge_coplanar=args.merge_faces, material_cache_path=MATERIAL_CACHE_PATH)
+    
+    # Partial conversion, the block index of every map is kept in <map>_index.npz
+    selection = None
+    if args.select_box or args.select_visgroup or args.select_class or args.select_material:
+        selection = Selection(bbox=(args.select_box[:3], args.select_box[3:]) if args.select_box else None,
+                              visgroups=tuple(args.select_visgroup or ()), classnames=tuple(args.select_class or ()),
+                              materials=tuple(args.select_material or ()))
+    
+    if args.watch:
+        watch(args.paths, options, output_format=args.format, selection=selection)
+        return 0
+    
+    results = convert_batch(vmf_paths, jobs, options, args.stream, args.incremental, args.report, args.trace_memory, args.format,
+                            selection)
+    
+    return 1 if any(result.error for result in results) else 0
+
+if __name__ == '__main__':
+    exit_code = 1
+    try:
+        exit_code = main()
         log_and_print("-" * 50)
         log_and_print(f'Done!')
+    except Exception as e:
+        import traceback
+        print(f"An error occurred: {e}")
+        print(traceback.format_exc())
+    finally:
         # Close log file because we are decent dudes
-        LOG_FILE.close()
-except Exception as e:
-    import traceback
-    print(f"An error occurred: {e}")
-    print(traceback.format_exc())
-finally:
-    input("\nPress Enter to exit...")
\ No newline at end of file
+        close_log()
+        if '--no-pause' not in sys.argv[1:]:
+            input("\nPress Enter to exit...")
+    sys.exit(exit_code)